@@ -0,0 +1,89 @@
+"""Benchmark of the DSP stage.
+
+For each combination of number of channels, chunk size and decimation factor, the levels of the channels and the
+decimated stream are computed on random chunks, as in the DSP process. One JSON line is written with the time per
+chunk and the throughput in multiples of the real time at each sampling rate: the DSP stage keeps up with the
+recording if the factor is greater than 1.
+
+Usage: python3 -m Benchmarks.dsp_benchmark --channels 7 16 32 --chunks 1024 --decimations 0 8 --output results.jsonl
+"""
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import platform
+import sys
+import time
+
+import numpy as np
+
+from Processes.capture_backends import paInt16, get_sample_size
+from Processes.audio_codecs import SAMPLE_TYPES
+from Processes.dsp_process import ChannelLevels, PolyphaseDecimator, chunk_levels
+
+
+def run_configuration(channels, chunk, decimation, options):
+    dtype = SAMPLE_TYPES[get_sample_size(paInt16)]
+    random = np.random.default_rng(0)
+    data = (random.standard_normal((chunk * options.distinct_chunks, channels)) * 3000).astype(dtype).tobytes()
+    chunk_size = chunk * channels * dtype.itemsize
+    levels = ChannelLevels(channels)
+    decimator = PolyphaseDecimator(decimation, channels) if decimation > 1 else None
+
+    # The chunks are viewed in a bytes object, like the memoryviews of the ring buffer
+    view = memoryview(data)
+    n_chunks = 0
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    while time.perf_counter() - start < options.duration:
+        offset = (n_chunks % options.distinct_chunks) * chunk_size
+        samples = np.frombuffer(view[offset:offset + chunk_size], dtype=dtype).reshape(-1, channels)
+        levels.update(*chunk_levels(samples))
+        if decimator is not None:
+            decimator.process(samples)
+        n_chunks += 1
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    seconds_per_chunk = elapsed / n_chunks
+    return {
+        'channels': channels,
+        'chunk': chunk,
+        'decimation': decimation,
+        'chunks': n_chunks,
+        'us_per_chunk': seconds_per_chunk * 1e6,
+        'mb_per_s': n_chunks * chunk_size / elapsed / 1e6,
+        'cpu_percent': 100 * cpu / elapsed,
+        'realtime_factor': {str(rate): chunk / rate / seconds_per_chunk for rate in options.rates},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Throughput benchmark of the DSP stage.')
+    parser.add_argument('--channels', type=int, nargs='+', default=[7, 16, 32])
+    parser.add_argument('--rates', type=int, nargs='+', default=[32000, 48000])
+    parser.add_argument('--chunks', type=int, nargs='+', default=[1024])
+    parser.add_argument('--decimations', type=int, nargs='+', default=[0, 8], help='0 disables the decimation')
+    parser.add_argument('--duration', type=float, default=2, help='seconds of measurement per configuration')
+    parser.add_argument('--distinct-chunks', type=int, default=64, help='different chunks cycled through')
+    parser.add_argument('--output', default=None, help='JSON lines file (default: standard output)')
+    options = parser.parse_args(argv)
+
+    output = open(options.output, 'a') if options.output else sys.stdout
+    run_info = {'host': platform.node(), 'machine': platform.machine(), 'cpus': multiprocessing.cpu_count(),
+                'python': platform.python_version(), 'numpy': np.__version__,
+                'date': datetime.datetime.now().isoformat(timespec='seconds')}
+    try:
+        for channels, chunk, decimation in itertools.product(options.channels, options.chunks, options.decimations):
+            result = run_configuration(channels, chunk, decimation, options)
+            result.update(run_info)
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
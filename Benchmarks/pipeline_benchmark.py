@@ -0,0 +1,202 @@
+"""Benchmark of the record -> save -> compress pipeline.
+
+The pipeline is fed by the synthetic capture backend and it is run for each combination of number of channels,
+sampling rate, chunk size, segment length and number of boards (each board has CHANNELS channels and its own
+record process, the boards are merged by the merge process). For each configuration one JSON line is written with the
+sustained throughput, the high-water marks of the ring buffer and of the files queue, the latencies (p50/p99) from the
+callback to the disk and to the archive, and the CPU time used by every process. A configuration fails if frames are
+lost, if the ring buffer gets half full or if the compression falls behind the recording. The last line reports the
+first configuration that failed.
+
+Usage: python3 -m Benchmarks.pipeline_benchmark --channels 7 16 32 --rates 32000 48000 --output results.jsonl
+       python3 -m Benchmarks.pipeline_benchmark --channels 7 --rates 32000 --boards 1 2 4
+"""
+import argparse
+import ctypes
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from Processes.board_merger import merge_boards
+from Processes.capture_backends import paInt16, get_sample_size
+from Processes.compress_process import compress_data
+from Processes.metrics import PipelineMetrics
+from Processes.record_process import audio_record
+from Processes.ring_buffer import RingWakeup, SharedRingBuffer
+from Processes.save_process import save_data
+from Processes.scrambling import Scrambler
+from Processes.shutdown import ShutdownControl
+
+STAGES = ('record', 'save', 'compress')
+QUEUE_SAMPLE_PERIOD = 0.1  # Seconds between two samples of the depth of the files queue
+DRAIN_TIMEOUT = 60  # Seconds waited for the pipeline to store the data left when the capture ends
+
+
+def _run_stage(index, cpu_times, target, *args):
+    # Run one process of the pipeline and store the CPU time it used (including the pool of the compression)
+    try:
+        target(*args)
+    finally:
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_times[index] = (self_usage.ru_utime + self_usage.ru_stime + children_usage.ru_utime +
+                            children_usage.ru_stime)
+
+
+def run_configuration(board_channels, rate, chunk, segment_seconds, boards, options):
+    sample_size = get_sample_size(paInt16)
+    channels = boards * board_channels
+    path = tempfile.mkdtemp(prefix='mch_benchmark_', dir=options.directory)
+
+    connection_error = multiprocessing.Value(ctypes.c_bool, False)
+    disconnection_error = multiprocessing.Value(ctypes.c_bool, False)
+    ring = SharedRingBuffer(options.ring_slots, chunk * channels * sample_size, channels * sample_size)
+    q_files = multiprocessing.Queue(options.queue_size)
+    metrics = PipelineMetrics()
+    shutdown = ShutdownControl(DRAIN_TIMEOUT)
+
+    backend = 'synthetic:signal={},speed={},duration={}'.format(options.signal, options.speed, options.duration)
+    scrambler = Scrambler.create(os.urandom(32), path, channels) if options.scramble else None
+    if boards == 1:
+        stages = STAGES
+        board_rings = [ring]
+        record_args = [(audio_record, connection_error, ring, paInt16, channels, rate, chunk, backend, metrics)]
+    else:
+        # One record process per board, pinned to its own core, and the merge process
+        stages = tuple('record {}'.format(board) for board in range(boards)) + ('merge',) + STAGES[1:]
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else [None]
+        board_wakeup = RingWakeup()
+        board_rings = [SharedRingBuffer(options.ring_slots, chunk * board_channels * sample_size,
+                                        board_channels * sample_size, board_wakeup) for _ in range(boards)]
+        record_args = [(audio_record, connection_error, board_ring, paInt16, board_channels, rate, chunk, backend,
+                        PipelineMetrics(), cpus[board % len(cpus)]) for board, board_ring in enumerate(board_rings)]
+        record_args.append((merge_boards, connection_error, disconnection_error, board_rings, ring,
+                            [board_channels] * boards, sample_size, rate, chunk, None, shutdown))
+    cpu_times = multiprocessing.RawArray(ctypes.c_double, len(stages))
+    stage_args = record_args + [
+        (save_data, connection_error, disconnection_error, ring, q_files, channels, sample_size, rate, chunk, path, 0,
+         segment_seconds, metrics, None, scrambler, None, shutdown),
+        (compress_data, connection_error, disconnection_error, q_files, path, options.codec, options.workers,
+         metrics, options.archive_format, None, shutdown),
+    ]
+    processes = [multiprocessing.Process(name=name, target=_run_stage, args=(index, cpu_times) + args)
+                 for index, (name, args) in enumerate(zip(stages, stage_args))]
+
+    start = time.monotonic()
+    for process in processes:
+        process.start()
+
+    # The capture ends by itself after DURATION seconds of audio
+    queue_high_water = 0
+    while any(process.is_alive() for process in processes[:boards]):
+        processes[0].join(QUEUE_SAMPLE_PERIOD)
+        queue_high_water = max(queue_high_water, q_files.qsize())
+    capture_time = time.monotonic() - start
+    backlog = metrics.get('segments_written') - metrics.get('segments_compressed')
+
+    # The other processes store the data left and stop as at the end of a recording, within DRAIN_TIMEOUT seconds
+    shutdown.begin()
+    shutdown.end_phase('record')
+    for name, process in zip(stages[boards:], processes[boards:]):
+        if name == 'save':
+            # The save process waits for the end of the merge process (if any) before it stores the frames left
+            shutdown.end_phase('merge')
+        process.join(shutdown.remaining())
+        if process.is_alive():
+            process.kill()
+            process.join()
+    total_time = time.monotonic() - start
+
+    shutil.rmtree(path, ignore_errors=True)
+
+    counters = metrics.snapshot()
+    input_rate = channels * rate * sample_size * options.speed
+    overruns = sum(board_ring.overruns for board_ring in set(board_rings + [ring]))
+    result = {
+        'channels': channels,
+        'boards': boards,
+        'rate': rate,
+        'chunk': chunk,
+        'segment_seconds': segment_seconds,
+        'codec': options.codec,
+        'archive_format': options.archive_format,
+        'scramble': options.scramble,
+        'workers': options.workers,
+        'speed': options.speed,
+        'input_mb_per_s': input_rate / 1e6,
+        'written_mb_per_s': counters['bytes_written'] / capture_time / 1e6,
+        'compressed_mb_per_s': counters['bytes_compressed'] / total_time / 1e6,
+        'compression_ratio': (counters['bytes_compressed'] / counters['bytes_written']
+                              if counters['bytes_written'] else None),
+        'overruns': overruns,
+        'ring_high_water': ring.high_water,
+        'ring_slots': options.ring_slots,
+        'queue_high_water': queue_high_water,
+        'compression_backlog': backlog,
+        'drain_seconds': total_time - capture_time,
+        'disk_latency': metrics.disk_latency.summary(),
+        'archive_latency': metrics.archive_latency.summary(),
+        'cpu_seconds': dict(zip(stages, cpu_times)),
+        'cpu_percent': {stage: 100 * cpu / total_time for stage, cpu in zip(stages, cpu_times)},
+        'exit_codes': {process.name: process.exitcode for process in processes},
+    }
+    result['ok'] = (result['overruns'] == 0 and result['ring_high_water'] < options.ring_slots / 2 and
+                    backlog <= 2 * options.workers + options.queue_size and
+                    all(code == 0 for code in result['exit_codes'].values()))
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Throughput and latency benchmark of the recording pipeline.')
+    parser.add_argument('--channels', type=int, nargs='+', default=[7, 16, 32], help='channels of each board')
+    parser.add_argument('--boards', type=int, nargs='+', default=[1], help='boards recorded together')
+    parser.add_argument('--rates', type=int, nargs='+', default=[32000, 48000])
+    parser.add_argument('--chunks', type=int, nargs='+', default=[1024])
+    parser.add_argument('--segments', type=float, nargs='+', default=[5], help='segment lengths (seconds)')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of audio recorded per configuration')
+    parser.add_argument('--speed', type=float, default=1, help='capture speed, in multiples of the real time')
+    parser.add_argument('--signal', default='noise', help='signal of the synthetic backend')
+    parser.add_argument('--codec', default='delta-zlib')
+    parser.add_argument('--archive-format', default='mchr', choices=['mchr', 'zip'])
+    parser.add_argument('--scramble', action='store_true', help='scramble the segments with a random key')
+    parser.add_argument('--workers', type=int, default=max(1, multiprocessing.cpu_count() - 2))
+    parser.add_argument('--ring-slots', type=int, default=512)
+    parser.add_argument('--queue-size', type=int, default=4)
+    parser.add_argument('--directory', default=None, help='where the segments are written (default: temporary)')
+    parser.add_argument('--output', default=None, help='JSON lines file (default: standard output)')
+    parser.add_argument('--stop-on-failure', action='store_true')
+    options = parser.parse_args(argv)
+
+    output = open(options.output, 'a') if options.output else sys.stdout
+    run_info = {'host': platform.node(), 'machine': platform.machine(), 'cpus': multiprocessing.cpu_count(),
+                'python': platform.python_version(), 'date': datetime.datetime.now().isoformat(timespec='seconds')}
+    first_failure = None
+    try:
+        for boards, channels, rate, chunk, segment_seconds in itertools.product(options.boards, options.channels,
+                                                                                options.rates, options.chunks,
+                                                                                options.segments):
+            result = run_configuration(channels, rate, chunk, segment_seconds, boards, options)
+            result.update(run_info)
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            if not result['ok'] and first_failure is None:
+                first_failure = {key: result[key] for key in ('boards', 'channels', 'rate', 'chunk',
+                                                              'segment_seconds')}
+                if options.stop_on_failure:
+                    break
+        output.write(json.dumps(dict(run_info, first_failure=first_failure)) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
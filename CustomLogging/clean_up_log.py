@@ -1,16 +1,67 @@
-import os
-import subprocess
-
-
-def clean_up(path):
-    # If the system was shut down and python did not have time to complete data compression and log file storage, it
-    # will do it before starting a new recording
-    if os.path.exists(path + '/audio_record.log'):
-        data_path = path + '/Recordings'
-        for folders in os.walk(data_path):
-            # Look for the folder with the log file missing (it should be the last one in the list
-            if not os.path.exists(folders[0] + '/audio_record.log') and folders[0] != data_path:
-                # Compress .wav file(s)
-                subprocess.run(['zip', '-j', '-r', '-m', '-9', folders[0] + '/data.zip', folders[0]])
-                # Move the log file to the folder where data are saved
-                subprocess.run(['mv', 'audio_record.log', folders[0]])
+import json
+import os
+from Processes.session_journal import *
+from Processes.wav_writer import repair_wav
+from Processes.compress_process import SegmentCompressor, DEFLATE
+from Processes.scrambling import SCRAMBLING_NAME, is_scrambled
+
+
+def clean_up(path):
+    # If the system was shut down and python did not have time to complete data compression and log file storage, it
+    # will do it before starting a new recording. Only the journal of the last session is read, so the time needed
+    # does not depend on the number of recordings
+    journal = last_session(path + '/Recordings')
+    if journal is None:
+        return
+
+    # Last state of every segment, in the order the segments were opened
+    settings = {}
+    states = {}
+    log_moved = False
+    for _, state, segment, info in journal.read():
+        if state == STARTED:
+            settings = info or {}
+        elif state == LOG_MOVED:
+            log_moved = True
+        elif segment:
+            states[segment] = state
+
+    # The windows of a scrambled segment are written whole: an incomplete window cannot be descrambled
+    window_frames = 1
+    if is_scrambled(journal.path):
+        with open(os.path.join(journal.path, SCRAMBLING_NAME)) as f:
+            scrambling = json.load(f)
+        window_frames = scrambling['block_frames'] * scrambling['window_blocks']
+
+    compressor = None
+    try:
+        for segment, state in states.items():
+            filename = os.path.join(journal.path, segment)
+            if not os.path.exists(filename + '.wav'):
+                continue
+            if state == COMPRESSED:
+                # The segment is already in the archive: only the .wav file was left
+                os.remove(filename + '.wav')
+                if os.path.exists(filename + '.json'):
+                    os.remove(filename + '.json')
+                continue
+            if state == OPENED:
+                # The segment was not closed: its header is repaired in place, so that the partial data are kept
+                repair_wav(filename + '.wav', window_frames)
+
+            # Compress the segments not yet stored in the archive
+            if compressor is None:
+                compressor = SegmentCompressor(journal.path + '/data.' + settings.get('archive_format', 'zip'),
+                                               settings.get('codec', DEFLATE), 1, journal=journal)
+            compressor.submit(filename)
+        if compressor is not None:
+            compressor.collect(timeout=None)
+    finally:
+        if compressor is not None:
+            compressor.shutdown()
+
+    # Move the log file to the folder where data are saved
+    if not log_moved and os.path.exists(path + '/audio_record.log'):
+        os.rename(path + '/audio_record.log', journal.path + '/audio_record.log')
+        journal.record(LOG_MOVED)
+    journal.close()
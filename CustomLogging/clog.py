@@ -1,69 +1,188 @@
-import sys
-import logging
-import traceback
-import threading
-import multiprocessing
-from logging import FileHandler as FH
-
-
-# ============================================================================
-# Define Log Handler
-# ============================================================================
-class CustomLogHandler(logging.Handler):
-    """multiprocessing log handler
-
-    This handler makes it possible for several processes
-    to log to the same file by using a queue.
-
-    """
-    def __init__(self, fname):
-        logging.Handler.__init__(self)
-
-        self._handler = FH(fname)
-        self.queue = multiprocessing.Queue(-1)
-
-        thrd = threading.Thread(target=self.receive)
-        thrd.daemon = True
-        thrd.start()
-
-    def setFormatter(self, fmt):
-        logging.Handler.setFormatter(self, fmt)
-        self._handler.setFormatter(fmt)
-
-    def receive(self):
-        while True:
-            try:
-                record = self.queue.get()
-                self._handler.emit(record)
-            except (KeyboardInterrupt, SystemExit):
-                raise
-            except EOFError:
-                break
-            except:
-                traceback.print_exc(file=sys.stderr)
-
-    def send(self, s):
-        self.queue.put_nowait(s)
-
-    def _format_record(self, record):
-        if record.args:
-            record.msg = record.msg % record.args
-            record.args = None
-        if record.exc_info:
-            dummy = self.format(record)
-            record.exc_info = None
-
-        return record
-
-    def emit(self, record):
-        try:
-            s = self._format_record(record)
-            self.send(s)
-        except (KeyboardInterrupt, SystemExit):
-            raise
-        except:
-            self.handleError(record)
-
-    def close(self):
-        self._handler.close()
-        logging.Handler.close(self)
+import os
+import sys
+import time
+import queue
+import logging
+import traceback
+import threading
+import multiprocessing
+import multiprocessing.util
+from collections import deque
+
+
+# ============================================================================
+# Define Log Handler
+# ============================================================================
+class CustomLogHandler(logging.Handler):
+    """multiprocessing log handler
+
+    This handler makes it possible for several processes
+    to log to the same file by using a queue.
+
+    Logging never blocks the caller (e.g. the audio callback): records are
+    appended to a bounded buffer of the calling process and formatted later by
+    a flusher thread, which sends them in batches to the main process. There a
+    receiver thread writes them to the file with buffered writes, flushed every
+    FLUSH_PERIOD seconds.
+    A message repeated more than RATE_LIMIT times in DEDUP_WINDOW seconds (e.g.
+    ALSA warnings) is suppressed and summarized. Records that do not fit in the
+    buffers are dropped and counted.
+
+    """
+    def __init__(self, fname, capacity=1000, flush_period=1.0, rate_limit=5, dedup_window=10.0):
+        logging.Handler.__init__(self)
+
+        self.capacity = capacity
+        self.flush_period = flush_period
+        self.rate_limit = rate_limit
+        self.dedup_window = dedup_window
+
+        self._file = open(fname, 'a', buffering=1 << 16)
+        self.queue = multiprocessing.Queue(capacity)
+        self._owner_pid = os.getpid()  # The process which writes the file
+        self._closing = threading.Event()
+
+        self._pid = None
+        self._start_flusher()
+
+        thrd = threading.Thread(target=self.receive)
+        thrd.daemon = True
+        thrd.start()
+        self._receiver = thrd
+
+    def _start_flusher(self):
+        # Buffer and flusher thread of the current process. They are created again in every child process
+        self._pid = os.getpid()
+        self._buffer = deque()
+        self._repeats = {}  # Message -> [start of the window, records in the window, records suppressed]
+        self.dropped = 0  # Records dropped because the buffers were full
+
+        thrd = threading.Thread(target=self._flush_loop)
+        thrd.daemon = True
+        thrd.start()
+
+        # The records left in the buffer are sent when the process exits, before the queue is closed (its finalizer
+        # has exit priority 10)
+        multiprocessing.util.Finalize(self, self.flush, args=(True,), exitpriority=20)
+
+    def receive(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                batch = self.queue.get(timeout=self.flush_period)
+                self._file.write(batch)
+            except queue.Empty:
+                if self._closing.is_set():
+                    break
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except (EOFError, OSError):
+                break
+            except:
+                traceback.print_exc(file=sys.stderr)
+
+            if time.monotonic() - last_flush >= self.flush_period:
+                self._file.flush()
+                last_flush = time.monotonic()
+        self._file.flush()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_period / 2)
+            self.flush()
+
+    def _is_repeated(self, record):
+        # Rate limiting of the repeated messages. It runs in the caller, so it only updates a dictionary
+        try:
+            key = (record.name, record.levelno, record.msg, record.args)
+            repeat = self._repeats.get(key)
+        except TypeError:
+            key = (record.name, record.levelno, record.msg)
+            repeat = self._repeats.get(key)
+
+        if repeat is None or record.created - repeat[0] >= self.dedup_window:
+            if repeat is not None and repeat[2]:
+                self._summarize(key, repeat)
+            self._repeats[key] = [record.created, 1, 0]
+            return False
+
+        repeat[1] += 1
+        if repeat[1] > self.rate_limit:
+            repeat[2] += 1
+            return True
+        return False
+
+    def _summarize(self, key, repeat):
+        name, levelno, msg = key[:3]
+        self._append(logging.LogRecord(name, levelno, __file__, 0, 'Previous message repeated %d more times: %s',
+                                       (repeat[2], msg), None))
+        repeat[2] = 0
+
+    def _append(self, record):
+        if len(self._buffer) >= self.capacity:
+            self.dropped += 1
+        else:
+            self._buffer.append(record)
+
+    def _format_record(self, record):
+        try:
+            return self.format(record) + '\n'
+        except Exception:
+            return 'Unformattable log record: {!r}\n'.format(record.msg)
+
+    def flush(self, final=False):
+        # Format the buffered records and send them to the main process in one batch. The records of the main process
+        # are written directly
+        if os.getpid() != self._pid:
+            return
+
+        # Summaries of the messages suppressed in windows that are over (all of them if the process is exiting)
+        now = time.time()
+        for key, repeat in list(self._repeats.items()):
+            if repeat[2] and (final or now - repeat[0] >= self.dedup_window):
+                self._summarize(key, repeat)
+
+        records = []
+        while self._buffer:
+            records.append(self._buffer.popleft())
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            records.append(logging.LogRecord('logging', logging.WARNING, __file__, 0,
+                                             '%d log records dropped (log buffer full).', (dropped,), None))
+        if not records:
+            return
+
+        batch = ''.join(self._format_record(record) for record in records)
+        if self._pid == self._owner_pid:
+            self._file.write(batch)
+            return
+        try:
+            self.queue.put_nowait(batch)
+        except queue.Full:
+            self.dropped += len(records)
+
+    def handle(self, record):
+        # No lock is taken: appending to the buffer is atomic
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def emit(self, record):
+        try:
+            if os.getpid() != self._pid:
+                self._start_flusher()
+            if not self._is_repeated(record):
+                self._append(record)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def close(self):
+        if os.getpid() == self._owner_pid and not self._closing.is_set():
+            # The receiver writes the batches still in the queue, then the file is flushed
+            self._closing.set()
+            self._receiver.join(5)
+            self.flush(final=True)
+            self._file.flush()
+        logging.Handler.close(self)
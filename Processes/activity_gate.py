@@ -0,0 +1,124 @@
+"""This part of the code defines the activity gate of the save process. The energy of every chunk is measured on each
+channel: the chunks are stored while some channel is active, the long silent stretches are replaced by markers with
+their length and their level, so that the data written and compressed depend on the events and not on the length of
+the recording.
+
+The noise floor of every channel is followed by the gate: it drops at once with the level and rises by FLOOR_RISE dB
+per second at most, so that short events do not change it, and it is never lower than MIN_LEVEL. A channel becomes
+active when its level gets ON_MARGIN dB above its floor, and the recording stays active until all the channels have
+been less than OFF_MARGIN dB above their floor (a lower threshold, so that the gate does not flicker) for POST_ROLL
+seconds. The last PRE_ROLL seconds before an event are kept in memory and stored with it, so the onset of every event
+is complete.
+"""
+import math
+from collections import deque
+
+import numpy as np
+
+from Processes.audio_codecs import SAMPLE_TYPES
+
+ON_MARGIN = 10  # dB above the noise floor of a channel which open the gate
+OFF_MARGIN = 4  # dB above the noise floor below which all the channels must stay to close the gate
+MIN_LEVEL = -70  # Level (dBFS) below which a channel is always silent
+FLOOR_RISE = 1  # dB per second the noise floor can rise
+PRE_ROLL = 0.5  # Seconds stored before the beginning of an event
+POST_ROLL = 1.0  # Seconds stored after the end of an event
+
+
+def level_to_power(level):
+    # Mean square of the samples (1 is the full scale) of a signal at LEVEL dBFS
+    return 10 ** (level / 10)
+
+
+def power_to_level(power):
+    return 10 * math.log10(power)
+
+
+class ActivityGate:
+    """incremental activity detector on the chunks of the recording
+
+    process() takes one chunk at a time and returns the chunks to store. The silent chunks are kept in a pre-roll
+    buffer of PRE_ROLL seconds; the chunks which leave it are skipped, and their frames and energy are summed until
+    they are taken with skipped().
+
+    """
+    def __init__(self, channels, format_size, rate, chunk, on_margin=ON_MARGIN, off_margin=OFF_MARGIN,
+                 pre_roll=PRE_ROLL, post_roll=POST_ROLL, min_level=MIN_LEVEL):
+        self.channels = channels
+        self.frame_size = channels * format_size
+        self.dtype = SAMPLE_TYPES[format_size]
+        self.active = False
+        self.events = 0  # Number of events (the gate was opened)
+        self._full_scale = float(-np.iinfo(self.dtype).min)
+        self._on_ratio = level_to_power(on_margin)
+        self._off_ratio = level_to_power(off_margin)
+        self._min_power = level_to_power(min_level)
+        self._floor_rise = level_to_power(FLOOR_RISE * chunk / rate)  # Rise of the floor per chunk
+        self.floor = None  # Noise floor (mean square) of every channel
+        self._pre_roll = max(0, math.ceil(pre_roll * rate / chunk))  # Chunks kept before an event
+        self._post_roll = max(1, math.ceil(post_roll * rate / chunk))  # Silent chunks stored after an event
+        self._silent_chunks = 0  # Silent chunks since the last active one
+        self._buffer = deque()  # Pre-roll: (data, timestamp, power) of the last silent chunks
+        self._skipped_frames = 0
+        self._skipped_energy = np.zeros(channels)
+
+    def power(self, data):
+        # Mean square of every channel of a chunk (1 is the full scale)
+        x = np.frombuffer(data, dtype=self.dtype).reshape(-1, self.channels).astype(np.float32)
+        return np.einsum('ij,ij->j', x, x) / (len(x) * self._full_scale ** 2)
+
+    def process(self, data, timestamp=None):
+        # Return the chunks (data, timestamp) to store after the chunk DATA. The chunks are copied only while they
+        # wait in the pre-roll buffer
+        power = self.power(data)
+        if self.floor is None:
+            self.floor = np.maximum(power, self._min_power)
+        self.floor = np.maximum(np.minimum(power, self.floor * self._floor_rise), self._min_power)
+        if self.active:
+            if (power >= self.floor * self._off_ratio).any():
+                self._silent_chunks = 0
+            else:
+                self._silent_chunks += 1
+                if self._silent_chunks > self._post_roll:
+                    # End of the event: the chunk is the first one of the silence
+                    self.active = False
+                    return self._buffer_chunk(data, timestamp, power)
+            return [(data, timestamp)]
+
+        if (power >= self.floor * self._on_ratio).any():
+            # Beginning of an event: the pre-roll is stored before the chunk
+            self.active = True
+            self.events += 1
+            self._silent_chunks = 0
+            chunks = [(buffered, buffered_timestamp) for buffered, buffered_timestamp, _ in self._buffer]
+            self._buffer.clear()
+            return chunks + [(data, timestamp)]
+        return self._buffer_chunk(data, timestamp, power)
+
+    def _buffer_chunk(self, data, timestamp, power):
+        self._buffer.append((bytes(data), timestamp, power))
+        if len(self._buffer) > self._pre_roll:
+            self._skip(self._buffer.popleft())
+        return []
+
+    def _skip(self, buffered):
+        data, _, power = buffered
+        frames = len(data) // self.frame_size
+        self._skipped_frames += frames
+        self._skipped_energy += power * frames
+
+    def discard(self):
+        # Skip the chunks of the pre-roll buffer (e.g. at the end of a segment, or before frames lost by the ring)
+        for buffered in self._buffer:
+            self._skip(buffered)
+        self._buffer.clear()
+
+    def skipped(self):
+        # Return the frames skipped since the last call and the level (dBFS, None for digital silence) of every
+        # channel in the meanwhile
+        frames = self._skipped_frames
+        levels = [round(power_to_level(energy / frames), 1) if frames and energy > 0 else None
+                  for energy in self._skipped_energy]
+        self._skipped_frames = 0
+        self._skipped_energy[:] = 0
+        return frames, levels
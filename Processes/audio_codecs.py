@@ -0,0 +1,186 @@
+"""This part of the code defines the lossless codecs used to compress the recorded audio data.
+
+The delta codecs store the difference between consecutive samples of each channel (which is small for audio
+signals), split in byte planes, and compress it with zlib or lzma. The FLAC codec needs the optional soundfile
+library and stores 16-bit samples only (libsndfile has no 32-bit FLAC). Every compressed segment starts with a small
+header, so it can be decoded without the original .wav file.
+"""
+import io
+import logging
+import lzma
+import os
+import struct
+import sys
+import wave
+import zipfile
+import zlib
+
+import numpy as np
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+# Codec name -> (codec id, file extension)
+CODECS = {
+    'raw': (0, '.raw'),
+    'delta-zlib': (1, '.dlz'),
+    'delta-lzma': (2, '.dxz'),
+    'flac': (3, '.flac'),
+}
+DEFLATE = 'deflate'  # .wav file compressed by the zip archive (compatible with the old recordings)
+# Codec name -> sample widths (bytes) it can store, if not all of them
+CODEC_SAMPLE_WIDTHS = {'flac': (2,)}
+FALLBACK_CODEC = 'delta-lzma'  # Codec used instead of a codec which can not store the samples
+
+# Sample width (bytes) -> type of the samples
+SAMPLE_TYPES = {2: np.dtype('<i2'), 4: np.dtype('<i4')}
+
+SEGMENT_MAGIC = b'MCHA'
+SEGMENT_HEADER = struct.Struct('<4sBBHII')  # Magic, codec id, sample width, channels, rate, frames
+
+ZLIB_LEVEL = 6
+LZMA_PRESET = 6
+
+# Initialize custom logger for multiprocessing logging
+process_logger = logging.getLogger('audio_codecs')
+
+
+def supported_codec(codec, sample_width):
+    # CODEC if it can store samples of SAMPLE_WIDTH bytes, otherwise FALLBACK_CODEC (with a warning)
+    if sample_width in CODEC_SAMPLE_WIDTHS.get(codec, (sample_width,)):
+        return codec
+    process_logger.warning('The {} codec can not store {}-bit samples: {} is used instead.'
+                           .format(codec, sample_width * 8, FALLBACK_CODEC))
+    return FALLBACK_CODEC
+
+
+def codec_extension(codec):
+    if codec == DEFLATE:
+        return '.wav'
+    return CODECS[codec][1]
+
+
+def _delta_planes(samples):
+    # Difference between consecutive samples of each channel (it wraps around like the integer type), stored
+    # channel after channel and split in byte planes: the high bytes are almost constant and compress very well
+    residual = np.diff(samples, axis=0, prepend=np.zeros((1, samples.shape[1]), samples.dtype))
+    planes = residual.T.copy().view(np.uint8).reshape(samples.shape[1], -1, samples.dtype.itemsize)
+    return np.ascontiguousarray(planes.transpose(2, 0, 1)).tobytes()
+
+
+def _undelta_planes(data, channels, dtype):
+    planes = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, channels, -1)
+    residual = np.ascontiguousarray(planes.transpose(1, 2, 0)).view(dtype).reshape(channels, -1)
+    return np.cumsum(residual, axis=1, dtype=dtype).T
+
+
+def encode_samples(samples, rate, codec):
+    # Compress an array of samples with shape (frames, channels)
+    samples = np.ascontiguousarray(samples)
+    if codec == 'raw':
+        return samples.tobytes()
+    if codec == 'delta-zlib':
+        return zlib.compress(_delta_planes(samples), ZLIB_LEVEL)
+    if codec == 'delta-lzma':
+        return lzma.compress(_delta_planes(samples), preset=LZMA_PRESET)
+    if codec == 'flac':
+        if samples.dtype.itemsize not in CODEC_SAMPLE_WIDTHS['flac']:
+            raise ValueError('The flac codec can not store {}-bit samples.'.format(samples.dtype.itemsize * 8))
+        if soundfile is None:
+            raise ImportError('The flac codec needs the soundfile library.')
+        encoded = io.BytesIO()
+        soundfile.write(encoded, samples, rate, format='FLAC', subtype='PCM_{}'.format(samples.dtype.itemsize * 8))
+        return encoded.getvalue()
+    raise ValueError('Unknown codec {}.'.format(codec))
+
+
+def decode_samples(data, codec, channels, dtype):
+    # Inverse of encode_samples(): return an array of samples with shape (frames, channels)
+    if codec == 'raw':
+        return np.frombuffer(data, dtype=dtype).reshape(-1, channels)
+    if codec == 'delta-zlib':
+        return _undelta_planes(zlib.decompress(data), channels, dtype)
+    if codec == 'delta-lzma':
+        return _undelta_planes(lzma.decompress(data), channels, dtype)
+    if codec == 'flac':
+        if soundfile is None:
+            raise ImportError('The flac codec needs the soundfile library.')
+        samples, _ = soundfile.read(io.BytesIO(data), dtype='int{}'.format(dtype.itemsize * 8), always_2d=True)
+        return samples
+    raise ValueError('Unknown codec {}.'.format(codec))
+
+
+def encode_segment(samples, rate, codec):
+    header = SEGMENT_HEADER.pack(SEGMENT_MAGIC, CODECS[codec][0], samples.dtype.itemsize, samples.shape[1], rate,
+                                 samples.shape[0])
+    return header + encode_samples(samples, rate, codec)
+
+
+def decode_segment(data):
+    # Return the samples (frames, channels) and the sampling rate of a compressed segment
+    magic, codec_id, sample_width, channels, rate, frames = SEGMENT_HEADER.unpack_from(data)
+    if magic != SEGMENT_MAGIC:
+        raise ValueError('Not a compressed audio segment.')
+    codec = next(name for name, (number, _) in CODECS.items() if number == codec_id)
+    samples = decode_samples(data[SEGMENT_HEADER.size:], codec, channels, SAMPLE_TYPES[sample_width])
+    if samples.shape[0] != frames:
+        raise ValueError('Compressed segment is truncated: {} frames instead of {}.'.format(samples.shape[0], frames))
+    return samples, rate
+
+
+def read_wav(filename):
+    # Return the samples (frames, channels) and the sampling rate of a .wav file
+    with wave.open(filename, 'rb') as w:
+        frames = w.readframes(w.getnframes())
+        samples = np.frombuffer(frames, dtype=SAMPLE_TYPES[w.getsampwidth()]).reshape(-1, w.getnchannels())
+        return samples, w.getframerate()
+
+
+def write_wav(filename, samples, rate):
+    with wave.open(filename, 'wb') as w:
+        w.setnchannels(samples.shape[1])
+        w.setsampwidth(samples.dtype.itemsize)
+        w.setframerate(rate)
+        w.writeframes(np.ascontiguousarray(samples).tobytes())
+
+
+def compress_wav(filename, codec):
+    # Compress a .wav file (it runs in the workers of the compression process)
+    samples, rate = read_wav(filename)
+    return encode_segment(samples, rate, codec)
+
+
+def extract_archive(archive, destination, key=None):
+    # Decompress all the segments of a data.zip archive into .wav files. The metadata of the segments are extracted
+    # as they are. Scrambled segments are descrambled with the KEY of the recordings
+    from Processes.scrambling import Scrambler
+    from Processes.recording_container import segment_number
+
+    scrambler = Scrambler.load(key, os.path.dirname(os.path.abspath(archive)))
+    os.makedirs(destination, exist_ok=True)
+    with zipfile.ZipFile(archive) as zf:
+        for member in zf.namelist():
+            name, extension = os.path.splitext(member)
+            if extension == '.json' or (extension == '.wav' and scrambler is None):
+                zf.extract(member, destination)
+                continue
+            if extension == '.wav':
+                with wave.open(io.BytesIO(zf.read(member))) as w:
+                    samples = np.frombuffer(w.readframes(w.getnframes()), dtype=SAMPLE_TYPES[w.getsampwidth()])
+                    samples, rate = samples.reshape(-1, w.getnchannels()), w.getframerate()
+            elif extension in (codec_extension(codec) for codec in CODECS):
+                samples, rate = decode_segment(zf.read(member))
+            else:
+                continue
+            if scrambler is not None:
+                samples = scrambler.descramble_segment(samples, segment_number(name))
+            write_wav(os.path.join(destination, name + '.wav'), samples, rate)
+
+
+if __name__ == '__main__':
+    # Usage: python -m Processes.audio_codecs <data.zip> <destination folder> [key file of scrambled recordings]
+    from Processes.scrambling import read_key
+
+    extract_archive(sys.argv[1], sys.argv[2], read_key(sys.argv[3]) if len(sys.argv) > 3 else None)
@@ -0,0 +1,325 @@
+"""This part of the code defines the merge of several MCH Streamer boards recorded together. Every board is recorded by
+its own record process in its own ring buffer; the merge process reads the chunks of all the boards and puts frames
+with the channels of all the boards (board 0 first) in the ring buffer of the save process, so that the save, DSP and
+live tap processes work as with a single board.
+
+The boards are not driven by the same clock, so their sampling rates differ slightly (tens of ppm) and their streams
+start at different times. The clock of every board is measured from the ADC times of its buffers: the time of a frame
+is fitted (least squares) on the last CLOCK_WINDOW seconds of buffers. Board 0 is the reference: for every merged
+chunk, the frame of each board recorded at the same time as the next frame of board 0 is computed from the clocks, and
+when the position of the board in the merged stream is more than MAX_OFFSET frames away from it, frames of the board
+are dropped or repeated, so that the merged segments stay aligned within one frame. The ADC times of all the boards
+must come from the same clock (the monotonic clock of the system with ALSA).
+"""
+import ctypes
+import logging
+import multiprocessing
+import time
+
+import numpy as np
+
+from Processes.audio_codecs import SAMPLE_TYPES
+from Processes.ring_buffer import wait_any
+from Processes.shutdown import follow_shutdown, stopping
+from CustomExceptions.custom_handlers import *
+
+# Initialize custom logger for multiprocessing logging
+process_logger = logging.getLogger('board_merger')
+
+# Register handler for the SIGTERM signal
+signal.signal(signal.SIGTERM, sigterm_handler)
+
+RING_TIMEOUT = 0.1  # Seconds the merge process waits for chunks before checking the error flags and the shutdown
+CLOCK_WINDOW = 30  # Seconds of buffers used to measure the clock of a board
+CLOCK_MIN_BUFFERS = 32  # Buffers of every board measured before the merge starts
+MAX_OFFSET = 0.75  # Frames a board can be away from its position before it is corrected
+MAX_REPEAT = 2  # Frames inserted by repeating the last frame of a board: longer insertions are filled with zeros
+BOARD_TIMEOUT = 0.5  # Seconds a board can be late before its frames are replaced by zeros
+
+
+class BoardClock:
+    """clock of the ADC of a board, measured from the ADC times of its buffers
+
+    time(frame) = time_0 + (frame - frame_0) * period, where (frame_0, time_0) is the centre of the measured buffers
+    and PERIOD the slope of the least squares fit. After a discontinuity of the stream (lost frames, reconnection) the
+    measures start again: the period already measured is kept until enough buffers are measured.
+
+    """
+    def __init__(self, rate, window_buffers):
+        self.period = None
+        self._nominal_period = 1 / rate
+        self._frames = np.zeros(window_buffers)
+        self._times = np.zeros(window_buffers)
+        self._count = 0  # Buffers measured since the last reset
+        self._fit = None  # (frame_0, time_0) of the last fit, None if it must be computed again
+
+    @property
+    def measured(self):
+        # Number of buffers used by the fit
+        return min(self._count, len(self._frames))
+
+    def add(self, frame, adc_time):
+        index = self._count % len(self._frames)
+        self._frames[index] = frame
+        self._times[index] = adc_time
+        self._count += 1
+        self._fit = None
+
+    def reset(self):
+        self._count = 0
+        self._fit = None
+
+    def _update(self):
+        if self._fit is not None:
+            return
+        n = self.measured
+        frames = self._frames[:n]
+        times = self._times[:n] - self._times[0]  # Relative times, for the precision of the fit
+        frame_0 = frames.mean()
+        time_0 = times.mean()
+        if n >= CLOCK_MIN_BUFFERS or self.period is None and n >= 2:
+            deviations = frames - frame_0
+            self.period = float(np.dot(deviations, times - time_0) / np.dot(deviations, deviations))
+        self._fit = (frame_0, time_0 + self._times[0])
+
+    def time(self, frame):
+        self._update()
+        frame_0, time_0 = self._fit
+        return time_0 + (frame - frame_0) * (self.period or self._nominal_period)
+
+    def frame(self, t):
+        self._update()
+        frame_0, time_0 = self._fit
+        return frame_0 + (t - time_0) / (self.period or self._nominal_period)
+
+
+class BoardStats:
+    """state of the boards in shared memory, written by the merge process and read by the metrics exporter
+
+    DRIFT is the rate of the clock of every board relative to board 0 (ppm), OFFSET the last distance (frames) of the
+    board from its position before the correction. DROPPED and INSERTED count the frames dropped and inserted to align
+    the board, MISSING the frames replaced by zeros while the board was late.
+
+    """
+    def __init__(self, boards):
+        self.boards = boards
+        self.chunks = multiprocessing.RawArray(ctypes.c_uint64, boards)
+        self.drift = multiprocessing.RawArray(ctypes.c_double, boards)
+        self.offset = multiprocessing.RawArray(ctypes.c_double, boards)
+        self.dropped = multiprocessing.RawArray(ctypes.c_uint64, boards)
+        self.inserted = multiprocessing.RawArray(ctypes.c_uint64, boards)
+        self.missing = multiprocessing.RawArray(ctypes.c_uint64, boards)
+
+    def snapshot(self):
+        return {'board_chunks': list(self.chunks), 'board_drift_ppm': list(self.drift),
+                'board_offset_frames': list(self.offset), 'board_frames_dropped': list(self.dropped),
+                'board_frames_inserted': list(self.inserted), 'board_frames_missing': list(self.missing)}
+
+
+class _BoardStream:
+    """frames of a board waiting to be merged
+
+    RECEIVED is the number of frames read from the ring of the board, POSITION the number of the next frame to merge.
+    The buffer holds the frames from POSITION to RECEIVED; if POSITION is ahead (the board was late and its frames were
+    replaced by zeros), the next frames received are dropped until POSITION.
+
+    """
+    def __init__(self, ring, channels, dtype, rate, chunk):
+        self.ring = ring
+        self.channels = channels
+        self.dtype = dtype
+        self.rate = rate
+        self.clock = BoardClock(rate, max(CLOCK_MIN_BUFFERS, int(CLOCK_WINDOW * rate / chunk)))
+        self.received = 0
+        self.position = 0
+        self.last_frame = np.zeros(channels, dtype)
+        self._buffer = np.zeros((8 * chunk, channels), dtype)
+        self._start = 0  # Index in the buffer of frame POSITION
+        self._end = 0  # Index in the buffer after the last frame received
+
+    def available(self):
+        return self.received - self.position
+
+    def poll(self):
+        # Read the chunks published by the record process of the board. Return the number of chunks read
+        chunks = self.ring.get_range(timeout=0)
+        for chunk in chunks:
+            samples = np.frombuffer(chunk.data, dtype=self.dtype).reshape(-1, self.channels)
+            if chunk.lost_frames:
+                # The stream is not continuous any more: the clock is measured again and places the next frames
+                self.clock.reset()
+            # Without the ADC time, the time when the chunk was put in the ring is used
+            adc_time = chunk.adc_time or chunk.timestamp - len(samples) / self.rate
+            self.clock.add(self.received, adc_time)
+            self._append(samples)
+        self.ring.release(len(chunks))
+        return len(chunks)
+
+    def _append(self, samples):
+        if self.received < self.position:
+            # Frames already replaced by zeros
+            skipped = min(len(samples), self.position - self.received)
+            samples = samples[skipped:]
+            self.received += skipped
+        n = len(samples)
+        if self._end + n > len(self._buffer):
+            kept = self._buffer[self._start:self._end]
+            if len(kept) + n > len(self._buffer):
+                self._buffer = np.zeros((2 * (len(kept) + n), self.channels), self.dtype)
+            self._buffer[:len(kept)] = kept.copy()
+            self._start, self._end = 0, len(kept)
+        self._buffer[self._end:self._end + n] = samples
+        self._end += n
+        self.received += n
+
+    def skip(self, n):
+        # Drop the next N frames
+        buffered = min(n, self._end - self._start)
+        self._start += buffered
+        self.position += n
+
+    def read(self, out):
+        # Copy the next len(OUT) frames in OUT (zeros for the frames not received yet). Return the missing frames
+        n = min(len(out), max(0, self.available()))
+        out[:n] = self._buffer[self._start:self._start + n]
+        out[n:] = 0
+        if n:
+            self.last_frame = self._buffer[self._start + n - 1].copy()
+        self.skip(len(out))
+        return len(out) - n
+
+
+class BoardMerger:
+    """merge of the streams of several boards in chunks of CHUNK frames
+
+    The merge starts when CLOCK_MIN_BUFFERS buffers of every board are measured, at the first frame recorded by all
+    the boards. merge() returns the merged chunks that are complete, with the ADC time of their first frame; a chunk is
+    completed with zeros for the boards which are more than BOARD_TIMEOUT seconds late.
+
+    """
+    def __init__(self, rings, channels, format_size, rate, chunk, stats=None):
+        self.channels = channels
+        self.chunk = chunk
+        self.rate = rate
+        self.stats = stats
+        dtype = SAMPLE_TYPES[format_size]
+        self.streams = [_BoardStream(ring, board_channels, dtype, rate, chunk)
+                        for ring, board_channels in zip(rings, channels)]
+        self._columns = np.cumsum([0] + list(channels))
+        self.started = False
+        self.late = False  # True while the frames of some board are replaced by zeros
+        self._late_since = None  # Time since which some board is late
+
+    def poll(self):
+        return sum(stream.poll() for stream in self.streams)
+
+    def _start(self):
+        # The merge starts at the first frame recorded by all the boards: the frames recorded before are dropped
+        start_time = max(stream.clock.time(stream.received - stream.available()) for stream in self.streams)
+        for stream in self.streams:
+            stream.skip(max(0, int(np.ceil(stream.clock.frame(start_time) - stream.position))))
+        self.started = True
+
+    def _corrections(self):
+        # Frames to drop (> 0) or to insert (< 0) in every board, so that its next frame is recorded at the time of the
+        # next frame of board 0
+        reference = self.streams[0]
+        reference_time = reference.clock.time(reference.position)
+        corrections = [0]
+        for board, stream in enumerate(self.streams[1:], 1):
+            offset = stream.clock.frame(reference_time) - stream.position
+            if self.stats is not None:
+                self.stats.offset[board] = offset
+                if reference.clock.period and stream.clock.period:
+                    self.stats.drift[board] = (reference.clock.period / stream.clock.period - 1) * 10 ** 6
+            corrections.append(int(round(offset)) if abs(offset) > MAX_OFFSET else 0)
+        return corrections
+
+    def merge(self, now=None):
+        # Return the merged chunks (data, adc_time) which can be completed
+        if not self.started:
+            if any(stream.clock.measured < CLOCK_MIN_BUFFERS for stream in self.streams):
+                return []
+            self._start()
+        merged = []
+        while True:
+            corrections = self._corrections()
+            late = [stream.available() - max(0, correction) < self.chunk + min(0, correction)
+                    for stream, correction in zip(self.streams, corrections)]
+            if any(late):
+                if all(late):
+                    return merged
+                now = time.monotonic() if now is None else now
+                if self._late_since is None:
+                    self._late_since = now
+                if now - self._late_since < BOARD_TIMEOUT:
+                    return merged
+                self.late = True
+            else:
+                self._late_since = None
+                self.late = False
+            merged.append(self._merge_chunk(corrections))
+
+    def _merge_chunk(self, corrections):
+        adc_time = self.streams[0].clock.time(self.streams[0].position)
+        out = np.empty((self.chunk, self._columns[-1]), self.streams[0].dtype)
+        for board, (stream, correction) in enumerate(zip(self.streams, corrections)):
+            columns = out[:, self._columns[board]:self._columns[board + 1]]
+            inserted = 0
+            if correction > 0:
+                stream.skip(correction)
+            elif correction < 0:
+                # The last frame is repeated for small corrections, the longer gaps are filled with zeros
+                inserted = min(-correction, self.chunk)
+                columns[:inserted] = stream.last_frame if inserted <= MAX_REPEAT else 0
+            missing = stream.read(columns[inserted:])
+            if self.stats is not None:
+                self.stats.chunks[board] += 1
+                self.stats.dropped[board] += max(0, correction)
+                self.stats.inserted[board] += inserted
+                self.stats.missing[board] += missing
+        return out.tobytes(), adc_time
+
+
+def merge_boards(connection_error, disconnection_error, rings, ring, channels, format_size, rate, chunk, stats=None,
+                 shutdown=None):
+
+    # SIGINT is left to the main process and SIGTERM starts the shutdown
+    follow_shutdown(shutdown)
+
+    # The chunks of the rings of the boards are merged and put in the ring buffer of the save process
+    merger = BoardMerger(rings, channels, format_size, rate, chunk, stats)
+    process_logger.info('Merging {} boards ({} channels).'.format(len(rings), sum(channels)))
+    late = False
+
+    def merge_received():
+        # The frames already received from all the boards are merged before the process terminates
+        merger.poll()
+        for data, adc_time in merger.merge():
+            ring.put(data, adc_time)
+
+    try:
+        while connection_error.value is False and disconnection_error.value is False and not stopping(shutdown):
+            if not merger.poll():
+                # The process sleeps until a board puts a chunk in its ring buffer (the rings share their wake-up)
+                wait_any(rings, RING_TIMEOUT)
+                continue
+            started = merger.started
+            for data, adc_time in merger.merge():
+                ring.put(data, adc_time)
+            if merger.started and not started:
+                process_logger.info('The clocks of the boards are measured: the merged recording starts.')
+            if merger.late != late:
+                late = merger.late
+                if late:
+                    process_logger.warning('A board is late: its frames are replaced by zeros.')
+                else:
+                    process_logger.info('All the boards deliver their frames again.')
+
+        # During the shutdown, the last frames are merged once the record processes have stopped
+        if stopping(shutdown):
+            shutdown.wait_phase('record')
+        merge_received()
+
+    except (KeyboardInterrupt, SystemExit):
+        merge_received()
@@ -0,0 +1,173 @@
+"""This part of the code defines the tuning of the buffers of the recording: the frames per buffer (CHUNK) and the
+number of chunks the ring buffer can hold. They are measured for every host and source of audio data and stored in a
+profile, so that the measure is done at the first start only.
+
+The frames per buffer are calibrated before the recording: the source is opened with buffers from the largest of
+CANDIDATE_CHUNKS down, for TRIAL_SECONDS each. A buffer size passes if no callback has the input overflow flag and if
+the callbacks are never later than JITTER_MARGIN times the buffer period: the smallest size that passes is used, so the
+latency is as low as the host allows. The ring buffer holds RING_SECONDS of audio at the beginning. After every
+recording the profile is updated: if some buffer overflowed, the next larger buffer size is used from the next start,
+and the ring buffer is sized to RING_MARGIN times the highest occupancy seen so far (twice as large if it overran).
+"""
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import time
+
+from Processes.capture_backends import create_backend, paContinue, paInputOverflow, timing_key
+
+# Initialize custom logger for multiprocessing logging
+process_logger = logging.getLogger('buffer_tuning')
+
+PROFILE_NAME = 'buffer_profile.json'  # Profile of the buffers of every host and source
+CANDIDATE_CHUNKS = (4096, 2048, 1024, 512, 256)  # Frames per buffer tried by the calibration, the largest first
+TRIAL_SECONDS = 3  # Seconds every buffer size is tried for
+WARM_UP_CALLBACKS = 8  # First callbacks of a trial which are not measured
+JITTER_MARGIN = 0.5  # Maximum delay of a callback, as a fraction of the buffer period
+RING_SECONDS = 16  # Seconds of audio the ring buffer holds before the recordings are measured
+MIN_RING_SECONDS = 4  # Minimum seconds of audio the ring buffer holds
+RING_MARGIN = 4  # Ring buffer size, in multiples of the highest occupancy seen
+
+
+def measure_chunk(backend, audio_format, channels, rate, chunk, seconds=TRIAL_SECONDS):
+    # Open the source with buffers of CHUNK frames for SECONDS and return the overflows, the delay of the latest
+    # callback (seconds, from the time grid of the callbacks) and the buffer period. None if the source is not available
+    capture = create_backend(backend)
+    arrivals = []
+    overflows = 0
+
+    def callback(in_data, frame_count, time_info, status):
+        nonlocal overflows
+        arrivals.append(time.monotonic())
+        if status & paInputOverflow:
+            overflows += 1
+        return in_data, paContinue
+
+    try:
+        if not capture.open(audio_format, channels, rate, chunk, callback):
+            return None
+        time.sleep(seconds)
+    finally:
+        capture.close()
+
+    arrivals = arrivals[WARM_UP_CALLBACKS:]
+    if len(arrivals) < 2:
+        return None
+    # The callbacks are compared with a grid at their mean period: the delay of a callback is its distance from the
+    # earliest callback of the grid
+    period = (arrivals[-1] - arrivals[0]) / (len(arrivals) - 1)
+    deviations = [arrival - n * period for n, arrival in enumerate(arrivals)]
+    return {'overflows': overflows, 'jitter': max(deviations) - min(deviations), 'period': period}
+
+
+def calibrate_chunk(backend, audio_format, channels, rate, candidates=CANDIDATE_CHUNKS, seconds=TRIAL_SECONDS):
+    # Return the smallest of the CANDIDATES (frames per buffer) which works without overflows and with a safe margin
+    # for the jitter of the callbacks, and the measures of the trials. The chunk is None if the source is not available
+    chunk = None
+    trials = {}
+    for candidate in sorted(candidates, reverse=True):
+        trial = measure_chunk(backend, audio_format, channels, rate, candidate, seconds)
+        if trial is None:
+            break
+        trials[candidate] = trial
+        if trial['overflows'] or trial['jitter'] > JITTER_MARGIN * trial['period']:
+            break
+        chunk = candidate
+    if chunk is None and trials:
+        # Even the largest buffers are not safe: they are used anyway
+        chunk = max(candidates)
+    return chunk, trials
+
+
+def ring_slots(seconds, rate, chunk):
+    # Chunks of the ring buffer needed to hold SECONDS of audio
+    return math.ceil(seconds * rate / chunk)
+
+
+class BufferProfile:
+    """tuned buffers of every host and source of audio data, in a JSON file
+
+    The entry of a source records the frames per buffer, the ring buffer size, the measures of the calibration and the
+    highest occupancy of the ring buffer (seconds of audio) seen by the recordings. A source is identified by the host,
+    the kind of backend with the options which change its timing, the sample format, the channels and the sampling
+    rate: the other options of the backend (e.g. the duration of a synthetic source) keep the calibration.
+
+    """
+    def __init__(self, filename, backend, audio_format, channels, rate):
+        self.filename = filename
+        self.key = '{}/{}/{}/{}ch/{}Hz'.format(platform.node(), timing_key(backend), audio_format, channels, rate)
+        self.backend = backend
+        self.audio_format = audio_format
+        self.channels = channels
+        self.rate = rate
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, entry):
+        # The file is written aside and renamed, so that a crash never leaves a partial profile
+        profiles = self._load()
+        profiles[self.key] = entry
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump(profiles, f, indent=1)
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def entry(self):
+        return self._load().get(self.key)
+
+    def buffers(self, default_chunk, default_ring_slots):
+        # Frames per buffer and ring buffer size for the recording. The source is calibrated if it is not in the
+        # profile yet; the default values are used if the calibration is not possible
+        entry = self.entry()
+        if entry is None:
+            entry = self.calibrate()
+        if entry is None:
+            return default_chunk, default_ring_slots
+        return entry['chunk'], entry['ring_slots']
+
+    def calibrate(self):
+        # The source is opened in a separate process, so that PortAudio is never initialised in the main process
+        process_logger.info('Calibrating the buffers of {}.'.format(self.backend))
+        with multiprocessing.Pool(1) as pool:
+            chunk, trials = pool.apply(calibrate_chunk, (self.backend, self.audio_format, self.channels, self.rate))
+        if chunk is None:
+            process_logger.warning('The buffers could not be calibrated: the default values are used.')
+            return None
+        for candidate, trial in trials.items():
+            process_logger.info('{} frames per buffer: {} overflows, callbacks jitter {:.2f} ms.'
+                                .format(candidate, trial['overflows'], 1000 * trial['jitter']))
+        entry = {'chunk': chunk, 'ring_slots': ring_slots(RING_SECONDS, self.rate, chunk),
+                 'trials': {str(candidate): trial for candidate, trial in trials.items()},
+                 'ring_high_water_seconds': 0, 'calibrated': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        self._save(entry)
+        process_logger.info('Buffers of {}: {} frames per buffer, {} chunks in the ring buffer.'
+                            .format(self.backend, entry['chunk'], entry['ring_slots']))
+        return entry
+
+    def record_session(self, chunk, overflows, ring_high_water, ring_overruns):
+        # Update the profile with the result of a recording made with buffers of CHUNK frames
+        entry = self.entry()
+        if entry is None or entry['chunk'] != chunk:
+            return
+        if overflows:
+            # The buffers are too small for this host: the next larger size is used from the next start
+            larger = [candidate for candidate in CANDIDATE_CHUNKS if candidate > chunk]
+            if larger:
+                entry['chunk'] = min(larger)
+                process_logger.warning('{} buffers overflowed: {} frames per buffer from the next start.'
+                                       .format(overflows, entry['chunk']))
+        high_water = max(entry['ring_high_water_seconds'], ring_high_water * chunk / self.rate)
+        entry['ring_high_water_seconds'] = high_water
+        if ring_overruns:
+            slots = 2 * entry['ring_slots'] * chunk // entry['chunk']
+        else:
+            slots = ring_slots(max(MIN_RING_SECONDS, RING_MARGIN * high_water), self.rate, entry['chunk'])
+        entry['ring_slots'] = slots
+        self._save(entry)
@@ -0,0 +1,400 @@
+"""This part of the code defines the sources of audio data used by the record process.
+
+Every backend delivers the recorded buffers through the PyAudio stream callback contract:
+callback(in_data, frame_count, time_info, status) -> (out_data, flag)
+so that the record process works in the same way with the MCH Streamer (portaudio), with a synthetic signal
+(synthetic) or with the replay of recordings already stored (replay). The synthetic and replay backends do not need
+any audio hardware and can be used to load-test the pipeline.
+
+A backend is selected with a string, e.g. 'synthetic:signal=noise,speed=4' or 'replay:path=Recordings/x/data.zip'.
+When several boards are recorded together, the backends of the boards are separated by '|'.
+"""
+import io
+import os
+import threading
+import time
+import wave
+import zipfile
+
+import numpy as np
+
+# Values of the PortAudio constants, so that the backends without hardware do not need PyAudio
+paInt32 = 2
+paInt16 = 8
+paContinue = 0
+paComplete = 1
+paInputUnderflow = 1
+paInputOverflow = 2
+SAMPLE_SIZES = {paInt32: 4, paInt16: 2}
+
+
+def get_sample_size(audio_format):
+    return SAMPLE_SIZES[audio_format]
+
+
+class CaptureBackend:
+    """source of audio data
+
+    open() starts the delivery of the buffers to CALLBACK and returns False if the source is not available.
+    is_active() is True until the source stops delivering data (e.g. the device was disconnected).
+    If the source is RECONNECTABLE, reopen() opens it again with the same settings after a stall or a disconnection.
+    TIMING_OPTIONS are the options of the description of the backend which change the timing of its buffers: with the
+    name of the backend, they identify the source in the buffer profile (see timing_key()).
+
+    """
+    name = None
+    reconnectable = False
+    timing_options = ()
+
+    def open(self, audio_format, channels, rate, chunk, callback):
+        raise NotImplementedError
+
+    def is_active(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def reopen(self):
+        self.close()
+        return self.open(*self._settings)
+
+
+class PortAudioBackend(CaptureBackend):
+    """MCH Streamer board, through PortAudio
+
+    BOARD is the number of the board when several MCH Streamers are connected (in the order of the audio peripherals).
+    The IDENTITY of the board (name and host API of the device) is kept at the first opening: a reconnection opens only
+    the same device, even if the order of the audio peripherals changed.
+
+    """
+    name = 'portaudio'
+    reconnectable = True
+
+    def __init__(self, board=0):
+        self.board = int(board)
+        self.identity = None
+        self._p_audio = None
+        self._stream = None
+        self.device_info = None
+
+    def open(self, audio_format, channels, rate, chunk, callback):
+        from Processes.stream_connection import stream_set_up, streamer_identity
+
+        # Look for the audio peripheral to use for the recording. PortAudio is initialized again at every opening,
+        # so that a board reconnected in the meanwhile is found
+        self._settings = (audio_format, channels, rate, chunk, callback)
+        self._p_audio, index_device, self.device_info = stream_set_up(self.board, self.identity)
+        if index_device == -1:
+            return False
+        if self.identity is None:
+            self.identity = streamer_identity(self.device_info)
+
+        self._stream = self._p_audio.open(format=audio_format, channels=channels, rate=rate, input=True,
+                                          input_device_index=index_device, frames_per_buffer=chunk,
+                                          stream_callback=callback)
+        return True
+
+    def is_active(self):
+        return self._stream.is_active()
+
+    def close(self):
+        if self._stream is not None:
+            try:
+                self._stream.stop_stream()
+                self._stream.close()
+            except OSError:
+                # The stream of a disconnected board can not be stopped
+                pass
+            self._stream = None
+        if self._p_audio is not None:
+            self._p_audio.terminate()
+            self._p_audio = None
+
+
+class _ThreadedBackend(CaptureBackend):
+    """backend whose buffers are delivered by a thread at SPEED times the real time (0 means as fast as possible)
+
+    CLOCK is the rate of the clock of the simulated ADC relative to the nominal sampling rate.
+
+    """
+    clock = 1.0
+    timing_options = ('speed',)
+
+    def __init__(self, speed=1.0):
+        self.speed = float(speed)
+        self._thread = None
+        self._stop = threading.Event()
+
+    def open(self, audio_format, channels, rate, chunk, callback):
+        self._settings = (audio_format, channels, rate, chunk, callback)
+        self._prepare(audio_format, channels, rate, chunk)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._deliver, args=(rate, chunk, callback), daemon=True)
+        self._thread.start()
+        return True
+
+    def _prepare(self, audio_format, channels, rate, chunk):
+        raise NotImplementedError
+
+    def _buffers(self):
+        # Yield (in_data, status) for every buffer to deliver, in_data is None if the buffer is lost. The iteration
+        # ends when the source is exhausted
+        raise NotImplementedError
+
+    def _delay(self):
+        # Extra delay of the next buffer (e.g. injected jitter)
+        return 0
+
+    def _deliver(self, rate, chunk, callback):
+        period = chunk / (rate * self.clock) / self.speed if self.speed > 0 else 0
+        start = time.monotonic()
+        self._start, self._period = start, period
+        for n_buffer, (in_data, status) in enumerate(self._buffers()):
+            # Buffers are delivered on a fixed time grid, the jitter delays a single buffer only
+            deadline = start + (n_buffer + 1) * period + self._delay()
+            if self._stop.wait(max(0.0, deadline - time.monotonic())):
+                return
+            if in_data is None:
+                continue
+            adc_time = start + n_buffer * period
+            time_info = {'input_buffer_adc_time': adc_time, 'current_time': time.monotonic(),
+                         'output_buffer_dac_time': 0}
+            _, flag = callback(in_data, chunk, time_info, status)
+            if flag != paContinue:
+                return
+
+    def is_active(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class SyntheticBackend(_ThreadedBackend):
+    """generator of synthetic multichannel signals
+
+    SIGNAL is one of sine (a different frequency on each channel), noise, bursts (noise bursts over a quiet floor, like
+    gut sounds), clicks (a click on all the channels at every second of the monotonic clock, so that the sources of
+    several boards record the same clicks) or silence. DRIFT is the error (ppm) of the clock of the simulated board:
+    its buffers are delivered, and time-stamped, at the sampling rate multiplied by 1 + DRIFT / 10 ** 6. JITTER is the
+    maximum extra delay (seconds) of a buffer, DROPOUT the probability that a buffer is lost: the next buffer is then
+    delivered with the input overflow flag. DURATION (seconds of audio, 0 means endless) makes the source stop like a
+    disconnected board. STALL (seconds of audio, 0 means never) makes the source hang once, like a board whose stream
+    stops delivering data, until it is opened again.
+
+    """
+    name = 'synthetic'
+    timing_options = ('speed', 'jitter', 'dropout')
+
+    def __init__(self, signal='sine', speed=1.0, jitter=0.0, dropout=0.0, duration=0, seed=0, stall=0, drift=0.0):
+        _ThreadedBackend.__init__(self, speed)
+        self.signal = signal
+        self.clock = 1 + float(drift) / 10 ** 6
+        self.jitter = float(jitter)
+        self.dropout = float(dropout)
+        self.duration = float(duration)
+        self.stall = float(stall)
+        self._stalled = False
+        self._random = np.random.default_rng(int(seed))
+        self._table = []
+        self._total_buffers = 0
+        self._stall_buffer = 0
+        self._n_buffer = 0  # Buffers delivered since the first opening
+
+    def _prepare(self, audio_format, channels, rate, chunk):
+        # One second of signal (at least one buffer) is computed in advance and delivered in loop
+        n_buffers = max(1, rate // chunk)
+        t = np.arange(n_buffers * chunk)[:, None] / rate
+        if self.signal == 'sine':
+            samples = np.sin(2 * np.pi * t * (100.0 * np.arange(1, channels + 1)))
+        elif self.signal == 'noise':
+            samples = self._random.standard_normal((len(t), channels)) / 4
+        elif self.signal == 'bursts':
+            envelope = (np.sin(2 * np.pi * t * 0.5) > 0.9) * 0.8 + 0.01
+            samples = self._random.standard_normal((len(t), channels)) / 4 * envelope
+        elif self.signal in ('silence', 'clicks'):
+            # The clicks are added to the buffers when they are delivered, because they depend on the time
+            samples = np.zeros((len(t), channels))
+        else:
+            raise ValueError('Unknown synthetic signal {}.'.format(self.signal))
+
+        if self.signal == 'clicks' and self.speed <= 0:
+            raise ValueError('The clicks signal needs a delivery speed greater than 0.')
+
+        sample_size = get_sample_size(audio_format)
+        full_scale = 2 ** (8 * sample_size - 1) - 1
+        self._click = full_scale // 2
+        self._chunk = chunk
+        self._dtype = '<i{}'.format(sample_size)
+        samples = (np.clip(samples, -1, 1) * full_scale).astype('<i{}'.format(sample_size))
+        self._table = [samples[i * chunk:(i + 1) * chunk].tobytes() for i in range(n_buffers)]
+        self._total_buffers = int(self.duration * rate / chunk) if self.duration > 0 else 0
+        self._stall_buffer = int(self.stall * rate / chunk) if self.stall > 0 and not self._stalled else 0
+
+    @property
+    def reconnectable(self):
+        # The source can be opened again after the stall, until all the buffers are delivered
+        return self.stall > 0 and (self._total_buffers == 0 or self._n_buffer < self._total_buffers)
+
+    def _delay(self):
+        if self.jitter > 0:
+            return self._random.uniform(0, self.jitter)
+        return 0
+
+    def _add_clicks(self, in_data, n_buffer):
+        # Click on the frames where the monotonic clock (at SPEED times the real time) passes a whole second. The
+        # time of every frame follows from the ADC time of buffer N_BUFFER of the current opening
+        frames = n_buffer + np.arange(-1, self._chunk) / self._chunk  # From the last frame of the previous buffer
+        seconds = np.floor((self._start + frames * self._period) * self.speed)
+        clicks = np.flatnonzero(np.diff(seconds))
+        if len(clicks) == 0:
+            return in_data
+        samples = np.frombuffer(in_data, dtype=self._dtype).reshape(self._chunk, -1).copy()
+        samples[clicks] = self._click
+        return samples.tobytes()
+
+    def _buffers(self):
+        status = 0
+        n_delivered = 0  # Buffers delivered since the opening
+        while self._total_buffers == 0 or self._n_buffer < self._total_buffers:
+            if self._stall_buffer and self._n_buffer == self._stall_buffer:
+                # The source hangs until it is closed, then it goes on from the next buffer
+                self._stalled = True
+                self._stop.wait()
+                return
+            in_data = self._table[self._n_buffer % len(self._table)]
+            if self.signal == 'clicks':
+                in_data = self._add_clicks(in_data, n_delivered)
+            self._n_buffer += 1
+            n_delivered += 1
+            if self.dropout > 0 and self._random.random() < self.dropout:
+                status = paInputOverflow
+                yield None, status
+                continue
+            yield in_data, status
+            status = 0
+
+
+class ReplayBackend(_ThreadedBackend):
+    """replay of recordings already stored
+
+    PATH is a .wav file, a data.zip archive, a recording container (data.mchr) or a folder containing them; several
+    paths are separated by ';'. The segments are replayed in order at SPEED times the real time. Channels and sampling
+    rate must be the same as the requested ones.
+
+    """
+    name = 'replay'
+
+    def __init__(self, path, speed=1.0):
+        _ThreadedBackend.__init__(self, speed)
+        self.paths = path.split(';')
+        self._chunk = None
+
+    def _prepare(self, audio_format, channels, rate, chunk):
+        self._channels = channels
+        self._rate = rate
+        self._chunk = chunk
+        self._sample_size = get_sample_size(audio_format)
+
+    def _segments(self):
+        # Yield the samples of every segment of the recordings, in recording order. Scrambled recordings are
+        # descrambled with the key file given by the MCH_SCRAMBLE_KEY environment variable (scramble.key by default)
+        from Processes.audio_codecs import decode_segment, read_wav, SAMPLE_TYPES
+        from Processes.recording_container import ContainerReader, segment_number
+        from Processes.scrambling import KEY_ENVIRONMENT, Scrambler, read_key
+
+        key = read_key(os.environ.get(KEY_ENVIRONMENT, 'scramble.key'))
+        for path in self.paths:
+            files = [path]
+            if os.path.isdir(path):
+                files = sorted((os.path.join(path, name) for name in os.listdir(path)
+                                if name.endswith(('.wav', '.zip', '.mchr'))), key=os.path.getmtime)
+            for filename in files:
+                scrambler = Scrambler.load(key, os.path.dirname(os.path.abspath(filename)))
+                if filename.endswith('.zip'):
+                    with zipfile.ZipFile(filename) as zf:
+                        for member in zf.infolist():
+                            data = zf.read(member)
+                            if member.filename.endswith('.wav'):
+                                with wave.open(io.BytesIO(data)) as w:
+                                    samples = np.frombuffer(w.readframes(w.getnframes()),
+                                                            dtype=SAMPLE_TYPES[w.getsampwidth()])
+                                    samples, rate = samples.reshape(-1, w.getnchannels()), w.getframerate()
+                            elif data[:4] == b'MCHA':
+                                samples, rate = decode_segment(data)
+                            else:
+                                continue
+                            if scrambler is not None:
+                                samples = scrambler.descramble_segment(samples, segment_number(member.filename))
+                            yield samples, rate
+                elif filename.endswith('.mchr'):
+                    with ContainerReader(filename, key) as reader:
+                        for samples in reader.blocks():
+                            yield samples, reader.rate
+                else:
+                    samples, rate = read_wav(filename)
+                    if scrambler is not None:
+                        samples = scrambler.descramble_segment(samples, segment_number(filename))
+                    yield samples, rate
+
+    def _buffers(self):
+        pending = b''
+        for samples, rate in self._segments():
+            if samples.shape[1] != self._channels or rate != self._rate:
+                raise ValueError('Replayed data have {} channels at {} Hz instead of {} channels at {} Hz.'
+                                 .format(samples.shape[1], rate, self._channels, self._rate))
+            if samples.dtype.itemsize != self._sample_size:
+                raise ValueError('Replayed data have a different sample format.')
+
+            # The segments are cut in buffers of CHUNK frames, the last frames are joined to the next segment
+            data = pending + samples.tobytes()
+            buffer_size = self._chunk * self._channels * self._sample_size
+            n_full = len(data) // buffer_size
+            for i in range(n_full):
+                yield data[i * buffer_size:(i + 1) * buffer_size], 0
+            pending = data[n_full * buffer_size:]
+
+
+BACKENDS = {backend.name: backend for backend in (PortAudioBackend, SyntheticBackend, ReplayBackend)}
+
+
+def board_backends(spec, boards):
+    # Backends of the boards recorded together: SPEC lists one backend per board, separated by '|', or it is a single
+    # backend used for all the boards. Every PortAudio backend opens a different MCH Streamer
+    specs = spec.split('|')
+    if len(specs) == 1:
+        specs = specs * boards
+    if len(specs) != boards:
+        raise ValueError('{} capture backends for {} boards.'.format(len(specs), boards))
+    for board, board_spec in enumerate(specs):
+        name, _, options = board_spec.partition(':')
+        if name == PortAudioBackend.name and 'board=' not in options:
+            specs[board] = '{}:{}'.format(name, ','.join(filter(None, [options, 'board={}'.format(board)])))
+    return specs
+
+
+def _parse_spec(spec):
+    # Name and options of the description of a backend: 'name' or 'name:option=value,option=value'
+    name, _, options = spec.partition(':')
+    kwargs = dict(option.split('=', 1) for option in options.split(',') if option)
+    if name not in BACKENDS:
+        raise ValueError('Unknown capture backend {}.'.format(name))
+    return name, kwargs
+
+
+def create_backend(spec):
+    # Create a backend from its description
+    name, kwargs = _parse_spec(spec)
+    return BACKENDS[name](**kwargs)
+
+
+def timing_key(spec):
+    # Description of a backend reduced to its name and to the options which change the timing of its buffers (e.g.
+    # the speed of a synthetic source, but not its signal or its duration)
+    name, kwargs = _parse_spec(spec)
+    options = ['{}={}'.format(option, kwargs[option]) for option in BACKENDS[name].timing_options if option in kwargs]
+    return ':'.join([name, ','.join(options)]) if options else name
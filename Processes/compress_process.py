@@ -1,54 +1,282 @@
-import subprocess
-import os
-import logging
-from CustomExceptions.custom_handlers import *
-
-# Initialize custom logger for multiprocessing logging
-process_logger = logging.getLogger('compression_process')
-
-# Register handler for the SIGTERM signal
-signal.signal(signal.SIGTERM, sigterm_handler)
-
-
-def compress_data(connection_error, disconnection_error, que, path):
-
-    try:
-        # Creation of zip file
-        stored_data = path + '/data.zip'
-
-        # If the MCH Streamer is not connected, then the recording does not start
-        while connection_error.value is False and disconnection_error.value is False:
-            if not que.empty():
-                # If a file is available, then it is compressed and the original copy is deleted
-                data_to_compress = que.get()
-                args = [stored_data, data_to_compress + '.wav']
-                command_line = subprocess.run(['zip', '-j', '-m', '-9', args[0], args[1]], universal_newlines=True,
-                                              capture_output=True)
-                process_logger.info('Data {}'.format(command_line.stdout[2:-1]))
-
-        # If the MCH Streamer is not connected (from the beginning)
-        if connection_error.value is True:
-            raise StreamConnectionError
-
-        # If the Streamer board was disconnected during the recording or the stream connection was interrupted
-        if disconnection_error.value is True:
-            raise DisconnectionError
-
-    except (KeyboardInterrupt, DisconnectionError):
-        # If SIGINT or SIGTERM signal occurred or the connection was interrupted, the process completes the ongoing
-        # tasks and terminates.
-
-        # Compressing the last .wav file
-        command_line = subprocess.run(['zip', '-j', '-r', '-m', '-9', stored_data, path], universal_newlines=True,
-                                      capture_output=True)
-        process_logger.info('Data {}'.format(command_line.stdout[2:-1]))
-
-    except StreamConnectionError:
-        # If MCH Streamer is not connected at the beginning, than the folder for storing data is removed
-        # (it would be empty)
-        if os.path.exists(path):
-            subprocess.run(['rm', '-r', path])
-        process_logger.error('Stream connection error: no data to compress.')
-
-    except SystemExit:
-        pass
+import subprocess
+import os
+import logging
+import multiprocessing
+import queue
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait
+from Processes.audio_codecs import *
+from Processes.recording_container import *
+from Processes.session_journal import *
+from Processes.shutdown import CLOSE_MARGIN, END_OF_SEGMENTS, SHUTDOWN_TIMEOUT, follow_shutdown, stopping
+from CustomExceptions.custom_handlers import *
+
+# Initialize custom logger for multiprocessing logging
+process_logger = logging.getLogger('compression_process')
+
+# Register handler for the SIGTERM signal
+signal.signal(signal.SIGTERM, sigterm_handler)
+
+QUEUE_TIMEOUT = 0.5  # Seconds waited for a new file before checking the error flags again
+DEFLATE_LEVEL = 6  # Compression level of the .wav files stored with the deflate codec
+
+
+def _ignore_signals():
+    # The workers of the pool are stopped by the compression process, which completes the ongoing tasks first
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+class SegmentCompressor:
+    """parallel compressor of the .wav segments
+
+    Segments are compressed by a pool of worker processes, several at the same time, and appended to the zip archive
+    in the order they were recorded. Each member is added at the end of the archive: the data already stored are
+    never rewritten. With the deflate codec the .wav file is compressed by the archive itself (compatible with the
+    archives made by the zip command), otherwise the member holds an already compressed segment and is stored.
+    If the archive is a recording container (.mchr), the segments are compressed in blocks of BLOCK_SECONDS seconds,
+    channel by channel, and appended to the container.
+    If a JOURNAL is given, the segments stored in the archive are recorded before their .wav file is removed, and the
+    segments given up with defer() are recorded as deferred.
+
+    """
+    def __init__(self, archive, codec, workers, metrics=None, block_seconds=BLOCK_SECONDS, journal=None):
+        self.archive = archive
+        self.codec = codec
+        self.metrics = metrics
+        self.journal = journal
+        self.block_seconds = block_seconds
+        self.container = archive.endswith(CONTAINER_SUFFIX)
+        self._writer = None  # Writer of the recording container, created with the first segment
+        self._pending = deque()  # (filename, capture time, future) of the segments not yet appended to the archive
+        self.submitted = set()  # Names of the segments submitted, so that no segment is compressed twice
+        self._given_up = False  # True if some segments were given up while they were being compressed
+        self._pool = None
+        if self.container and codec not in CODECS:
+            raise ValueError('The recording container needs one of the codecs {}.'.format(', '.join(CODECS)))
+        if codec != DEFLATE:
+            self._pool = ProcessPoolExecutor(workers, initializer=_ignore_signals)
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    def submit(self, filename, capture_time=None):
+        # CAPTURE_TIME is the time.monotonic() value when the first chunk of the segment was recorded
+        future = None
+        if self.container:
+            future = self._pool.submit(encode_blocks, filename + '.wav', self.codec, self.block_seconds)
+        elif self._pool is not None:
+            future = self._pool.submit(compress_wav, filename + '.wav', self.codec)
+        self._pending.append((filename, capture_time, future))
+        self.submitted.add(os.path.basename(filename))
+
+    def collect(self, timeout=0):
+        # Append to the archive the segments already compressed, in recording order. TIMEOUT is the time waited for
+        # the oldest segment; None waits until all the segments are compressed
+        while self._pending:
+            filename, capture_time, future = self._pending[0]
+            if future is not None and not wait([future], timeout).done:
+                break
+            self._pending.popleft()
+            self._append(filename, capture_time, future)
+            if timeout is not None:
+                timeout = 0
+
+    def _append(self, filename, capture_time, future):
+        name = os.path.basename(filename)
+        try:
+            original_size = os.path.getsize(filename + '.wav')
+            if self.container:
+                compressed_size = self._append_blocks(future.result(), capture_time)
+            else:
+                compressed_size = self._append_member(filename, name, future)
+        except Exception as error:
+            # The .wav file is kept, so that no data are lost
+            process_logger.error('Compression of {} failed: {!r}'.format(name, error))
+        else:
+            # The original copy is deleted
+            if self.journal is not None:
+                self.journal.record(COMPRESSED, name)
+            os.remove(filename + '.wav')
+            if os.path.exists(filename + '.json'):
+                os.remove(filename + '.json')
+            if self.metrics is not None:
+                self.metrics.add('segments_compressed')
+                self.metrics.add('bytes_compressed', compressed_size)
+                if capture_time is not None:
+                    self.metrics.archive_latency.record(time.monotonic() - capture_time)
+            process_logger.info('Data {} compressed with {} ({} -> {} bytes)'.format(name, self.codec, original_size,
+                                                                                      compressed_size))
+
+    def _append_member(self, filename, name, future):
+        # Add the segment to the zip archive and return its compressed size
+        with zipfile.ZipFile(self.archive, 'a', allowZip64=True) as zf:
+            if future is None:
+                zf.write(filename + '.wav', name + '.wav', zipfile.ZIP_DEFLATED, DEFLATE_LEVEL)
+            else:
+                zf.writestr(name + codec_extension(self.codec), future.result(), zipfile.ZIP_STORED)
+            compressed_size = zf.infolist()[-1].compress_size
+
+            # The metadata of the segment (e.g. the gaps in the recording) are stored next to it
+            if os.path.exists(filename + '.json'):
+                zf.write(filename + '.json', name + '.json', zipfile.ZIP_DEFLATED)
+        return compressed_size
+
+    def _append_blocks(self, segment, capture_time):
+        # Append the blocks of the segment to the recording container and return their size. The start time of the
+        # container is the capture time of its first segment
+        if self._writer is None:
+            start_time = time.time()
+            if capture_time is not None:
+                start_time -= time.monotonic() - capture_time
+            self._writer = ContainerWriter(self.archive, segment.channels, segment.sample_width, segment.rate,
+                                           self.codec, self.block_seconds, start_time)
+        return self._writer.append(segment)
+
+    def defer(self):
+        # Give up the segments not yet appended to the archive and return their names. Their .wav files are kept and
+        # they are compressed at the next start
+        names = []
+        while self._pending:
+            filename, _, future = self._pending.popleft()
+            names.append(os.path.basename(filename))
+            self._given_up = True
+            if self.journal is not None:
+                self.journal.record(DEFERRED, names[-1])
+        return names
+
+    def shutdown(self, cancel=False):
+        # If CANCEL is True, the segments still being compressed are not waited for: their results would not be used,
+        # so the workers are stopped (they ignore SIGTERM). The workers of the pool are the only children of the
+        # compression process. The futures are not cancelled: the pool fails them when its workers are killed (a
+        # cancelled future would make the thread of the pool raise)
+        if self._pool is not None:
+            busy = bool(self._pending) or self._given_up
+            self._pool.shutdown(wait=not (cancel and busy))
+            if cancel and busy:
+                for worker in multiprocessing.active_children():
+                    worker.kill()
+        if self._writer is not None:
+            self._writer.close()
+
+
+def unstored_segments(journal):
+    # Names of the segments closed and not stored in the archive, according to the journal, in recording order
+    states = {}
+    for _, state, segment, _ in journal.read():
+        if segment:
+            states[segment] = state
+    return [segment for segment, state in states.items() if state in (CLOSED, QUEUED, DEFERRED)]
+
+
+def store_left_segments(compressor, que, path, journal=None, shutdown=None, end_received=False):
+    # The recording is ending. The segments sent by the save process are taken from the queue until the end of the
+    # segments, then the segments closed and never stored (e.g. sent to a compression process which failed) are found in
+    # the journal: every segment is compressed once. The segments which are not stored before the deadline (minus
+    # CLOSE_MARGIN, to close the archive) are deferred to the next start
+    deadline = (shutdown.deadline if stopping(shutdown) else time.monotonic() + SHUTDOWN_TIMEOUT) - CLOSE_MARGIN
+    while not end_received and time.monotonic() < deadline:
+        try:
+            item = que.get(timeout=min(QUEUE_TIMEOUT, max(0.0, deadline - time.monotonic())))
+        except queue.Empty:
+            pass
+        else:
+            if item is END_OF_SEGMENTS:
+                end_received = True
+            elif os.path.basename(item[0]) not in compressor.submitted:
+                compressor.submit(*item)
+        compressor.collect()
+
+    if end_received and journal is not None:
+        # The save process has ended: no segment is being written
+        for segment in unstored_segments(journal):
+            if time.monotonic() >= deadline:
+                break
+            if segment not in compressor.submitted and os.path.exists(os.path.join(path, segment) + '.wav'):
+                compressor.submit(os.path.join(path, segment))
+                compressor.collect()
+
+    while compressor.in_flight and time.monotonic() < deadline:
+        compressor.collect(timeout=max(0.0, deadline - time.monotonic()))
+
+    # What is left is recorded in the journal and compressed at the next start
+    deferred = compressor.defer()
+    while True:
+        try:
+            item = que.get_nowait()
+        except queue.Empty:
+            break
+        if item is not END_OF_SEGMENTS:
+            deferred.append(os.path.basename(item[0]))
+            if journal is not None:
+                journal.record(DEFERRED, deferred[-1])
+    if deferred:
+        process_logger.warning('Deadline of the shutdown: {} will be compressed at the next start.'
+                               .format(', '.join(deferred)))
+
+
+def compress_data(connection_error, disconnection_error, que, path, codec=DEFLATE, workers=1, metrics=None,
+                  archive_format='zip', journal=None, shutdown=None):
+
+    # SIGINT is left to the main process and SIGTERM starts the shutdown: a signal never interrupts a write
+    follow_shutdown(shutdown)
+
+    compressor = None
+    end_received = False
+    try:
+        # Creation of zip file (or of the recording container)
+        stored_data = path + '/data.' + archive_format
+        compressor = SegmentCompressor(stored_data, codec, workers, metrics, journal=journal)
+        max_in_flight = 2 * workers  # Segments compressed at the same time
+
+        # If the MCH Streamer is not connected, then the recording does not start
+        while connection_error.value is False and disconnection_error.value is False and not stopping(shutdown):
+            # Backpressure: while enough segments are being compressed, no file is taken from the queue. When the
+            # queue is full, the save process waits before sending the next file
+            if compressor.in_flight >= max_in_flight:
+                compressor.collect(timeout=QUEUE_TIMEOUT)
+                continue
+
+            # Wait for a file to compress. The flags are checked again when the timeout expires
+            try:
+                item = que.get(timeout=QUEUE_TIMEOUT)
+            except queue.Empty:
+                pass
+            else:
+                if item is END_OF_SEGMENTS:
+                    # The save process has ended (e.g. the board was disconnected)
+                    end_received = True
+                    break
+                # If a file is available, then it is compressed and the original copy is deleted
+                compressor.submit(*item)
+            compressor.collect()
+
+        # If the MCH Streamer is not connected (from the beginning)
+        if connection_error.value is True:
+            raise StreamConnectionError
+
+        # The recording is ending: because of a shutdown, or because the Streamer board was disconnected during the
+        # recording or the stream connection was interrupted
+        store_left_segments(compressor, que, path, journal, shutdown, end_received)
+
+    except KeyboardInterrupt:
+        # Without a shutdown control, SIGINT ends the recording: the process completes the ongoing tasks and
+        # terminates
+        store_left_segments(compressor, que, path, journal, shutdown, end_received)
+
+    except StreamConnectionError:
+        # If MCH Streamer is not connected at the beginning, than the folder for storing data is removed
+        # (it would be empty)
+        if os.path.exists(path):
+            subprocess.run(['rm', '-r', path])
+        process_logger.error('Stream connection error: no data to compress.')
+
+    except SystemExit:
+        pass
+
+    finally:
+        if compressor is not None:
+            compressor.shutdown(cancel=True)
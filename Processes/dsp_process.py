@@ -0,0 +1,196 @@
+"""This part of the code defines the DSP stage of the recording. It observes the chunks of the ring buffer without
+slowing down the save process, views every chunk as a (frames, channels) array without copying it and computes the
+level of each channel: RMS, peak, clipped samples and DC offset. Optionally the signal is decimated with a polyphase
+low-pass filter and the low-rate stream is published for monitoring in a live tap segment (MONITOR_TAP_NAME), read by
+other programs like the live stream:
+
+    from Processes.live_tap import LiveSubscriber
+    with LiveSubscriber(MONITOR_TAP_NAME) as tap:
+        for chunk in tap:
+            print(chunk.samples.shape, tap.rate)
+"""
+import ctypes
+import logging
+import math
+import multiprocessing
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from Processes.audio_codecs import SAMPLE_TYPES
+from Processes.live_tap import LivePublisher, TAP_SLOTS
+from Processes.shutdown import follow_shutdown, stopping
+from CustomExceptions.custom_handlers import *
+
+# Initialize custom logger for multiprocessing logging
+process_logger = logging.getLogger('dsp_process')
+
+# Register handler for the SIGTERM signal
+signal.signal(signal.SIGTERM, sigterm_handler)
+
+RING_TIMEOUT = 0.5  # Seconds waited for new chunks before checking the error flags again
+TAPS_PER_PHASE = 16  # Taps of each phase of the decimation filter
+MONITOR_TAP_NAME = 'mch_monitor'  # Name of the shared memory segment of the decimated stream
+
+
+class ChannelLevels:
+    """levels of the channels in shared memory, written by the DSP process and read by the metrics exporter
+
+    RMS, PEAK and DC are the values of the last chunk (1 is the full scale), CLIPPED counts the samples at full scale
+    since the beginning of the recording. SKIPPED counts the chunks the DSP process could not analyse in time.
+
+    """
+    def __init__(self, channels):
+        self.channels = channels
+        self.rms = multiprocessing.RawArray(ctypes.c_double, channels)
+        self.peak = multiprocessing.RawArray(ctypes.c_double, channels)
+        self.dc = multiprocessing.RawArray(ctypes.c_double, channels)
+        self.clipped = multiprocessing.RawArray(ctypes.c_uint64, channels)
+        self._chunks = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self._skipped = multiprocessing.RawValue(ctypes.c_uint64, 0)
+
+    def update(self, rms, peak, dc, clipped):
+        self.rms[:] = rms.tolist()
+        self.peak[:] = peak.tolist()
+        self.dc[:] = dc.tolist()
+        for channel, count in enumerate(clipped.tolist()):
+            if count:
+                self.clipped[channel] += count
+        self._chunks.value += 1
+
+    def skip(self, n_chunks):
+        self._skipped.value += n_chunks
+
+    def snapshot(self):
+        return {'channel_rms': list(self.rms), 'channel_peak': list(self.peak), 'channel_dc': list(self.dc),
+                'channel_clipped_samples': list(self.clipped), 'dsp_chunks': self._chunks.value,
+                'dsp_skipped_chunks': self._skipped.value}
+
+
+def chunk_levels(samples):
+    # RMS, peak and DC offset (1 is the full scale) and number of clipped samples of every channel of SAMPLES, an
+    # integer array (frames, channels)
+    limits = np.iinfo(samples.dtype)
+    full_scale = float(-limits.min)
+    x = samples.astype(np.float32)
+    dc = x.mean(axis=0)
+    rms = np.sqrt(np.einsum('ij,ij->j', x, x) / len(x))
+    peak = np.maximum(samples.max(axis=0).astype(np.int64), -samples.min(axis=0).astype(np.int64))
+    clipped = np.count_nonzero((samples == limits.max) | (samples == limits.min), axis=0)
+    return rms / full_scale, peak / full_scale, dc / full_scale, clipped
+
+
+def lowpass_filter(factor, taps_per_phase=TAPS_PER_PHASE):
+    # Windowed-sinc low-pass filter whose cut-off is the Nyquist frequency of the signal decimated by FACTOR
+    n_taps = factor * taps_per_phase
+    n = np.arange(n_taps) - (n_taps - 1) / 2
+    taps = np.sinc(n / factor) * np.blackman(n_taps)
+    return (taps / taps.sum()).astype(np.float32)
+
+
+class PolyphaseDecimator:
+    """streaming decimation by FACTOR with a polyphase FIR filter
+
+    Only the output samples that are kept are computed: every output sample is the sum over the FACTOR phases of the
+    filter applied to the matching polyphase components of the input. The last input samples are kept from one chunk
+    to the next, so the output does not depend on how the input is cut in chunks.
+
+    """
+    def __init__(self, factor, channels, taps_per_phase=TAPS_PER_PHASE):
+        self.factor = factor
+        self.channels = channels
+        taps = lowpass_filter(factor, taps_per_phase)
+        self._n_taps = len(taps)
+        self._taps_per_phase = taps_per_phase
+        # Time reversed filter in rows of FACTOR taps: each column is one phase of the filter
+        self._phases = np.ascontiguousarray(taps[::-1].reshape(taps_per_phase, factor))
+        self.reset()
+
+    def reset(self):
+        self._history = np.zeros((self._n_taps - 1, self.channels), dtype=np.float32)
+        self._next = self._n_taps - 1  # Position (in the history + new input) of the last input of the next output
+
+    def process(self, samples):
+        # Return the decimated samples (float32, same scale as the input) of the new input SAMPLES (frames, channels)
+        data = np.concatenate((self._history, samples.astype(np.float32)))
+        windows = sliding_window_view(data, self._n_taps, axis=0)[self._next - self._n_taps + 1::self.factor]
+        polyphase = windows.reshape(len(windows), self.channels, self._taps_per_phase, self.factor)
+        output = np.einsum('icqp,qp->ic', polyphase, self._phases)
+
+        self._next += len(windows) * self.factor - len(samples)
+        self._history = data[len(data) - self._n_taps + 1:]
+        return output
+
+
+def dsp_monitor(connection_error, disconnection_error, ring, observer, channels, format_size, rate, levels,
+                decimation=0, monitor_name=MONITOR_TAP_NAME, shutdown=None):
+    # OBSERVER is the number of the DSP process among the observers of the ring buffer (see add_observer()). If
+    # DECIMATION is greater than 1, the decimated stream is published in the live tap segment MONITOR_NAME
+
+    # SIGINT is left to the main process and SIGTERM starts the shutdown
+    follow_shutdown(shutdown)
+
+    dtype = SAMPLE_TYPES[format_size]
+    limits = np.iinfo(dtype)
+    decimator = None
+    monitor = None
+    lost_frames = 0  # Decimated frames not published before the next chunk
+    chunk_frames = ring.slot_size // ring.frame_size
+    if decimation > 1:
+        decimator = PolyphaseDecimator(decimation, channels)
+        monitor = LivePublisher(channels, format_size, int(round(rate / decimation)),
+                                monitor_slot_size(chunk_frames, channels, format_size, decimation), monitor_name,
+                                TAP_SLOTS)
+        process_logger.info('Decimated stream published in the shared memory segment {}.'.format(monitor_name))
+    seq = 0  # Sequence number of the next chunk to analyse
+    try:
+        while connection_error.value is False and disconnection_error.value is False and not stopping(shutdown):
+            # The process sleeps until new chunks are published
+            if not ring.wait_observed(seq, observer, RING_TIMEOUT):
+                continue
+            chunks = ring.observe(seq)
+            if not chunks:
+                continue
+            if chunks[0].seq != seq:
+                # The DSP process fell behind: the chunks already overwritten are not analysed
+                levels.skip(chunks[0].seq - seq)
+                if decimator is not None:
+                    decimator.reset()
+                    lost_frames += (chunks[0].seq - seq) * chunk_frames // decimation
+
+            for chunk in chunks:
+                # View of the chunk as a (frames, channels) array, without copying it
+                samples = np.frombuffer(chunk.data, dtype=dtype).reshape(-1, channels)
+                chunk_result = chunk_levels(samples)
+                decimated = decimator.process(samples) if decimator is not None else None
+
+                # The results are used only if the producer did not overwrite the chunk in the meanwhile
+                if not ring.is_intact(chunk.seq):
+                    levels.skip(chunks[-1].seq + 1 - chunk.seq)
+                    if decimator is not None:
+                        decimator.reset()
+                        lost_frames += (chunks[-1].seq + 1 - chunk.seq) * chunk_frames // decimation
+                    break
+                levels.update(*chunk_result)
+                if decimated is not None and len(decimated):
+                    if monitor.subscribers:
+                        monitor.publish(np.clip(np.rint(decimated), limits.min, limits.max).astype(dtype).tobytes(),
+                                        lost_frames + chunk.lost_frames // decimation, chunk.timestamp)
+                    else:
+                        # Nobody reads the monitor stream: it is not copied
+                        monitor.clean_up()
+                    lost_frames = 0
+            seq = chunks[-1].seq + 1
+
+    except (KeyboardInterrupt, SystemExit):
+        # The DSP stage keeps no data: it just terminates
+        pass
+
+    finally:
+        if monitor is not None:
+            monitor.close()
+
+
+def monitor_slot_size(chunk, channels, format_size, decimation):
+    # Size (bytes) of a slot of the live tap of the decimated stream
+    return (math.ceil(chunk / decimation) + 1) * channels * format_size
@@ -0,0 +1,233 @@
+"""This part of the code defines the integrity checksums of the recordings and their verification.
+
+While a segment is written, the save process computes the CRC32 of its data from the buffers it already holds (see
+wav_writer.py): one for the whole segment and one for every block of CHECKSUM_SECONDS seconds. When the segment is
+closed, they are appended to the manifest of the session (manifest.log in the session folder, one JSON object per
+line). The checksums cover the data as they are stored in the archive, so scrambled segments are verified without the
+key, and they still hold after the container is compressed again with another codec.
+
+The verification decompresses every segment of the archive (data.mchr or data.zip, or the .wav file of a segment not
+yet compressed) and compares it with the manifest. The segments are verified in parallel by a pool of processes, one
+per core by default:
+    python3 -m Processes.integrity <Recordings folder or session folders> [--workers N]
+The blocks whose checksum differs locate the damaged seconds of a segment. The exit status is 1 if a segment is damaged
+or missing.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+import wave
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from Processes.audio_codecs import CODECS, SAMPLE_TYPES, codec_extension, decode_segment, read_wav
+from Processes.recording_container import CONTAINER_SUFFIX, ContainerReader, segment_number
+
+MANIFEST_NAME = 'manifest.log'  # Manifest of the checksums of a session, in the session folder
+CHECKSUM_SECONDS = 1  # Seconds of data of every block checksummed on its own
+SEGMENT_PREFIX = 'audio data minute '  # Name of the segments, followed by their number
+
+
+class SessionManifest:
+    """append-only manifest of the checksums of a recording session
+
+    Each record is one line (JSON object with the segment, its frames and its checksums) written with a single write on
+    a file opened in append mode, like the journal of the session. A line cut by a crash is ignored.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.filename = os.path.join(path, MANIFEST_NAME)
+        self._fd = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fd'] = None
+        return state
+
+    def record(self, segment, checksums):
+        # CHECKSUMS are returned by SegmentWriter.checksums()
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self._pid = os.getpid()
+        os.write(self._fd, (json.dumps(dict(checksums, segment=segment)) + '\n').encode())
+
+    def read(self):
+        # Return the records of the manifest by segment
+        records = {}
+        if not os.path.exists(self.filename):
+            return records
+        with open(self.filename) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[record['segment']] = record
+        return records
+
+    def close(self):
+        if self._fd is not None and self._pid == os.getpid():
+            os.close(self._fd)
+        self._fd = None
+
+
+def find_sessions(paths):
+    # Session folders among PATHS: a path without an archive nor a manifest is a Recordings folder, its sessions are
+    # verified
+    found = []
+    for path in paths:
+        if any(os.path.exists(os.path.join(path, name)) for name in (MANIFEST_NAME, 'data' + CONTAINER_SUFFIX,
+                                                                     'data.zip')):
+            found.append(path)
+        elif os.path.isdir(path):
+            found.extend(sorted(entry.path for entry in os.scandir(path) if entry.is_dir()))
+    return found
+
+
+def stored_segments(session):
+    # Where every segment of a session is stored: name -> (kind, file, member). The archives are read first, then the
+    # .wav files of the segments not yet compressed
+    segments = {}
+    container = os.path.join(session, 'data' + CONTAINER_SUFFIX)
+    if os.path.exists(container):
+        with ContainerReader(container, stored=True) as reader:
+            for segment in dict.fromkeys(reader.index['segment'].tolist()):
+                segments[SEGMENT_PREFIX + str(segment)] = ('mchr', container, segment)
+    archive = os.path.join(session, 'data.zip')
+    if os.path.exists(archive):
+        extensions = {codec_extension(codec) for codec in CODECS} | {'.wav'}
+        with zipfile.ZipFile(archive) as zf:
+            for member in zf.namelist():
+                name, extension = os.path.splitext(member)
+                if extension in extensions:
+                    segments[name] = ('zip', archive, member)
+    for entry in os.scandir(session):
+        name, extension = os.path.splitext(entry.name)
+        if extension == '.wav' and name not in segments:
+            segments[name] = ('wav', entry.path, None)
+    return segments
+
+
+_reader = None  # Container opened by the worker, kept for the next segments of the same session
+
+
+def _stored_samples(kind, filename, member):
+    # Samples (frames, channels) and sampling rate of a segment as they are stored
+    global _reader
+    if kind == 'mchr':
+        if _reader is None or _reader.filename != filename:
+            if _reader is not None:
+                _reader.close()
+            _reader = ContainerReader(filename, stored=True)
+        return _reader.stored_segment(member), _reader.rate
+    if kind == 'wav':
+        return read_wav(filename)
+    with zipfile.ZipFile(filename) as zf:
+        # The zip archive checks the CRC of the member while it is read
+        data = zf.read(member)
+    if member.endswith('.wav'):
+        with wave.open(io.BytesIO(data)) as w:
+            samples = np.frombuffer(w.readframes(w.getnframes()), dtype=SAMPLE_TYPES[w.getsampwidth()])
+            return samples.reshape(-1, w.getnchannels()), w.getframerate()
+    return decode_segment(data)
+
+
+def verify_segment(task):
+    # Compare a stored segment with its record of the manifest (it runs in the workers of the pool). Return the bytes
+    # verified and the problems found
+    name, kind, filename, member, record = task
+    try:
+        samples, rate = _stored_samples(kind, filename, member)
+    except Exception as error:
+        return name, 0, ['unreadable ({}): {!r}'.format(kind, error)]
+
+    data = memoryview(np.ascontiguousarray(samples)).cast('B')
+    problems = []
+    if len(samples) != record['frames']:
+        problems.append('{} frames instead of {}'.format(len(samples), record['frames']))
+    if '{:08x}'.format(zlib.crc32(data)) != record['crc32']:
+        block_size = record['block_frames'] * samples.shape[1] * samples.dtype.itemsize
+        if block_size:
+            damaged = [number for number, crc in enumerate(record['blocks'])
+                       if '{:08x}'.format(zlib.crc32(data[number * block_size:(number + 1) * block_size])) != crc]
+            problems.append('checksum mismatch in the seconds {}'.format(', '.join(
+                '{:g}-{:g}'.format(number * record['block_frames'] / rate,
+                                   min(len(samples), (number + 1) * record['block_frames']) / rate)
+                for number in damaged)))
+        else:
+            problems.append('checksum mismatch')
+    return name, len(data), problems
+
+
+def verify_sessions(paths, workers=None, output=sys.stdout):
+    # Verify the sessions found in PATHS with a pool of WORKERS processes (one per core by default). Return the number
+    # of segments damaged or missing
+    start = time.monotonic()
+    totals = {'segments': 0, 'bytes': 0, 'damaged': 0, 'missing': 0, 'unchecked': 0}
+    with ProcessPoolExecutor(workers or multiprocessing.cpu_count()) as pool:
+        for session in find_sessions(paths):
+            manifest = SessionManifest(session).read()
+            try:
+                segments = stored_segments(session)
+            except (OSError, ValueError, zipfile.BadZipFile) as error:
+                output.write('{}: archive unreadable: {!r}\n'.format(session, error))
+                totals['damaged'] += len(manifest) or 1
+                continue
+
+            tasks = []
+            missing = []
+            for name, record in sorted(manifest.items(), key=lambda item: segment_number(item[0])):
+                if name in segments:
+                    tasks.append((name,) + segments[name] + (record,))
+                elif record['frames']:
+                    # A segment without frames (e.g. all skipped by the activity gate) has no data in the archive
+                    missing.append(name)
+            unchecked = sorted(set(segments) - set(manifest), key=segment_number)
+
+            damaged = 0
+            for name, size, problems in pool.map(verify_segment, tasks, chunksize=max(1, len(tasks) // (4 * (
+                    workers or multiprocessing.cpu_count())))):
+                totals['bytes'] += size
+                if problems:
+                    damaged += 1
+                    output.write('{}: {}: {}\n'.format(session, name, '; '.join(problems)))
+            for name in missing:
+                output.write('{}: {}: missing from the archive\n'.format(session, name))
+            if unchecked:
+                output.write('{}: no checksum for {}\n'.format(session, ', '.join(unchecked)))
+            output.write('{}: {} segments verified, {} damaged, {} missing, {} without checksum\n'.format(
+                session, len(tasks), damaged, len(missing), len(unchecked)))
+            output.flush()
+            totals['segments'] += len(tasks)
+            totals['damaged'] += damaged
+            totals['missing'] += len(missing)
+            totals['unchecked'] += len(unchecked)
+
+    seconds = time.monotonic() - start
+    output.write('{segments} segments ({bytes} bytes) verified in {seconds:.1f} s ({rate:.1f} MB/s): {damaged} '
+                 'damaged, {missing} missing, {unchecked} without checksum\n'.format(
+                     seconds=seconds, rate=totals['bytes'] / 1e6 / max(seconds, 1e-6), **totals))
+    return totals['damaged'] + totals['missing']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Verify the recordings against the checksums of their manifest.')
+    parser.add_argument('paths', nargs='+', help='Recordings folders or session folders')
+    parser.add_argument('--workers', type=int, default=None, help='processes verifying the segments (default: cores)')
+    options = parser.parse_args(argv)
+    return 1 if verify_sessions(options.paths, options.workers) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
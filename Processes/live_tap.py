@@ -0,0 +1,395 @@
+"""This part of the code defines the live tap of the recording: the recorded chunks are published in a named shared
+memory segment, so that other programs of the same computer (e.g. a level meter or a real time detector) can read the
+live stream while it is recorded.
+
+The segment holds a header, a table of the subscribers, the table of the slots and the slots themselves. The publisher
+writes every chunk in the next slot and never waits for the subscribers: each subscriber reads the chunks with its own
+cursor and a subscriber which falls too far behind is dropped (it has to subscribe again): its slot in the table is
+freed, by the subscriber when it sees that it was dropped or by the publisher after DROPPED_GRACE seconds. While no
+program is subscribed, the chunks are not copied. A small client API is given by LiveSubscriber:
+
+    from Processes.live_tap import LiveSubscriber
+    with LiveSubscriber() as tap:
+        for chunk in tap:
+            print(chunk.seq, chunk.samples.shape)  # samples: NumPy array (frames, channels)
+"""
+import logging
+import os
+import tempfile
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from Processes.audio_codecs import SAMPLE_TYPES
+from Processes.shutdown import follow_shutdown, stopping
+from CustomExceptions.custom_handlers import *
+
+try:
+    import fcntl
+except ImportError:
+    # Not a POSIX system: the subscribers are added without the lock file
+    fcntl = None
+
+# Initialize custom logger for multiprocessing logging
+process_logger = logging.getLogger('live_tap')
+
+TAP_NAME = 'mch_live'  # Name of the shared memory segment (/dev/shm/mch_live on Linux)
+TAP_MAGIC = b'MCHL'
+TAP_VERSION = 1
+TAP_SLOTS = 256  # Chunks kept in the segment (about 8 s of audio)
+MAX_SUBSCRIBERS = 16
+DROP_LAG = 0.75  # A subscriber is dropped when it lags behind by this fraction of the slots
+POLL_PERIOD = 0.005  # Seconds between two checks for new chunks by the subscribers
+RING_TIMEOUT = 0.5  # Seconds the publisher waits for new chunks before checking the error flags again
+CLEAN_UP_PERIOD = 1.0  # Seconds between two checks of the subscribers which exited without unsubscribing
+DROPPED_GRACE = 5.0  # Seconds after which the slot of a dropped subscriber is freed by the publisher
+INVALID_SEQ = 2 ** 64 - 1  # Sequence number of a slot being written
+
+# States of the subscribers
+FREE = 0
+ACTIVE = 1
+DROPPED = 2
+
+HEADER_TYPE = np.dtype([('magic', 'S4'), ('version', '<u4'), ('channels', '<u4'), ('sample_width', '<u4'),
+                        ('rate', '<u4'), ('n_slots', '<u4'), ('slot_size', '<u4'), ('max_subscribers', '<u4'),
+                        ('publisher', '<u4'), ('closed', '<u4'), ('head', '<u8'), ('dropped', '<u8')])
+SUBSCRIBER_TYPE = np.dtype([('pid', '<u4'), ('state', '<u4'), ('cursor', '<u8'), ('attached', '<f8')])
+SLOT_TYPE = np.dtype([('seq', '<u8'), ('length', '<u4'), ('lost', '<u4'), ('timestamp', '<f8')])
+
+# A chunk of the live stream. SAMPLES is a copy of the frames (frames, channels), LOST_FRAMES the frames missing just
+# before the chunk and TIMESTAMP the time.monotonic() value when the chunk was recorded
+LiveChunk = namedtuple('LiveChunk', ['seq', 'samples', 'lost_frames', 'timestamp'])
+
+
+def _align(size, alignment=64):
+    return -(-size // alignment) * alignment
+
+
+class _TapLayout:
+    """numpy views on the tables of a live tap segment"""
+    def __init__(self, buffer):
+        self.header = np.ndarray((), HEADER_TYPE, buffer, 0)
+        if bytes(self.header['magic']) != TAP_MAGIC or int(self.header['version']) != TAP_VERSION:
+            raise ValueError('Not a live tap (version {}).'.format(TAP_VERSION))
+        n_slots = int(self.header['n_slots'])
+        max_subscribers = int(self.header['max_subscribers'])
+        offset = _align(HEADER_TYPE.itemsize)
+        self.subscribers = np.ndarray(max_subscribers, SUBSCRIBER_TYPE, buffer, offset)
+        offset = _align(offset + max_subscribers * SUBSCRIBER_TYPE.itemsize)
+        self.slots = np.ndarray(n_slots, SLOT_TYPE, buffer, offset)
+        self.data_offset = _align(offset + n_slots * SLOT_TYPE.itemsize)
+        self.slot_size = int(self.header['slot_size'])
+        self.n_slots = n_slots
+
+    @staticmethod
+    def size(n_slots, slot_size, max_subscribers):
+        offset = _align(_align(HEADER_TYPE.itemsize) + max_subscribers * SUBSCRIBER_TYPE.itemsize)
+        return _align(offset + n_slots * SLOT_TYPE.itemsize) + n_slots * slot_size
+
+
+def _lock_filename(name):
+    # The subscribers are added one at a time, under a lock file
+    return os.path.join(tempfile.gettempdir(), name + '.lock')
+
+
+def _open_segment(name):
+    # Attach to an existing segment without letting the resource tracker remove it when this process exits
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        from multiprocessing import resource_tracker
+        segment = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+class LivePublisher:
+    """writer of the live tap segment
+
+    publish() copies a chunk in the next slot: the sequence number of the slot is invalidated while the data are
+    written, so a subscriber never takes a half written chunk. The lag of the subscribers is checked at every chunk.
+    clean_up() frees the slots of the subscribers which exited without unsubscribing or were dropped DROPPED_GRACE
+    seconds ago; it is called by publish() and, while nobody is subscribed, by the process of the publisher.
+
+    """
+    def __init__(self, channels, sample_width, rate, slot_size, name=TAP_NAME, n_slots=TAP_SLOTS,
+                 max_subscribers=MAX_SUBSCRIBERS):
+        size = _TapLayout.size(n_slots, slot_size, max_subscribers)
+        try:
+            self._segment = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # Left by a publisher which did not exit properly: the subscribers still attached see it closed
+            stale = _open_segment(name)
+            header = np.ndarray((), HEADER_TYPE, stale.buf, 0)
+            header['closed'] = 1
+            del header
+            stale.close()
+            stale.unlink()
+            self._segment = shared_memory.SharedMemory(name, create=True, size=size)
+        self.name = name
+
+        header = np.ndarray((), HEADER_TYPE, self._segment.buf, 0)
+        header['magic'] = TAP_MAGIC
+        header['version'] = TAP_VERSION
+        header['channels'] = channels
+        header['sample_width'] = sample_width
+        header['rate'] = rate
+        header['n_slots'] = n_slots
+        header['slot_size'] = slot_size
+        header['max_subscribers'] = max_subscribers
+        header['publisher'] = os.getpid()
+        del header
+        self._layout = _TapLayout(self._segment.buf)
+        self._layout.slots['seq'] = INVALID_SEQ
+        self._view = self._segment.buf[self._layout.data_offset:]
+        self._drop_lag = int(n_slots * DROP_LAG)
+        self._last_clean_up = time.monotonic()
+        self._dropped_at = {}  # Slot of a dropped subscriber -> time.monotonic() when it was seen dropped
+
+    @property
+    def head(self):
+        return int(self._layout.header['head'])
+
+    @property
+    def subscribers(self):
+        return int(np.count_nonzero(self._layout.subscribers['state'] == ACTIVE))
+
+    @property
+    def dropped(self):
+        return int(self._layout.header['dropped'])
+
+    def publish(self, data, lost_frames=0, timestamp=0.0):
+        layout = self._layout
+        head = int(layout.header['head'])
+        slot = layout.slots[head % layout.n_slots]
+        offset = (head % layout.n_slots) * layout.slot_size
+        size = len(data)
+        slot['seq'] = INVALID_SEQ
+        self._view[offset:offset + size] = data
+        slot['length'] = size
+        slot['lost'] = lost_frames
+        slot['timestamp'] = timestamp
+        slot['seq'] = head
+        layout.header['head'] = head + 1
+        self._check_subscribers(head + 1)
+
+    def _check_subscribers(self, head):
+        subscribers = self._layout.subscribers
+        # Subscribers too far behind are dropped before the chunks they did not read are overwritten
+        late = (subscribers['state'] == ACTIVE) & (head - subscribers['cursor'].astype(np.int64) > self._drop_lag)
+        if late.any():
+            subscribers['state'][late] = DROPPED
+            self._layout.header['dropped'] += int(np.count_nonzero(late))
+            process_logger.warning('{} live subscriber(s) dropped: too slow.'.format(int(np.count_nonzero(late))))
+        self.clean_up()
+
+    def clean_up(self):
+        # Free the slots of the subscribers which exited without unsubscribing, and of the subscribers dropped for
+        # more than DROPPED_GRACE seconds (they have to subscribe again anyway)
+        now = time.monotonic()
+        if now - self._last_clean_up < CLEAN_UP_PERIOD:
+            return
+        self._last_clean_up = now
+        subscribers = self._layout.subscribers
+        for index in np.flatnonzero(subscribers['state'] != FREE):
+            index = int(index)
+            if subscribers['state'][index] == DROPPED:
+                dropped_at = self._dropped_at.setdefault(index, now)
+                if now - dropped_at >= DROPPED_GRACE:
+                    subscribers['state'][index] = FREE
+                    continue
+            else:
+                self._dropped_at.pop(index, None)
+            try:
+                os.kill(int(subscribers['pid'][index]), 0)
+            except ProcessLookupError:
+                subscribers['state'][index] = FREE
+            except PermissionError:
+                pass
+        for index in list(self._dropped_at):
+            if subscribers['state'][index] != DROPPED:
+                del self._dropped_at[index]
+
+    def close(self):
+        if self._segment is None:
+            return
+        self._layout.header['closed'] = 1
+        # The numpy views on the segment must be released before it is closed
+        self._view.release()
+        self._layout = None
+        self._segment.close()
+        self._segment.unlink()
+        self._segment = None
+
+
+class LiveSubscriber:
+    """client of the live tap
+
+    The subscriber starts from the chunk being recorded. read() returns the new chunks (copied, so they stay valid)
+    and raises SubscriberDropped if the subscriber was too slow (its slot is freed), EOFError when the recording ends.
+
+    """
+    def __init__(self, name=TAP_NAME):
+        self.name = name
+        self._segment = _open_segment(name)
+        try:
+            self._layout = _TapLayout(self._segment.buf)
+        except ValueError:
+            self._segment.close()
+            raise
+        header = self._layout.header
+        self.channels = int(header['channels'])
+        self.rate = int(header['rate'])
+        self.dtype = SAMPLE_TYPES[int(header['sample_width'])]
+        self._view = self._segment.buf[self._layout.data_offset:]
+
+        with open(_lock_filename(name), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            free = np.flatnonzero(self._layout.subscribers['state'] == FREE)
+            if not len(free):
+                max_subscribers = len(self._layout.subscribers)
+                self._release()
+                raise ConnectionRefusedError('The live tap has already {} subscribers.'.format(max_subscribers))
+            self._index = int(free[0])
+            self._subscriber = self._layout.subscribers[self._index]
+            self._attached = time.time()
+            self._subscriber['pid'] = os.getpid()
+            self._subscriber['cursor'] = header['head']
+            self._subscriber['attached'] = self._attached
+            self._subscriber['state'] = ACTIVE
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        # Yield the chunks until the recording ends
+        while True:
+            try:
+                chunks = self.read()
+            except EOFError:
+                return
+            for chunk in chunks:
+                yield chunk
+
+    @property
+    def cursor(self):
+        return int(self._subscriber['cursor'])
+
+    def _owned(self):
+        # True if the slot is still the slot of this subscriber: the publisher frees the slots of the subscribers
+        # dropped for some time, and another subscriber may take it
+        return self._subscriber['pid'] == os.getpid() and self._subscriber['attached'] == self._attached
+
+    def _dropped(self, message):
+        # The slot is freed at once: the subscriber has to subscribe again
+        if self._owned():
+            self._subscriber['state'] = FREE
+        self._release()
+        return SubscriberDropped(message)
+
+    def read(self, timeout=None, max_chunks=None):
+        # Return the chunks recorded since the last read. An empty list means that the timeout expired
+        layout = self._layout
+        if layout is None:
+            raise SubscriberDropped('The live subscriber was dropped or closed: it has to subscribe again.')
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._subscriber['state'] != ACTIVE or not self._owned():
+                raise self._dropped('The live subscriber was dropped: it did not read the chunks in time.')
+            cursor = int(self._subscriber['cursor'])
+            head = int(layout.header['head'])
+            if head > cursor:
+                break
+            if layout.header['closed']:
+                raise EOFError('The live stream ended.')
+            if deadline is not None and time.monotonic() >= deadline:
+                return []
+            time.sleep(POLL_PERIOD)
+
+        if max_chunks is not None:
+            head = min(head, cursor + max_chunks)
+        chunks = []
+        for seq in range(cursor, head):
+            slot = layout.slots[seq % layout.n_slots]
+            offset = (seq % layout.n_slots) * layout.slot_size
+            length, lost, timestamp = int(slot['length']), int(slot['lost']), float(slot['timestamp'])
+            data = bytes(self._view[offset:offset + length])
+            # The chunk is valid only if the publisher did not start to overwrite its slot in the meanwhile
+            if int(slot['seq']) != seq:
+                raise self._dropped('The live subscriber was dropped: chunk {} was overwritten.'.format(seq))
+            samples = np.frombuffer(data, dtype=self.dtype).reshape(-1, self.channels)
+            chunks.append(LiveChunk(seq, samples, lost, timestamp))
+        self._subscriber['cursor'] = head
+        return chunks
+
+    def _release(self):
+        self._view.release()
+        self._subscriber = None
+        self._layout = None
+        self._segment.close()
+
+    def close(self):
+        if self._layout is None:
+            return
+        if self._owned():
+            self._subscriber['state'] = FREE
+        self._release()
+
+
+def live_publisher(connection_error, disconnection_error, ring, observer, channels, format_size, rate, name=TAP_NAME,
+                   n_slots=TAP_SLOTS, metrics=None, shutdown=None):
+    # OBSERVER is the number of the live tap among the observers of the ring buffer (see add_observer())
+
+    # Register handler for the SIGTERM signal (with a shutdown control, SIGTERM starts the shutdown and SIGINT is left
+    # to the main process)
+    signal.signal(signal.SIGTERM, sigterm_handler)
+    follow_shutdown(shutdown)
+
+    # The chunks of the ring buffer are observed, like in the DSP process, and copied in the live tap
+    publisher = LivePublisher(channels, format_size, rate, ring.slot_size, name, n_slots)
+    process_logger.info('Live stream published in the shared memory segment {}.'.format(name))
+    seq = 0  # Sequence number of the next chunk to publish
+    lost_frames = 0  # Frames not published before the next chunk
+    dropped = 0
+    try:
+        while connection_error.value is False and disconnection_error.value is False and not stopping(shutdown):
+            # The process sleeps until new chunks are published
+            if not ring.wait_observed(seq, observer, RING_TIMEOUT):
+                publisher.clean_up()
+                continue
+            chunks = ring.observe(seq)
+            if not chunks:
+                continue
+            if not publisher.subscribers:
+                # Nobody reads the live stream: the chunks are skipped without copying them
+                seq = chunks[-1].seq + 1
+                lost_frames = 0
+                publisher.clean_up()
+                continue
+            for chunk in chunks:
+                if chunk.seq != seq:
+                    # The chunks already overwritten are reported as lost to the subscribers
+                    lost_frames += (chunk.seq - seq) * ring.slot_size // ring.frame_size
+                data = bytes(chunk.data)
+                seq = chunk.seq + 1
+                if not ring.is_intact(chunk.seq):
+                    lost_frames += len(data) // ring.frame_size
+                    continue
+                publisher.publish(data, lost_frames + chunk.lost_frames, chunk.timestamp)
+                lost_frames = 0
+            if metrics is not None and publisher.dropped > dropped:
+                metrics.add('subscribers_dropped', publisher.dropped - dropped)
+                dropped = publisher.dropped
+
+    except (KeyboardInterrupt, SystemExit):
+        # The live tap keeps no data: it just terminates
+        pass
+
+    finally:
+        publisher.close()
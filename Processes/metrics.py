@@ -0,0 +1,261 @@
+"""This part of the code defines the metrics of the recording pipeline. Metrics are stored in shared memory and every
+counter or histogram is updated by one process only, so that no lock is needed and they can be updated in the
+audio callback. The exporter thread of the main process writes them periodically in a local file, in the Prometheus
+textfile format or as JSON lines.
+"""
+import ctypes
+import json
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+
+# Initialize custom logger for multiprocessing logging
+process_logger = logging.getLogger('metrics')
+
+HISTOGRAM_STEPS = 4  # Buckets of a latency histogram per power of two
+HISTOGRAM_BUCKETS = 41 * HISTOGRAM_STEPS  # From 1 microsecond to about 12 days
+
+# Counters of the pipeline and process which updates them
+COUNTERS = (
+    'chunks_captured',  # record
+    'bytes_captured',  # record
+    'input_overflows',  # record (callbacks with the input overflow flag)
+    'input_underflows',  # record (callbacks with the input underflow flag)
+    'reconnections',  # record (streams opened again after a stall or a disconnection)
+    'frames_lost',  # save (frames missing because of ring overruns or reconnections)
+    'frames_inactive',  # save (silent frames not stored by the activity gate)
+    'activity_events',  # save (times the activity gate was opened)
+    'bytes_written',  # save
+    'segments_written',  # save
+    'subscribers_dropped',  # live (subscribers of the live tap which were too slow)
+    'segments_compressed',  # compress
+    'bytes_compressed',  # compress (size of the compressed data)
+    'sessions_recompressed',  # recompress (sessions compressed again with the archive codec)
+    'bytes_saved_by_recompression',  # recompress
+    'sessions_deleted',  # main (sessions deleted by the storage manager)
+)
+COUNTER_INDEX = {name: index for index, name in enumerate(COUNTERS)}
+
+INPUT_UNDERFLOW = 1  # paInputUnderflow
+INPUT_OVERFLOW = 2  # paInputOverflow
+
+
+class LatencyHistogram:
+    """histogram of latencies in shared memory, with logarithmic buckets
+
+    Bucket 0 counts the values lower than 1 microsecond, bucket i the values lower than 2 ** (i / HISTOGRAM_STEPS)
+    microseconds, so percentiles are accurate within 19%.
+
+    """
+    def __init__(self):
+        self._buckets = multiprocessing.RawArray(ctypes.c_uint64, HISTOGRAM_BUCKETS)
+        self._sum = multiprocessing.RawValue(ctypes.c_double, 0)
+
+    def record(self, seconds):
+        microseconds = seconds * 1e6
+        bucket = 0
+        if microseconds >= 1:
+            bucket = min(int(HISTOGRAM_STEPS * math.log2(microseconds)) + 1, HISTOGRAM_BUCKETS - 1)
+        self._buckets[bucket] += 1
+        self._sum.value += seconds
+
+    @staticmethod
+    def bucket_bound(bucket):
+        # Upper bound (seconds) of the values counted in BUCKET
+        return 2 ** (bucket / HISTOGRAM_STEPS) / 1e6
+
+    def count(self):
+        return sum(self._buckets)
+
+    def mean(self):
+        count = self.count()
+        return self._sum.value / count if count else None
+
+    def percentile(self, q):
+        # Upper bound of the bucket containing the Q-th percentile (0 < Q <= 100), None if the histogram is empty
+        buckets = list(self._buckets)
+        count = sum(buckets)
+        if count == 0:
+            return None
+        rank = math.ceil(q / 100 * count)
+        cumulative = 0
+        for bucket, value in enumerate(buckets):
+            cumulative += value
+            if cumulative >= rank:
+                return self.bucket_bound(bucket)
+
+    def summary(self):
+        return {'count': self.count(), 'mean': self.mean(), 'p50': self.percentile(50), 'p99': self.percentile(99)}
+
+
+class PipelineMetrics:
+    """metrics shared by the record, save and compress processes
+
+    ADC_LATENCY is the time from the acquisition of a buffer by the ADC to the callback, CALLBACK_DURATION the time
+    spent in the callback, DISK_LATENCY the time from the callback to the write of a chunk on the disk and
+    ARCHIVE_LATENCY the time from the callback of the first chunk of a segment to the moment the segment is stored in
+    the archive.
+
+    """
+    def __init__(self):
+        self._counters = multiprocessing.RawArray(ctypes.c_uint64, len(COUNTERS))
+        self.adc_latency = LatencyHistogram()
+        self.callback_duration = LatencyHistogram()
+        self.disk_latency = LatencyHistogram()
+        self.archive_latency = LatencyHistogram()
+
+    def histograms(self):
+        return {'adc_latency': self.adc_latency, 'callback_duration': self.callback_duration,
+                'disk_latency': self.disk_latency, 'archive_latency': self.archive_latency}
+
+    def add(self, counter, value=1):
+        self._counters[COUNTER_INDEX[counter]] += value
+
+    def get(self, counter):
+        return self._counters[COUNTER_INDEX[counter]]
+
+    def snapshot(self):
+        return {name: self._counters[index] for index, name in enumerate(COUNTERS)}
+
+    def record_callback(self, size, time_info, status, start):
+        # Called at the end of the audio callback. START is the time.perf_counter() value when the callback began
+        self.add('chunks_captured')
+        self.add('bytes_captured', size)
+        if status & INPUT_OVERFLOW:
+            self.add('input_overflows')
+        if status & INPUT_UNDERFLOW:
+            self.add('input_underflows')
+        adc_time = time_info.get('input_buffer_adc_time', 0)
+        if adc_time:
+            self.adc_latency.record(time_info['current_time'] - adc_time)
+        self.callback_duration.record(time.perf_counter() - start)
+
+
+class CombinedMetrics:
+    """metrics of several processes of the same kind seen as one (e.g. the record processes of several boards)
+
+    Every process updates its own PipelineMetrics, so that no counter has more than one writer. The counters are summed
+    and the histograms merged when they are exported.
+
+    """
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._histograms = {name: LatencyHistogram() for name in metrics[0].histograms()}
+
+    def histograms(self):
+        for name, histogram in self._histograms.items():
+            parts = [metrics.histograms()[name] for metrics in self.metrics]
+            histogram._buckets[:] = [sum(buckets) for buckets in zip(*(part._buckets for part in parts))]
+            histogram._sum.value = sum(part._sum.value for part in parts)
+        return self._histograms
+
+    def snapshot(self):
+        snapshots = [metrics.snapshot() for metrics in self.metrics]
+        return {name: sum(snapshot[name] for snapshot in snapshots) for name in COUNTERS}
+
+
+class MetricsExporter:
+    """thread writing the metrics of the pipeline in a local file every PERIOD seconds
+
+    With the prometheus format the file is replaced at every export (node exporter textfile collector), with the jsonl
+    format one JSON object is appended at every export. Besides the counters and the latencies, the exporter computes
+    the occupancy of the ring buffer, the written and compressed bytes per second and the compression lag (segments
+    written but not yet compressed). If the LEVELS of the channels are given (DSP stage), they are exported too, and so
+    are the clocks of the BOARDS of a multi-board recording and the state of the STORAGE.
+
+    """
+    def __init__(self, metrics, ring, filename, period=10, export_format='prometheus', levels=None, boards=None,
+                 storage=None):
+        self.metrics = metrics
+        self.ring = ring
+        self.levels = levels
+        self.boards = boards
+        self.storage = storage
+        self.filename = filename
+        self.period = period
+        self.export_format = export_format
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+        self._previous = None  # (time, counters) of the previous export
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.period):
+            self.export()
+        self.export()
+
+    def collect(self):
+        now = time.monotonic()
+        counters = self.metrics.snapshot()
+        sample = dict(counters)
+        sample['ring_occupancy'] = self.ring.occupancy()
+        sample['ring_high_water'] = self.ring.high_water
+        sample['ring_overruns'] = self.ring.overruns
+        sample['compression_lag_segments'] = counters['segments_written'] - counters['segments_compressed']
+        if self._previous is not None:
+            elapsed = now - self._previous[0]
+            for name in ('bytes_captured', 'bytes_written', 'bytes_compressed'):
+                sample[name + '_per_second'] = (counters[name] - self._previous[1][name]) / elapsed
+        self._previous = (now, counters)
+        for name, histogram in self.metrics.histograms().items():
+            sample[name] = histogram.summary()
+        if self.levels is not None:
+            sample.update(self.levels.snapshot())
+        if self.boards is not None:
+            sample.update(self.boards.snapshot())
+        if self.storage is not None:
+            sample.update(self.storage.snapshot())
+        return sample
+
+    def export(self):
+        try:
+            sample = self.collect()
+            if self.export_format == 'jsonl':
+                sample['time'] = time.time()
+                with open(self.filename, 'a') as f:
+                    f.write(json.dumps(sample) + '\n')
+            else:
+                # The file is written aside and renamed, so that the collector never reads a partial file
+                with open(self.filename + '.tmp', 'w') as f:
+                    f.write(prometheus_text(sample, self.metrics.histograms()))
+                os.replace(self.filename + '.tmp', self.filename)
+        except OSError as error:
+            process_logger.warning('Metrics export failed: {}'.format(error))
+
+
+def prometheus_text(sample, histograms):
+    # Metrics in the Prometheus text exposition format
+    lines = []
+    for name, value in sample.items():
+        if name in histograms:
+            histogram = histograms[name]
+            metric = 'mch_{}_seconds'.format(name)
+            lines.append('# TYPE {} summary'.format(metric))
+            for q in (0.5, 0.9, 0.99):
+                value = histogram.percentile(100 * q)
+                lines.append('{}{{quantile="{}"}} {}'.format(metric, q, value if value is not None else 'NaN'))
+            lines.append('{}_sum {}'.format(metric, histogram.count() and histogram.mean() * histogram.count()))
+            lines.append('{}_count {}'.format(metric, histogram.count()))
+        elif isinstance(value, list):
+            # One value per channel (or per board)
+            label = 'board' if name.startswith('board_') else 'channel'
+            lines.append('# TYPE mch_{} gauge'.format(name))
+            for index, item in enumerate(value):
+                lines.append('mch_{}{{{}="{}"}} {}'.format(name, label, index, item))
+        elif name in COUNTER_INDEX or name in ('ring_overruns', 'dsp_chunks', 'dsp_skipped_chunks'):
+            lines.append('# TYPE mch_{}_total counter'.format(name))
+            lines.append('mch_{}_total {}'.format(name, value))
+        else:
+            lines.append('# TYPE mch_{} gauge'.format(name))
+            lines.append('mch_{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
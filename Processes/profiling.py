@@ -0,0 +1,208 @@
+"""This part of the code defines the profiling mode of the recording, to find after the fact which process was the
+bottleneck (e.g. when a field unit dropped audio). Every process started by the supervisor runs a sampling profiler: a
+thread of the process reads the stacks of the other threads every INTERVAL seconds, so the code of the process is not
+instrumented and the audio callback is never slowed down by a trace function.
+
+Every process writes its profile in the session folder (next to audio_record.log) every PERIOD seconds and when it ends,
+so that a process killed at the deadline of the shutdown still leaves its last profile:
+- profile <process> <pid>.wall.folded: the stacks sampled, with the number of samples (wall time);
+- profile <process> <pid>.cpu.folded: the stacks of the threads which were running (or waiting for a core) when they
+  were sampled, with the number of samples (CPU time, on Linux where the state of the threads is known);
+- profile <process> <pid>.json: the wall time, the CPU time (user and system) of the process and of each thread, and
+  the CPU time of the child processes which ended (e.g. the workers of the compression process).
+The folded stacks (one line per stack: thread;outermost frame;...;innermost frame count, from the target of the process)
+are read by flamegraph.pl or speedscope.
+"""
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+PROFILE_ENVIRONMENT = 'MCH_PROFILE'  # Environment variable turning the profiling on (any value but 0)
+SAMPLE_INTERVAL = 0.01  # Seconds between two samples of the stacks
+DUMP_PERIOD = 30  # Seconds between two writes of the profile
+
+
+def profiling_requested(default=False):
+    # True if the profiling is turned on by the environment (or by DEFAULT if the variable is not set)
+    value = os.environ.get(PROFILE_ENVIRONMENT)
+    if value is None:
+        return default
+    return value.strip() not in ('', '0')
+
+
+def _thread_running(native_id):
+    # True if the thread is running or waiting for a core, None if its state is not known (e.g. not on Linux)
+    try:
+        with open('/proc/self/task/{}/stat'.format(native_id), 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The state follows the name of the thread, which is in parentheses
+    end = stat.rfind(b')')
+    return stat[end + 2:end + 3] == b'R'
+
+
+def _thread_cpu_time(ident):
+    # CPU time (seconds) used by a thread of the process, None if it can not be measured (e.g. not on Linux)
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError, OverflowError):
+        return None
+
+
+def _frame_name(code):
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class StackSampler:
+    """sampling profiler of the threads of a process
+
+    The thread of the sampler is a daemon: start() and stop() are called by the process itself, the profile is written
+    by dump() (stop() writes it once more). The stacks start below the frame of ROOT (a code object), if it is given:
+    the frames of the parent process (before the fork) are left out.
+
+    """
+    def __init__(self, path, process, interval=SAMPLE_INTERVAL, period=DUMP_PERIOD, root=None):
+        self.process = process
+        self.root = root
+        self.interval = interval
+        self.period = period
+        prefix = os.path.join(path, 'profile {} {}'.format(process, os.getpid()))
+        self.filenames = {'wall': prefix + '.wall.folded', 'cpu': prefix + '.cpu.folded', 'times': prefix + '.json'}
+        self.samples = 0
+        self._wall = {}  # (thread, code objects from the outermost) -> samples
+        self._cpu = {}  # (thread, code objects from the outermost) -> samples while the thread was running
+        self._thread_cpu = {}  # Thread name -> CPU time (seconds) at the last sample, also for the threads which ended
+        self._names = {}  # Code object -> name of the frame
+        self._start = None
+        self._start_time = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self._start = time.monotonic()
+        self._start_time = time.time()
+        self._thread.start()
+
+    def stop(self):
+        if self._thread.is_alive():
+            self._stop.set()
+            self._thread.join()
+        self.dump()
+
+    def _run(self):
+        last_dump = time.monotonic()
+        while not self._stop.wait(self.interval):
+            self.sample()
+            if time.monotonic() - last_dump >= self.period:
+                self.dump()
+                last_dump = time.monotonic()
+
+    def sample(self):
+        # Add the stacks of the threads of the process (except the sampler) to the profile
+        threads = {thread.ident: thread for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == threading.get_ident():
+                continue
+            codes = []
+            while frame is not None and frame.f_code is not self.root:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            thread = threads.get(ident)
+            name = thread.name if thread is not None else 'thread {}'.format(ident)
+            key = (name, tuple(reversed(codes)))
+            self._wall[key] = self._wall.get(key, 0) + 1
+
+            if thread is not None and thread.native_id is not None and _thread_running(thread.native_id):
+                self._cpu[key] = self._cpu.get(key, 0) + 1
+            cpu = _thread_cpu_time(ident)
+            if cpu is not None:
+                self._thread_cpu[name] = cpu
+        # The CPU time of the sampler itself is the overhead of the profiling
+        cpu = _thread_cpu_time(threading.get_ident())
+        if cpu is not None:
+            self._thread_cpu[self._thread.name] = cpu
+        self.samples += 1
+
+    def _folded(self, counts):
+        lines = []
+        for (thread, codes), count in list(counts.items()):
+            if count <= 0:
+                continue
+            for code in codes:
+                if code not in self._names:
+                    self._names[code] = _frame_name(code)
+            lines.append('{};{} {}\n'.format(thread, ';'.join(self._names[code] for code in codes), count))
+        return ''.join(sorted(lines))
+
+    def times(self):
+        # Wall and CPU time of the process and of its threads
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        threads = dict(self._thread_cpu)
+        for thread in threading.enumerate():
+            cpu = _thread_cpu_time(thread.ident)
+            if cpu is not None:
+                threads[thread.name] = cpu
+        wall = time.monotonic() - self._start if self._start is not None else 0.0
+        return {'process': self.process, 'pid': os.getpid(), 'start_time': self._start_time,
+                'wall_seconds': round(wall, 6), 'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 6),
+                'user_seconds': round(usage.ru_utime, 6), 'system_seconds': round(usage.ru_stime, 6),
+                'cpu_share': round((usage.ru_utime + usage.ru_stime) / wall, 4) if wall else 0.0,
+                'children_cpu_seconds': round(children.ru_utime + children.ru_stime, 6),
+                'max_rss_kilobytes': usage.ru_maxrss,
+                'threads_cpu_seconds': {name: round(cpu, 6) for name, cpu in sorted(threads.items())},
+                'samples': self.samples, 'interval': self.interval}
+
+    def dump(self):
+        # Write the profile, every file replaced at once (a reader never sees a partial profile)
+        contents = {'wall': self._folded(self._wall), 'cpu': self._folded(self._cpu),
+                    'times': json.dumps(self.times(), indent=1)}
+        for kind, filename in self.filenames.items():
+            try:
+                with open(filename + '.tmp', 'w') as f:
+                    f.write(contents[kind])
+                os.replace(filename + '.tmp', filename)
+            except OSError:
+                # E.g. the session folder was removed: the profile is not written
+                pass
+
+
+class ProfiledTarget:
+    """target of a process run under the sampling profiler
+
+    The supervisor starts the processes with it instead of their target when the profiling is on (see Profiling).
+
+    """
+    def __init__(self, target, path, process, interval=SAMPLE_INTERVAL, period=DUMP_PERIOD):
+        self.target = target
+        self.path = path
+        self.process = process
+        self.interval = interval
+        self.period = period
+
+    def __call__(self, *args):
+        sampler = StackSampler(self.path, self.process, self.interval, self.period, ProfiledTarget.__call__.__code__)
+        sampler.start()
+        try:
+            return self.target(*args)
+        finally:
+            sampler.stop()
+
+
+class Profiling:
+    """settings of the profiling mode
+
+    The profiles of the processes are written in PATH (the session folder).
+
+    """
+    def __init__(self, path, interval=SAMPLE_INTERVAL, period=DUMP_PERIOD):
+        self.path = path
+        self.interval = interval
+        self.period = period
+
+    def wrap(self, target, process):
+        return ProfiledTarget(target, self.path, process, self.interval, self.period)
@@ -1,77 +1,149 @@
-import subprocess
-from Processes.stream_connection import *
-from CustomExceptions.custom_handlers import *
-
-# Initialize custom logger for multiprocessing logging
-process_logger = logging.getLogger('record_process')
-
-# Register handler for the SIGTERM signal
-signal.signal(signal.SIGTERM, sigterm_handler)
-
-
-def put_data_in_the_queue(data, q):
-    q.put(data)
-
-
-def audio_record(error_connection, que, audio_format, channels, rate, chunk):
-
-    # Look for the audio peripheral to use for the recording
-    p_audio, index_device = stream_set_up()
-
-    # Define callback function which is called everytime new data from the sensors are available
-    def callback(in_data, frame_count, time_info, status):
-        put_data_in_the_queue(in_data, que)
-        return in_data, pyaudio.paContinue
-
-    try:
-        if index_device != -1:  # If the MCH Streamer is connected then the audio recording starts
-
-            # Open Streaming
-            s = p_audio.open(format=audio_format, channels=channels, rate=rate, input=True,
-                             input_device_index=index_device, frames_per_buffer=chunk, stream_callback=callback)
-
-            process_logger.info('The device is going to record at {} Hz, using {} channels.'.format(rate, channels))
-            process_logger.info('Start recording.')
-
-            # The recording continues until the stream connection is active.
-            # If the stream connection is not active (e.g. the Streamer board was disconnected), the record_process
-            # is terminated by SIGSEGV signal (segmentation fault error), exit code 139
-            while s.is_active() is True:
-                continue
-
-        # If the Streamer board is not connected then an exception is raised and propagated to all the processes
-        if index_device == -1:
-            error_connection.value = True
-            raise StreamConnectionError
-
-    # Recording finishes when SIGINT or SIGTERM signal are catched
-    except KeyboardInterrupt:
-        process_logger.info('Recording finished.')
-
-    except OSError:
-        # If there is a problem with the MCH Streamer, audio drivers are restarted to solve the problem
-        process_logger.error('Problem with MCH Streamer connection: restarting the drivers.')
-        command_line = subprocess.run(['pulseaudio', '-k'], universal_newlines=True, capture_output=True)
-        process_logger.info('Kill pulseaudio processes. {}'.format(command_line.stdout))
-        command_line = subprocess.run(['alsa', 'force-reload'], universal_newlines=True, capture_output=True)
-        process_logger.info('Reload alsa packages. {}'.format(command_line.stdout))
-        command_line = subprocess.run(['pulseaudio', '--start'], universal_newlines=True, capture_output=True)
-        process_logger.info('Restart pulseaudio. {}'.format(command_line.stdout))
-
-        # The exception is propagated to the other processes
-        error_connection.value = True
-
-    except StreamConnectionError:
-        # If the Streamer board is not connecter (from the beginning), no stream connection is opened
-        process_logger.error('MCH Streamer is not connected. No stream connection opened.')
-
-    except SystemExit:
-        pass
-
-    finally:
-        # Close streaming
-        if index_device != -1:
-            s.stop_stream()
-            s.close()
-
-        p_audio.terminate()
+import os
+import subprocess
+import time
+import logging
+from Processes.capture_backends import *
+from Processes.shutdown import follow_shutdown, stopping
+from CustomExceptions.custom_handlers import *
+
+# Initialize custom logger for multiprocessing logging
+process_logger = logging.getLogger('record_process')
+
+# Register handler for the SIGTERM signal
+signal.signal(signal.SIGTERM, sigterm_handler)
+
+STREAM_CHECK_PERIOD = 0.25  # Seconds between two checks of the stream state
+STALL_TIMEOUT = 1.0  # Seconds without callbacks after which the stream is considered stalled
+RECONNECT_PERIOD = 1.0  # Seconds between two attempts to open the stream again
+RECONNECT_TIMEOUT = 60  # Seconds after which the reconnection is abandoned and the drivers are restarted
+
+
+def reconnect(capture, shutdown=None):
+    # Open the stream again, until the device answers or RECONNECT_TIMEOUT expires (or the recording is ending). The
+    # other processes keep on running, so only the frames of the reconnection are lost
+    deadline = time.monotonic() + RECONNECT_TIMEOUT
+    attempt = 0
+    while time.monotonic() < deadline and not stopping(shutdown):
+        attempt += 1
+        try:
+            if capture.reopen():
+                process_logger.info('Stream opened again after {} attempt(s).'.format(attempt))
+                return True
+        except OSError as error:
+            process_logger.warning('Reconnection attempt {} failed: {}'.format(attempt, error))
+        time.sleep(RECONNECT_PERIOD)
+    return False
+
+
+def pin_process(cpu):
+    # Run the process (and the threads it starts afterwards, e.g. the PortAudio callback thread) on the core CPU only,
+    # so that the record processes of several boards do not compete for the same core
+    if not hasattr(os, 'sched_setaffinity'):
+        process_logger.warning('The record process can not be pinned to a core on this system.')
+        return
+    try:
+        os.sched_setaffinity(0, {cpu})
+    except OSError as error:
+        process_logger.warning('The record process could not be pinned to core {}: {}'.format(cpu, error))
+    else:
+        process_logger.info('Record process pinned to core {}.'.format(cpu))
+
+
+def audio_record(error_connection, ring, audio_format, channels, rate, chunk, backend='portaudio', metrics=None,
+                 cpu=None, shutdown=None):
+
+    # SIGINT is left to the main process and SIGTERM starts the shutdown: the stream is closed by this process
+    follow_shutdown(shutdown)
+
+    if cpu is not None:
+        pin_process(cpu)
+
+    # Source of the audio data (the MCH Streamer, unless a synthetic or replay backend is requested)
+    capture = create_backend(backend)
+    connected = False
+    stall_timeout = max(STALL_TIMEOUT, 4 * chunk / rate)
+    last_callback = None  # Time of the last callback
+    gap_start = None  # Time of the last callback before a reconnection, until the first callback after it
+
+    # Define callback function which is called everytime new data from the sensors are available. Data are copied
+    # straight into the shared ring buffer, with the time when the ADC acquired them (used to align several boards)
+    def callback(in_data, frame_count, time_info, status):
+        nonlocal last_callback, gap_start
+        start = time.perf_counter()
+        last_callback = time.monotonic()
+        if gap_start is not None:
+            # First buffer after a reconnection: the frames missing since the last buffer are marked in the data
+            ring.mark_gap(max(0, round((last_callback - gap_start) * rate) - frame_count))
+            gap_start = None
+        ring.put(in_data, time_info.get('input_buffer_adc_time', 0.0))
+        if metrics is not None:
+            metrics.record_callback(len(in_data), time_info, status, start)
+        return in_data, paContinue
+
+    try:
+        # Look for the audio peripheral to use for the recording and open the streaming.
+        # If the MCH Streamer is connected then the audio recording starts
+        connected = capture.open(audio_format, channels, rate, chunk, callback)
+        if connected:
+            process_logger.info('The device is going to record at {} Hz, using {} channels ({} backend).'
+                                .format(rate, channels, capture.name))
+            process_logger.info('Start recording.')
+
+            # The recording continues until the stream connection is active. The process sleeps between the checks,
+            # the data are moved by the callback.
+            # If the stream stops delivering data or it is not active (e.g. the Streamer board was disconnected), the
+            # stream is opened again while the other processes keep on running. If the reconnection fails, the drivers
+            # are restarted. When the shutdown starts, the stream is closed
+            last_callback = time.monotonic()
+            while not stopping(shutdown):
+                time.sleep(STREAM_CHECK_PERIOD)
+                if capture.is_active() is True and time.monotonic() - last_callback < stall_timeout:
+                    continue
+                if not capture.reconnectable:
+                    break
+
+                process_logger.warning('Stream stalled: no data for {:.2f} s. Reconnecting the device.'
+                                       .format(time.monotonic() - last_callback))
+                gap_start = last_callback
+                if not reconnect(capture, shutdown):
+                    if stopping(shutdown):
+                        break
+                    raise OSError('the device could not be reconnected')
+                last_callback = time.monotonic()
+                if metrics is not None:
+                    metrics.add('reconnections')
+            if stopping(shutdown):
+                process_logger.info('Recording finished.')
+
+        # If the Streamer board is not connected then an exception is raised and propagated to all the processes
+        if not connected:
+            error_connection.value = True
+            raise StreamConnectionError
+
+    # Recording finishes when SIGINT or SIGTERM signal are catched
+    except KeyboardInterrupt:
+        process_logger.info('Recording finished.')
+
+    except OSError:
+        # If there is a problem with the MCH Streamer, audio drivers are restarted to solve the problem
+        process_logger.error('Problem with MCH Streamer connection: restarting the drivers.')
+        command_line = subprocess.run(['pulseaudio', '-k'], universal_newlines=True, capture_output=True)
+        process_logger.info('Kill pulseaudio processes. {}'.format(command_line.stdout))
+        command_line = subprocess.run(['alsa', 'force-reload'], universal_newlines=True, capture_output=True)
+        process_logger.info('Reload alsa packages. {}'.format(command_line.stdout))
+        command_line = subprocess.run(['pulseaudio', '--start'], universal_newlines=True, capture_output=True)
+        process_logger.info('Restart pulseaudio. {}'.format(command_line.stdout))
+
+        # The exception is propagated to the other processes
+        error_connection.value = True
+
+    except StreamConnectionError:
+        # If the Streamer board is not connecter (from the beginning), no stream connection is opened
+        process_logger.error('MCH Streamer is not connected. No stream connection opened.')
+
+    except SystemExit:
+        pass
+
+    finally:
+        # Close streaming
+        capture.close()
@@ -0,0 +1,443 @@
+"""This part of the code defines the recording container, an indexed file where the recorded data are stored in blocks
+of BLOCK_SECONDS seconds. Every channel of a block is compressed on its own, so that a time range of a few channels is
+read without decompressing the rest of the recording.
+
+The container is made of two append-only files:
+- data.mchr: the file header, then the blocks. Every block has a header (magic, first frame, frames, segment, first
+  frame in the segment, compressed size of each channel) followed by the compressed channels
+- data.mchr.idx: the same file header, then one record of fixed size per block (first frame, frames, position of the
+  compressed channels in data.mchr, compressed size of each channel, segment, first frame in the segment), so that
+  the blocks of a time range are found by a binary search
+
+Frames are counted from the beginning of the recording, including the frames lost (e.g. while the device was
+reconnected, or silent frames skipped by the activity gate): the time of every sample is exact and the missing frames
+are read as zeros. The gaps are listed, with the levels of the skipped silence, in data.mchr.gaps (one JSON object per
+line). The segment of every block is kept, so that scrambled segments (see scrambling.py) are descrambled by the
+reader. Version 1 containers (without the segments) are still read.
+A container can be compressed again with another codec (e.g. in idle time, see storage_manager.py): the copy replaces
+it only when it is complete.
+"""
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+from Processes.audio_codecs import CODECS, SAMPLE_TYPES, decode_samples, encode_samples, read_wav, write_wav
+from Processes.scrambling import Scrambler, read_key
+
+CONTAINER_SUFFIX = '.mchr'
+INDEX_SUFFIX = '.idx'
+GAPS_SUFFIX = '.gaps'
+RECOMPRESSED_SUFFIX = '.recompressed'  # Complete copy of a container compressed again, replacing it
+CONTAINER_MAGIC = b'MCHR'
+CONTAINER_VERSION = 2
+# Magic, version, codec id, sample width, channels, rate, frames per block, start time (seconds since the epoch)
+CONTAINER_HEADER = struct.Struct('<4sBBBxHIId')
+BLOCK_MAGIC = b'MCHB'
+BLOCK_HEADER = struct.Struct('<4sQIII')  # Magic, first frame, frames, segment, first frame in the segment. It is
+# followed by the size of each channel
+BLOCK_SECONDS = 10  # Seconds of audio per block
+
+# Blocks of a compressed segment. SEGMENT is the number of the segment, GAPS its gaps (see SegmentWriter.mark_gap()),
+# every block is a tuple (first frame in the segment, frames, list of the compressed channels)
+SegmentBlocks = namedtuple('SegmentBlocks', ['rate', 'sample_width', 'channels', 'frames', 'gaps', 'blocks',
+                                             'segment'])
+
+
+def index_type(channels, version=CONTAINER_VERSION):
+    # Type of the records of the index
+    fields = [('start', '<u8'), ('frames', '<u4'), ('offset', '<u8'), ('sizes', '<u4', (channels,))]
+    if version >= 2:
+        fields += [('segment', '<u4'), ('segment_frame', '<u4')]
+    return np.dtype(fields)
+
+
+def segment_number(filename):
+    # Number of a segment from its file name (e.g. 'audio data minute 12.wav' -> 12), 0 if there is none
+    match = re.search(r'(\d+)$', os.path.splitext(os.path.basename(filename))[0])
+    return int(match.group(1)) if match else 0
+
+
+def codec_name(codec_id):
+    return next(name for name, (number, _) in CODECS.items() if number == codec_id)
+
+
+def encode_blocks(filename, codec, block_seconds=BLOCK_SECONDS):
+    # Compress a .wav segment in blocks, channel by channel (it runs in the workers of the compression process).
+    # Blocks never contain a gap
+    samples, rate = read_wav(filename)
+    gaps = []
+    metadata = os.path.splitext(filename)[0] + '.json'
+    if os.path.exists(metadata):
+        with open(metadata) as f:
+            gaps = json.load(f)['gaps']
+
+    block_frames = max(1, int(block_seconds * rate))
+    bounds = sorted({0, len(samples)} | {gap['frame'] for gap in gaps if 0 < gap['frame'] < len(samples)})
+    blocks = []
+    for begin, end in zip(bounds[:-1], bounds[1:]):
+        for start in range(begin, end, block_frames):
+            stop = min(start + block_frames, end)
+            blocks.append((start, stop - start, [encode_samples(samples[start:stop, channel:channel + 1], rate, codec)
+                                                 for channel in range(samples.shape[1])]))
+    return SegmentBlocks(rate, samples.dtype.itemsize, samples.shape[1], len(samples), gaps, blocks,
+                         segment_number(filename))
+
+
+def _read_header(f):
+    header = f.read(CONTAINER_HEADER.size)
+    if len(header) < CONTAINER_HEADER.size:
+        raise ValueError('Recording container is truncated.')
+    magic, version, codec_id, sample_width, channels, rate, block_frames, start_time = CONTAINER_HEADER.unpack(header)
+    if magic != CONTAINER_MAGIC or not 1 <= version <= CONTAINER_VERSION:
+        raise ValueError('Not a recording container (version {} at most).'.format(CONTAINER_VERSION))
+    return codec_name(codec_id), sample_width, channels, rate, block_frames, start_time, version
+
+
+class ContainerWriter:
+    """append-only writer of a recording container
+
+    The data of a block are written before its index record, so the index never points to missing data. If the
+    container already exists (e.g. the compression process was restarted), the complete blocks whose record was not
+    written are indexed, the data of an incomplete block are discarded and the new blocks are appended.
+
+    """
+    def __init__(self, filename, channels, sample_width, rate, codec, block_seconds=BLOCK_SECONDS, start_time=0.0):
+        if codec not in CODECS:
+            raise ValueError('The recording container needs one of the codecs {}.'.format(', '.join(CODECS)))
+        self.filename = filename
+        self.channels = channels
+        self.sample_width = sample_width
+        self.rate = rate
+        self.codec = codec
+        self.block_frames = max(1, int(block_seconds * rate))
+        self.next_frame = 0  # Frame of the recording after the last block
+        self._type = index_type(channels)
+        header = CONTAINER_HEADER.pack(CONTAINER_MAGIC, CONTAINER_VERSION, CODECS[codec][0], sample_width, channels,
+                                       rate, self.block_frames, start_time)
+
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            with open(filename, 'rb') as f:
+                settings = _read_header(f)
+                f.seek(0)
+                header = f.read(CONTAINER_HEADER.size)
+            if settings[:4] != (codec, sample_width, channels, rate) or settings[6] != CONTAINER_VERSION:
+                raise ValueError('{} holds data with different settings.'.format(filename))
+            self.block_frames = settings[4]
+            if not os.path.exists(filename + INDEX_SUFFIX) or \
+                    os.path.getsize(filename + INDEX_SUFFIX) < CONTAINER_HEADER.size:
+                with open(filename + INDEX_SUFFIX, 'wb') as f:
+                    f.write(header)
+            self._data = open(filename, 'r+b')
+            self._index = open(filename + INDEX_SUFFIX, 'r+b')
+
+            # Only the complete records are kept
+            n_blocks = (os.path.getsize(filename + INDEX_SUFFIX) - CONTAINER_HEADER.size) // self._type.itemsize
+            self._index.truncate(CONTAINER_HEADER.size + n_blocks * self._type.itemsize)
+            self._data_size = CONTAINER_HEADER.size
+            if n_blocks:
+                self._index.seek(CONTAINER_HEADER.size + (n_blocks - 1) * self._type.itemsize)
+                last = np.frombuffer(self._index.read(self._type.itemsize), self._type)[0]
+                self._data_size = int(last['offset'] + last['sizes'].sum())
+                self.next_frame = int(last['start'] + last['frames'])
+            self._index.seek(0, os.SEEK_END)
+            self._recover_blocks()
+        else:
+            self._data = open(filename, 'wb')
+            self._index = open(filename + INDEX_SUFFIX, 'wb')
+            self._data.write(header)
+            self._index.write(header)
+            self._data_size = CONTAINER_HEADER.size
+
+    def _recover_blocks(self):
+        # Index the complete blocks written after the last index record, then discard the rest of the data
+        self._data.seek(self._data_size)
+        while True:
+            header = self._data.read(BLOCK_HEADER.size + 4 * self.channels)
+            if len(header) < BLOCK_HEADER.size + 4 * self.channels:
+                break
+            magic, start, frames, segment, segment_frame = BLOCK_HEADER.unpack_from(header)
+            sizes = struct.unpack_from('<{}I'.format(self.channels), header, BLOCK_HEADER.size)
+            offset = self._data_size + len(header)
+            if magic != BLOCK_MAGIC or offset + sum(sizes) > os.path.getsize(self.filename):
+                break
+            self._index.write(self._record(start, frames, offset, sizes, segment, segment_frame))
+            self._data_size = offset + sum(sizes)
+            self.next_frame = start + frames
+            self._data.seek(self._data_size)
+        self._data.truncate(self._data_size)
+        self._data.seek(self._data_size)
+
+    def _record(self, start, frames, offset, sizes, segment, segment_frame):
+        record = np.zeros(1, self._type)
+        record['start'] = start
+        record['frames'] = frames
+        record['offset'] = offset
+        record['sizes'] = sizes
+        record['segment'] = segment
+        record['segment_frame'] = segment_frame
+        return record.tobytes()
+
+    def append(self, segment):
+        # Append the blocks of a segment (see encode_blocks()) and return the bytes written. The frames lost in the
+        # gaps are skipped on the time line
+        if (segment.channels, segment.sample_width, segment.rate) != (self.channels, self.sample_width, self.rate):
+            raise ValueError('Segment with different settings than the recording container.')
+        size = self._data_size
+        for start, frames, channels in segment.blocks:
+            lost = sum(gap['lost_frames'] for gap in segment.gaps if gap['frame'] <= start)
+            self._write_block(self.next_frame + start + lost, frames, channels, segment.segment, start)
+        if segment.gaps:
+            with open(self.filename + GAPS_SUFFIX, 'a') as f:
+                lost = 0  # Frames of the previous gaps of the segment
+                for gap in segment.gaps:
+                    f.write(json.dumps(dict(gap, start=self.next_frame + gap['frame'] + lost,
+                                            segment=segment.segment)) + '\n')
+                    lost += gap['lost_frames']
+        self.next_frame += segment.frames + sum(gap['lost_frames'] for gap in segment.gaps)
+
+        # The data are on the disk before the index refers to them
+        self._data.flush()
+        self._index.flush()
+        return self._data_size - size
+
+    def _write_block(self, start, frames, channels, segment, segment_frame):
+        sizes = [len(channel) for channel in channels]
+        self._data.write(BLOCK_HEADER.pack(BLOCK_MAGIC, start, frames, segment, segment_frame))
+        self._data.write(struct.pack('<{}I'.format(self.channels), *sizes))
+        offset = self._data_size + BLOCK_HEADER.size + 4 * self.channels
+        for channel in channels:
+            self._data.write(channel)
+        self._data_size = offset + sum(sizes)
+        self._index.write(self._record(start, frames, offset, sizes, segment, segment_frame))
+
+    def sync(self):
+        # Force the data and the index on the disk
+        for f in (self._data, self._index):
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        if self._data is None:
+            return
+        self._data.flush()
+        self._index.flush()
+        self._data.close()
+        self._index.close()
+        self._data = None
+
+
+class ContainerReader:
+    """random access reader of a recording container
+
+    read() returns the samples of a time range of some channels and decompresses only the blocks of that range, one
+    channel at a time. The blocks stored with the raw codec are read straight from the memory mapped file.
+    If the segments were scrambled (see scrambling.py), the KEY of the recordings is needed: only the windows of the
+    segments which hold the time range are decompressed and descrambled. A STORED reader returns the samples as they
+    are stored (scrambled), without the key.
+
+    """
+    def __init__(self, filename, key=None, stored=False):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.codec, sample_width, self.channels, self.rate, self.block_frames, self.start_time, version = \
+                _read_header(f)
+        self.dtype = SAMPLE_TYPES[sample_width]
+
+        # Only the complete records are used: the writer may be appending a block
+        record_type = index_type(self.channels, version)
+        n_blocks = (os.path.getsize(filename + INDEX_SUFFIX) - CONTAINER_HEADER.size) // record_type.itemsize
+        self.index = np.fromfile(filename + INDEX_SUFFIX, dtype=record_type, count=max(0, n_blocks),
+                                 offset=CONTAINER_HEADER.size)
+        self.version = version
+        self.scrambler = None
+        if version >= 2 and not stored:
+            self.scrambler = Scrambler.load(key, os.path.dirname(os.path.abspath(filename)))
+
+        self._file = open(filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def frames(self):
+        # Frames of the recording, including the frames lost
+        if len(self.index) == 0:
+            return 0
+        return int(self.index['start'][-1] + self.index['frames'][-1])
+
+    @property
+    def duration(self):
+        return self.frames / self.rate
+
+    def gaps(self):
+        # Gaps of the recording: START is their first frame, LOST_FRAMES their length. The stretches skipped by the
+        # activity gate are INACTIVE, with the LEVELS (dBFS) of the channels
+        gaps = []
+        if os.path.exists(self.filename + GAPS_SUFFIX):
+            with open(self.filename + GAPS_SUFFIX) as f:
+                gaps = [json.loads(line) for line in f if line.endswith('\n')]
+        return gaps
+
+    def _channel(self, block, channel):
+        # Samples of one channel of a block
+        offset = int(block['offset'] + block['sizes'][:channel].sum())
+        size = int(block['sizes'][channel])
+        if self.codec == 'raw':
+            return np.frombuffer(self._map, dtype=self.dtype, count=int(block['frames']), offset=offset)
+        return decode_samples(self._map[offset:offset + size], self.codec, 1, self.dtype)[:, 0]
+
+    def read(self, start, duration, channels=None):
+        # Return the samples (frames, channels) from START seconds for DURATION seconds. CHANNELS is a list of channel
+        # numbers (all the channels by default). The frames which were not recorded are zeros
+        if channels is None:
+            channels = range(self.channels)
+        channels = list(channels)
+        first = max(0, int(round(start * self.rate)))
+        last = max(first, int(round((start + duration) * self.rate)))
+        samples = np.zeros((last - first, len(channels)), dtype=self.dtype)
+
+        starts = self.index['start'].astype(np.int64)
+        ends = starts + self.index['frames']
+        n_block = int(np.searchsorted(ends, first, side='right'))
+        while n_block < len(self.index) and starts[n_block] < last:
+            block = self.index[n_block]
+            begin = max(first, int(starts[n_block]))
+            end = min(last, int(ends[n_block]))
+            if self.scrambler is not None:
+                # Frames of the segment in their original order
+                segment_begin = int(block['segment_frame']) + begin - int(starts[n_block])
+                samples[begin - first:end - first] = self._descrambled(int(block['segment']), segment_begin,
+                                                                       segment_begin + end - begin, channels)
+            else:
+                for position, channel in enumerate(channels):
+                    data = self._channel(block, channel)
+                    samples[begin - first:end - first, position] = \
+                        data[begin - starts[n_block]:end - starts[n_block]]
+            n_block += 1
+        return samples
+
+    def _stored(self, segment, begin, end, channels):
+        # Samples of the frames BEGIN to END of a segment as they are stored, CHANNELS are stored channel numbers
+        samples = np.zeros((end - begin, len(channels)), dtype=self.dtype)
+        for block in self.index[self.index['segment'] == segment]:
+            block_begin = int(block['segment_frame'])
+            block_end = block_begin + int(block['frames'])
+            if block_end <= begin or block_begin >= end:
+                continue
+            for position, channel in enumerate(channels):
+                data = self._channel(block, channel)
+                samples[max(begin, block_begin) - begin:min(end, block_end) - begin, position] = \
+                    data[max(begin, block_begin) - block_begin:min(end, block_end) - block_begin]
+        return samples
+
+    def _segment_frames(self, segment):
+        blocks = self.index[self.index['segment'] == segment]
+        return int((blocks['segment_frame'] + blocks['frames']).max()) if len(blocks) else 0
+
+    def stored_segment(self, segment):
+        # Samples (frames, channels) of a whole segment as they are stored: scrambled segments are not descrambled
+        return self._stored(segment, 0, self._segment_frames(segment), range(self.channels))
+
+    def _descrambled(self, segment, begin, end, channels):
+        # Original samples of the frames BEGIN to END of a scrambled segment: the whole windows holding them are read
+        # and descrambled
+        window_frames = self.scrambler.window_frames
+        first_window = begin // window_frames
+        window_begin = first_window * window_frames
+        window_end = min(-(-end // window_frames) * window_frames, self._segment_frames(segment))
+        stored_channels = self.scrambler.stored_channels(segment, range(self.channels))
+        # Only the stored channels holding CHANNELS are decompressed
+        needed = sorted({stored_channels[channel] for channel in channels})
+        stored = np.zeros((window_end - window_begin, self.channels), dtype=self.dtype)
+        stored[:, needed] = self._stored(segment, window_begin, window_end, needed)
+
+        samples = np.empty_like(stored)
+        for window, start in enumerate(range(0, len(stored), window_frames), first_window):
+            samples[start:start + window_frames] = self.scrambler.descramble(stored[start:start + window_frames],
+                                                                             segment, window)
+        return samples[begin - window_begin:end - window_begin][:, channels]
+
+    def blocks(self):
+        # Yield the samples (frames, channels) of every block, in recording order. Scrambled recordings are yielded
+        # segment by segment
+        if self.scrambler is not None:
+            for segment in dict.fromkeys(self.index['segment'].tolist()):
+                frames = self._segment_frames(segment)
+                yield self._descrambled(segment, 0, frames, range(self.channels))
+            return
+        for block in self.index:
+            yield np.stack([self._channel(block, channel) for channel in range(self.channels)], axis=1)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def finish_recompression(filename):
+    # Complete the replacement of a container by its recompressed copy, if it was interrupted (e.g. power failure).
+    # The copy is complete once its index is renamed: before that, the partial copy is removed
+    if os.path.exists(filename + INDEX_SUFFIX + RECOMPRESSED_SUFFIX):
+        if os.path.exists(filename + RECOMPRESSED_SUFFIX):
+            os.replace(filename + RECOMPRESSED_SUFFIX, filename)
+        os.replace(filename + INDEX_SUFFIX + RECOMPRESSED_SUFFIX, filename + INDEX_SUFFIX)
+        return
+    for leftover in (filename + RECOMPRESSED_SUFFIX, filename + '.tmp', filename + '.tmp' + INDEX_SUFFIX):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+def recompress_container(filename, codec, proceed=None):
+    # Compress again every block of a container with CODEC (e.g. a slower codec with a higher ratio). The blocks keep
+    # their frames and segments, and scrambled segments stay scrambled. PROCEED is called before every block: if it
+    # returns False, the recompression is abandoned. Return the sizes (before, after) of the container, None if it was
+    # abandoned
+    finish_recompression(filename)
+    temporary = filename + '.tmp'
+    with ContainerReader(filename, stored=True) as reader:
+        writer = ContainerWriter(temporary, reader.channels, reader.dtype.itemsize, reader.rate, codec,
+                                 reader.block_frames / reader.rate, reader.start_time)
+        try:
+            for block in reader.index:
+                if proceed is not None and not proceed():
+                    writer.close()
+                    finish_recompression(filename)
+                    return None
+                segment, segment_frame = (int(block['segment']), int(block['segment_frame'])) \
+                    if reader.version >= 2 else (0, 0)
+                writer._write_block(int(block['start']), int(block['frames']),
+                                    [encode_samples(reader._channel(block, channel)[:, None], reader.rate, codec)
+                                     for channel in range(reader.channels)], segment, segment_frame)
+            writer.sync()
+        finally:
+            writer.close()
+
+    # The copy replaces the container in two renames: once the index of the copy is renamed, the replacement is
+    # completed by finish_recompression() even after a crash
+    sizes = (os.path.getsize(filename), os.path.getsize(temporary))
+    os.replace(temporary, filename + RECOMPRESSED_SUFFIX)
+    os.replace(temporary + INDEX_SUFFIX, filename + INDEX_SUFFIX + RECOMPRESSED_SUFFIX)
+    finish_recompression(filename)
+    return sizes
+
+
+def container_codec(filename):
+    with open(filename, 'rb') as f:
+        return _read_header(f)[0]
+
+
+if __name__ == '__main__':
+    # Usage: python -m Processes.recording_container <data.mchr> <start (s)> <duration (s)> <channels, e.g. 0,3>
+    # <output .wav file> [key file of scrambled recordings]
+    with ContainerReader(sys.argv[1], read_key(sys.argv[6]) if len(sys.argv) > 6 else None) as reader:
+        selected = [int(channel) for channel in sys.argv[4].split(',')] if sys.argv[4] != 'all' else None
+        write_wav(sys.argv[5], reader.read(float(sys.argv[2]), float(sys.argv[3]), selected), reader.rate)
@@ -0,0 +1,235 @@
+"""This part of the code defines the shared memory ring buffer used to move the recorded frames from the record process
+to the save process without pickling them and without passing through a pipe.
+"""
+import ctypes
+import multiprocessing
+import os
+import time
+from collections import namedtuple
+from multiprocessing.connection import wait
+
+# A chunk read from the ring buffer. DATA is a memoryview on the shared memory (valid until the chunk is released),
+# LOST_FRAMES is the number of frames that were lost just before this chunk (e.g. because the ring was full) and
+# TIMESTAMP the time.monotonic() value when the chunk was put in the ring. ADC_TIME is the time when the ADC acquired
+# the first frame of the chunk, as given by the source (0 if it is not known)
+RingChunk = namedtuple('RingChunk', ['seq', 'data', 'lost_frames', 'timestamp', 'adc_time'], defaults=(0.0,))
+
+
+class RingWakeup:
+    """wake-up of a process waiting for the chunks of one or several ring buffers
+
+    The producers write a byte in a non-blocking pipe, only while the process is waiting: the audio callback never
+    takes a lock, and it does not make a system call for every chunk. The same wake-up can be shared by several ring
+    buffers (e.g. the rings of the boards read by the merge process).
+
+    """
+    def __init__(self):
+        self._waiting = multiprocessing.RawValue(ctypes.c_bool, False)  # True while the process sleeps
+        self._reader, self._writer = multiprocessing.Pipe(duplex=False)
+        # A full pipe already wakes up the process: the producers never block on it, nor the process when it drains it
+        os.set_blocking(self._writer.fileno(), False)
+        os.set_blocking(self._reader.fileno(), False)
+
+    def notify(self):
+        if self._waiting.value:
+            try:
+                os.write(self._writer.fileno(), b'\0')
+            except BlockingIOError:
+                pass
+
+    def _drain(self):
+        try:
+            while os.read(self._reader.fileno(), 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def wait(self, ready, timeout=None):
+        # Block until READY() returns True or the timeout expires. Return READY()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._waiting.value = True
+        try:
+            while not ready():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                if wait([self._reader], remaining):
+                    self._drain()
+            return True
+        finally:
+            self._waiting.value = False
+
+
+class SharedRingBuffer:
+    """single producer / single consumer ring buffer in shared memory
+
+    The producer (the PortAudio callback) copies every chunk straight into a fixed-size slot and publishes it by
+    advancing the head counter. The consumer reads ranges of published slots as memoryviews and frees them by
+    advancing the tail counter. No lock is needed: the head is written only by the producer and the tail only by the
+    consumer.
+    If the ring is full, the new chunk is dropped and counted as an overrun. Its frames are attached to the next chunk
+    that is published, so the consumer knows exactly where data are missing.
+    Other processes can observe the published chunks with observe(): they do not advance the tail, so a slow observer
+    loses chunks instead of slowing down the producer or the consumer. An observer registered with add_observer()
+    (before the processes are started) sleeps in wait_observed() until new chunks are published.
+    The consumer sleeps on WAKEUP, which may be shared with other ring buffers (a new one by default).
+
+    """
+    def __init__(self, n_slots, slot_size, frame_size, wakeup=None):
+        self.n_slots = n_slots
+        self.slot_size = slot_size
+        self.frame_size = frame_size
+
+        self._data = multiprocessing.RawArray(ctypes.c_char, n_slots * slot_size)
+        self._lengths = multiprocessing.RawArray(ctypes.c_uint32, n_slots)  # Bytes stored in each slot
+        self._seqs = multiprocessing.RawArray(ctypes.c_uint64, n_slots)  # Sequence number of the chunk in each slot
+        self._lost = multiprocessing.RawArray(ctypes.c_uint64, n_slots)  # Frames lost before the chunk in each slot
+        self._times = multiprocessing.RawArray(ctypes.c_double, n_slots)  # Time when each slot was written
+        self._adc_times = multiprocessing.RawArray(ctypes.c_double, n_slots)  # ADC time of the chunk in each slot
+        self._head = multiprocessing.RawValue(ctypes.c_uint64, 0)  # Next sequence number to write (producer only)
+        self._tail = multiprocessing.RawValue(ctypes.c_uint64, 0)  # Next sequence number to read (consumer only)
+        self._overruns = multiprocessing.RawValue(ctypes.c_uint64, 0)  # Chunks dropped because the ring was full
+        self._high_water = multiprocessing.RawValue(ctypes.c_uint64, 0)  # Highest occupancy seen by the producer
+        self._wakeup = wakeup if wakeup is not None else RingWakeup()  # Wake-up of the consumer
+        self._observers = []  # Wake-ups of the observers
+
+        # Process-local state: the memoryview on the shared memory is created lazily in each process
+        self._view = None
+        self._pending_lost = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_view'] = None
+        return state
+
+    def _buffer(self):
+        if self._view is None:
+            self._view = memoryview(self._data).cast('B')
+        return self._view
+
+    @property
+    def overruns(self):
+        return self._overruns.value
+
+    @property
+    def high_water(self):
+        return self._high_water.value
+
+    def occupancy(self):
+        # Number of chunks published and not yet released
+        return self._head.value - self._tail.value
+
+    # ------------------------------------------------------------------------
+    # Producer side
+    # ------------------------------------------------------------------------
+    def put(self, data, adc_time=0.0):
+        head = self._head.value
+        size = len(data)
+
+        # If the consumer did not free any slot, the chunk is dropped. It never blocks the caller
+        if head - self._tail.value >= self.n_slots:
+            self._overruns.value += 1
+            self._pending_lost += size // self.frame_size
+            return False
+
+        slot = head % self.n_slots
+        offset = slot * self.slot_size
+        self._buffer()[offset:offset + size] = data
+        self._lengths[slot] = size
+        self._lost[slot] = self._pending_lost
+        self._times[slot] = time.monotonic()
+        self._adc_times[slot] = adc_time
+        self._seqs[slot] = head
+        self._pending_lost = 0
+
+        occupancy = head + 1 - self._tail.value
+        if occupancy > self._high_water.value:
+            self._high_water.value = occupancy
+
+        # Publish the chunk, then wake up the consumer and the observers which are sleeping
+        self._head.value = head + 1
+        self._wakeup.notify()
+        for observer in self._observers:
+            observer.notify()
+        return True
+
+    def mark_gap(self, n_frames):
+        # Frames missing from the source (e.g. while the device was reconnected). They are reported with the next
+        # chunk, like the frames lost by an overrun
+        self._pending_lost += n_frames
+
+    # ------------------------------------------------------------------------
+    # Consumer side
+    # ------------------------------------------------------------------------
+    def wait(self, timeout=None):
+        # Block until at least one chunk is available or the timeout expires
+        return self._wakeup.wait(lambda: self._head.value != self._tail.value, timeout)
+
+    def get_range(self, max_chunks=None, timeout=None):
+        # Return the published chunks (at most MAX_CHUNKS) without copying them. An empty list means that the
+        # timeout expired. The chunks must be released with release() once they have been consumed
+        tail = self._tail.value
+        available = self._head.value - tail
+        if available == 0:
+            if timeout == 0 or not self.wait(timeout):
+                return []
+            available = self._head.value - tail
+        if max_chunks is not None:
+            available = min(available, max_chunks)
+
+        view = self._buffer()
+        chunks = []
+        for seq in range(tail, tail + available):
+            slot = seq % self.n_slots
+            if self._seqs[slot] != seq:
+                raise BufferError('Ring buffer slot {} holds chunk {} instead of {}.'.format(slot, self._seqs[slot],
+                                                                                             seq))
+            offset = slot * self.slot_size
+            chunks.append(RingChunk(seq, view[offset:offset + self._lengths[slot]], self._lost[slot],
+                                    self._times[slot], self._adc_times[slot]))
+        return chunks
+
+    def release(self, n_chunks):
+        # Give back to the producer the slots of the first N_CHUNKS chunks read
+        self._tail.value += n_chunks
+
+    # ------------------------------------------------------------------------
+    # Observer side
+    # ------------------------------------------------------------------------
+    def add_observer(self):
+        # Register an observer and return its number, given to wait_observed(). Observers are registered before the
+        # processes are started, so that every process shares their wake-ups
+        self._observers.append(RingWakeup())
+        return len(self._observers) - 1
+
+    def wait_observed(self, seq, observer, timeout=None):
+        # Block the observer number OBSERVER until the chunk SEQ is published or the timeout expires
+        return self._observers[observer].wait(lambda: self._head.value > seq, timeout)
+
+    def observe(self, seq, max_chunks=None):
+        # Return the published chunks from sequence number SEQ, without taking them from the consumer: an observer
+        # (e.g. the DSP stage) never holds back the producer. The chunks already overwritten are skipped, so the first
+        # chunk returned may come after SEQ. The data must be checked with is_intact() once they have been used
+        head = self._head.value
+        first = max(seq, head - self.n_slots + 1)
+        last = head if max_chunks is None else min(head, first + max_chunks)
+        view = self._buffer()
+        chunks = []
+        for seq in range(first, last):
+            slot = seq % self.n_slots
+            if self._seqs[slot] != seq:
+                break
+            offset = slot * self.slot_size
+            chunks.append(RingChunk(seq, view[offset:offset + self._lengths[slot]], self._lost[slot],
+                                    self._times[slot], self._adc_times[slot]))
+        return chunks
+
+    def is_intact(self, seq):
+        # True if the producer has not started to overwrite the chunk SEQ (nor any later chunk)
+        return self._head.value < seq + self.n_slots
+
+
+def wait_any(rings, timeout=None):
+    # Block until one of RINGS has chunks to read or the timeout expires. The rings must share the wake-up of their
+    # consumer (the same RingWakeup given to all of them), otherwise only the first ring wakes up the process
+    return rings[0]._wakeup.wait(lambda: any(ring.occupancy() for ring in rings), timeout)
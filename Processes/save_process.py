@@ -1,89 +1,232 @@
-import wave
-import os
-import logging
-from CustomExceptions.custom_handlers import *
-
-# Initialize custom logger for multiprocessing logging
-process_logger = logging.getLogger('save_process')
-
-# Register handler for the SIGTERM signal
-signal.signal(signal.SIGTERM, sigterm_handler)
-
-
-def save_data(connection_error, disconnection_error, que1, que2, channels, format_size, rate, chunk, path):
-
-    try:
-        # Filename creation for partial data. Every minute one .wav file is saved
-        n_file = 1
-        filename = path + '/audio data minute ' + str(n_file)
-
-        # Queue and Stream initialization
-        record_seconds = 60  # Every 60 seconds data are saved
-        frames_per_window = int(rate / chunk * record_seconds)  # Number of frames per window of observation
-        frames_collected = 0  # Number of frames that have been collected
-
-        # Open wav file and set it up
-        w = wave.open(filename + '.wav', 'wb')
-        w.setnchannels(channels)
-        w.setsampwidth(format_size)
-        w.setframerate(rate)
-
-        # If the MCH Streamer is not connected, then the recording does not start
-        while connection_error.value is False and disconnection_error.value is False:
-            # Frames are extracted from the queue and written in the .wav file
-            if not que1.empty():
-                if frames_collected < frames_per_window:
-                    received_frame = que1.get()
-                    w.writeframes(received_frame)
-                    frames_collected += 1
-                else:
-                    # When the frames are collected, they are saved in the .wav file
-                    frames_collected = 0
-                    # Close the file
-                    w.close()
-
-                    # Send the filename to to the next process to be compressed
-                    que2.put(filename)
-                    n_file += 1
-
-                    # Open a new file
-                    filename = path + '/audio data minute ' + str(n_file)  # update filename
-                    w = wave.open(filename + '.wav', 'wb')
-                    w.setnchannels(channels)
-                    w.setsampwidth(format_size)
-                    w.setframerate(rate)
-
-        # If the MCH Streamer is not connected (from the beginning)
-        if connection_error.value is True:
-            raise StreamConnectionError
-
-        # If the Streamer board was disconnected during the recording or the stream connection was interrupted
-        if disconnection_error.value is True:
-            raise DisconnectionError
-
-    except (KeyboardInterrupt, DisconnectionError):
-        # If SIGINT or SIGTERM signal occurred or the connection was interrupted, the process completes the ongoing
-        # tasks and terminates.
-
-        # If the observed window is not empty, left frames are permuted and
-        # the saved, even if the number is < target
-        while not que1.empty():
-            received_frame = que1.get()
-            w.writeframes(received_frame)
-            que2.put(filename)
-            process_logger.info('Data are stored in the directory %s' % path)
-
-    except StreamConnectionError:
-        # If the MCH Streamer is not well connected at the beginning, the process terminates and
-        #  the .wav file is not saved
-        os.remove(filename + '.wav')
-        process_logger.error('Stream connection error: no audio data were saved.')
-
-    except SystemExit:
-        # If SIGINT or SIGTERM signal occurred or the connection was interrupted, the process completes the ongoing
-        # tasks and terminates.
-        pass
-
-    finally:
-        # Close .wav file
-        w.close()
+import os
+import logging
+import queue
+from Processes.wav_writer import *
+from Processes.scrambling import ScramblingSegmentWriter
+from Processes.integrity import CHECKSUM_SECONDS, SessionManifest
+from Processes.session_journal import *
+from Processes.shutdown import END_OF_SEGMENTS, SHUTDOWN_TIMEOUT, follow_shutdown, stopping
+from CustomExceptions.custom_handlers import *
+
+# Initialize custom logger for multiprocessing logging
+process_logger = logging.getLogger('save_process')
+
+# Register handler for the SIGTERM signal
+signal.signal(signal.SIGTERM, sigterm_handler)
+
+RING_TIMEOUT = 0.5  # Seconds waited for new frames before checking the error flags again
+QUEUE_TIMEOUT = 5  # Seconds waited for the compression process while recording, when the queue of the files is full
+
+
+def send(que2, item, shutdown=None, timeout=None):
+    # Put ITEM in the queue of the compression process, waiting at most TIMEOUT seconds (None: no limit) while the queue
+    # is full. During a shutdown the wait is bounded by its deadline. Return True if the item was sent
+    if stopping(shutdown):
+        timeout = shutdown.remaining()
+    try:
+        que2.put(item, timeout=timeout)
+    except queue.Full:
+        return False
+    return True
+
+
+def open_segment(filename, n_file, channels, format_size, rate, frames, fsync_period, latency, scrambler):
+    # Writer of the .wav file of a segment. If a SCRAMBLER is given, the frames are scrambled before they are written.
+    # The checksums of the data are computed while they are written
+    checksum_frames = max(1, int(CHECKSUM_SECONDS * rate))
+    if scrambler is not None:
+        return ScramblingSegmentWriter(filename + '.wav', channels, format_size, rate, frames, scrambler, n_file,
+                                       fsync_period, latency=latency, checksum_frames=checksum_frames)
+    return SegmentWriter(filename + '.wav', channels, format_size, rate, frames, fsync_period, latency=latency,
+                         checksum_frames=checksum_frames)
+
+
+def mark_inactive(w, gate, metrics):
+    # Mark in the segment the silent frames skipped by the activity gate
+    frames, levels = gate.skipped()
+    if frames:
+        w.mark_gap(frames, levels)
+        if metrics is not None:
+            metrics.add('frames_inactive', frames)
+
+
+def write_chunk(w, gate, received_chunk, metrics):
+    # Write a chunk in the segment. With the activity gate, the chunks of the events (with their pre-roll) are written
+    # and the silent chunks are skipped
+    if gate is None:
+        stored = [(received_chunk.data, received_chunk.timestamp)]
+    else:
+        events = gate.events
+        stored = gate.process(received_chunk.data, received_chunk.timestamp)
+        if stored:
+            mark_inactive(w, gate, metrics)
+        if metrics is not None and gate.events > events:
+            metrics.add('activity_events')
+    for data, timestamp in stored:
+        w.write(data, timestamp)
+        if metrics is not None:
+            metrics.add('bytes_written', len(data))
+
+
+def save_data(connection_error, disconnection_error, ring, que2, channels, format_size, rate, chunk, path,
+              fsync_period=0, record_seconds=60, metrics=None, journal=None, scrambler=None, activity_gate=None,
+              shutdown=None):
+
+    # SIGINT is left to the main process and SIGTERM starts the shutdown: a signal never interrupts a write
+    follow_shutdown(shutdown)
+
+    try:
+        # Filename creation for partial data. Every minute one .wav file is saved
+        n_file = 1
+        filename = path + '/audio data minute ' + str(n_file)
+
+        # Queue and Stream initialization. Every RECORD_SECONDS seconds (60 by default) data are saved
+        # Number of audio frames per window of observation (a whole number of chunks)
+        frames_per_window = int(rate / chunk * record_seconds) * chunk
+
+        # Open wav file and set it up. The file is preallocated for the whole window. The journal records the
+        # segment before the file is created
+        disk_latency = metrics.disk_latency if metrics is not None else None
+        # The checksums of every segment are appended to the manifest of the session when the segment is closed
+        manifest = SessionManifest(path)
+        if journal is not None:
+            journal.record(OPENED, os.path.basename(filename))
+        w = open_segment(filename, n_file, channels, format_size, rate, frames_per_window, fsync_period,
+                         disk_latency, scrambler)
+        segment_start = None  # Capture time of the first chunk of the segment
+        segment_frames = 0  # Frames received in the segment (stored or skipped by the activity gate)
+
+        def unsent(filename):
+            # The segment is recorded as deferred in the journal: the compression process takes it from the journal
+            # when the recording ends, or it is compressed at the next start
+            if journal is not None:
+                journal.record(DEFERRED, os.path.basename(filename))
+            if stopping(shutdown):
+                process_logger.warning('{} could not be sent to the compression process before the deadline of the '
+                                       'shutdown: it will be compressed at the next start.'
+                                       .format(os.path.basename(filename)))
+            else:
+                process_logger.warning('{} could not be sent to the compression process within {} s: it will be '
+                                       'compressed at the end of the recording.'
+                                       .format(os.path.basename(filename), QUEUE_TIMEOUT))
+
+        def store(chunks):
+            # Write the chunks read from the ring buffer in the segments
+            nonlocal filename, n_file, w, segment_start, segment_frames
+            for received_chunk in chunks:
+                if segment_frames >= frames_per_window:
+                    # When the frames are collected, they are saved in the .wav file. The silence at the end of the
+                    # segment is marked
+                    if activity_gate is not None:
+                        activity_gate.discard()
+                        mark_inactive(w, activity_gate, metrics)
+                    # Close the file
+                    w.close()
+                    manifest.record(os.path.basename(filename), w.checksums())
+
+                    if metrics is not None:
+                        metrics.add('segments_written')
+                    if journal is not None:
+                        journal.record(CLOSED, os.path.basename(filename))
+
+                    # Send the filename to to the next process to be compressed. When the queue is full, the process
+                    # waits for the compression process at most QUEUE_TIMEOUT seconds, so that the ring buffer does
+                    # not overrun while the compression process is stuck
+                    if send(que2, (filename, segment_start), shutdown, QUEUE_TIMEOUT):
+                        if journal is not None:
+                            journal.record(QUEUED, os.path.basename(filename))
+                    else:
+                        unsent(filename)
+                    n_file += 1
+
+                    # Open a new file
+                    filename = path + '/audio data minute ' + str(n_file)  # update filename
+                    if journal is not None:
+                        journal.record(OPENED, os.path.basename(filename))
+                    w = open_segment(filename, n_file, channels, format_size, rate, frames_per_window, fsync_period,
+                                     disk_latency, scrambler)
+                    segment_start = None
+                    segment_frames = 0
+
+                if received_chunk.lost_frames:
+                    # The missing frames (ring buffer overrun or reconnection of the device) are marked in the segment
+                    process_logger.warning('{} frames lost before chunk {}.'.format(received_chunk.lost_frames,
+                                                                                    received_chunk.seq))
+                    if activity_gate is not None:
+                        activity_gate.discard()
+                        mark_inactive(w, activity_gate, metrics)
+                    w.mark_gap(received_chunk.lost_frames)
+                    if metrics is not None:
+                        metrics.add('frames_lost', received_chunk.lost_frames)
+                if segment_start is None:
+                    segment_start = received_chunk.timestamp
+                write_chunk(w, activity_gate, received_chunk, metrics)
+                segment_frames += len(received_chunk.data) // (channels * format_size)
+            ring.release(len(chunks))
+
+        def flush():
+            # The recording is ending: the frames left in the ring buffer are saved, even if the segment is shorter than
+            # the window, and the segment is sent to the compression process once, followed by the end of the segments
+            if shutdown is not None:
+                # The frames are read until the record processes (and the merge process) have stopped
+                shutdown.wait_phase('merge')
+            chunks = ring.get_range(timeout=0)
+            while chunks:
+                store(chunks)
+                chunks = ring.get_range(timeout=0)
+            if activity_gate is not None:
+                activity_gate.discard()
+                mark_inactive(w, activity_gate, metrics)
+            # The header of the segment is fixed up and the segment is forced on the disk
+            w.close(sync=True)
+            if segment_frames == 0:
+                # No frame was received after the last segment: the empty file is not kept
+                os.remove(filename + '.wav')
+            else:
+                manifest.record(os.path.basename(filename), w.checksums())
+                if metrics is not None:
+                    metrics.add('segments_written')
+                if journal is not None:
+                    journal.record(CLOSED, os.path.basename(filename))
+                # The queue of the files to compress is bounded: the wait for the compression process is bounded too
+                if send(que2, (filename, segment_start), shutdown, SHUTDOWN_TIMEOUT):
+                    if journal is not None:
+                        journal.record(QUEUED, os.path.basename(filename))
+                else:
+                    unsent(filename)
+            send(que2, END_OF_SEGMENTS, shutdown, SHUTDOWN_TIMEOUT)
+            process_logger.info('Data are stored in the directory %s' % path)
+
+        # If the MCH Streamer is not connected, then the recording does not start
+        while connection_error.value is False and disconnection_error.value is False and not stopping(shutdown):
+            # Frames are read from the ring buffer and written in the .wav file
+            store(ring.get_range(timeout=RING_TIMEOUT))
+
+        # If the MCH Streamer is not connected (from the beginning)
+        if connection_error.value is True:
+            raise StreamConnectionError
+
+        # The recording is ending: because of a shutdown, or because the Streamer board was disconnected during the
+        # recording or the stream connection was interrupted
+        flush()
+
+    except KeyboardInterrupt:
+        # Without a shutdown control, SIGINT ends the recording: the process completes the ongoing tasks and
+        # terminates
+        flush()
+
+    except StreamConnectionError:
+        # If the MCH Streamer is not well connected at the beginning, the process terminates and
+        #  the .wav file is not saved
+        os.remove(filename + '.wav')
+        process_logger.error('Stream connection error: no audio data were saved.')
+
+    except SystemExit:
+        # If SIGTERM signal occurred (without a shutdown control), the process terminates: the segment is left in the
+        # journal and compressed at the next start
+        pass
+
+    finally:
+        # Close .wav file and the manifest of the session
+        w.close()
+        manifest.close()
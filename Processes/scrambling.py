@@ -0,0 +1,208 @@
+"""This part of the code defines the scrambling of the recorded segments. Before they are written on the disk, the
+frames of every segment are permuted in blocks of BLOCK_FRAMES frames (and optionally the channels are permuted), so
+that the .wav files and the archive cannot be listened to without the key of the recordings.
+
+The blocks are permuted within windows of WINDOW_BLOCKS blocks (about one second of audio), so the save process keeps
+only one window in memory. The permutations of a segment depend on the key, on a random number chosen for every
+session (stored with the scrambling settings in the session folder) and on the number of the segment: they are
+computed once when the segment is opened and applied with a single NumPy gather per window. The descrambler uses the
+inverse permutations.
+"""
+import hashlib
+import hmac
+import json
+import os
+
+import numpy as np
+
+from Processes.audio_codecs import SAMPLE_TYPES
+from Processes.wav_writer import SegmentWriter
+
+SCRAMBLING_NAME = 'scrambling.json'  # Settings of the scrambling of a session, in the session folder
+KEY_ENVIRONMENT = 'MCH_SCRAMBLE_KEY'  # Environment variable with the path of the key file
+BLOCK_FRAMES = 256  # Frames of the blocks which are permuted
+WINDOW_BLOCKS = 128  # Blocks permuted together
+
+
+def read_key(filename):
+    # Key of the recordings stored in FILENAME (any binary content, e.g. 32 random bytes), None if there is no key
+    if not filename or not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as f:
+        key = f.read()
+    if not key:
+        raise ValueError('The scrambling key {} is empty.'.format(filename))
+    return key
+
+
+def is_scrambled(path):
+    # True if the segments of the session folder PATH are scrambled
+    return os.path.exists(os.path.join(path, SCRAMBLING_NAME))
+
+
+class Scrambler:
+    """keyed and reversible permutation of the blocks and of the channels of the segments
+
+    The permutations of a segment are drawn from a generator seeded with an HMAC of the session nonce and of the
+    segment number, so they can only be computed with the key. The permutation of the blocks of a window is the order
+    of random keys: a shorter (last) window uses the order of its first keys.
+
+    """
+    def __init__(self, key, nonce, channels, block_frames=BLOCK_FRAMES, window_blocks=WINDOW_BLOCKS,
+                 scramble_channels=True):
+        self.channels = channels
+        self.block_frames = block_frames
+        self.window_blocks = window_blocks
+        self.window_frames = block_frames * window_blocks
+        self.scramble_channels = scramble_channels
+        self._key = key
+        self._nonce = nonce
+        self._segment = None  # Number of the segment whose permutations are cached
+        self._keys = np.empty((0, window_blocks))
+
+    @classmethod
+    def create(cls, key, path, channels, block_frames=BLOCK_FRAMES, window_blocks=WINDOW_BLOCKS,
+               scramble_channels=True):
+        # New scrambler for the session folder PATH. Its settings (not the key) are stored in the folder
+        scrambler = cls(key, os.urandom(16), channels, block_frames, window_blocks, scramble_channels)
+        with open(os.path.join(path, SCRAMBLING_NAME), 'w') as f:
+            json.dump({'nonce': scrambler._nonce.hex(), 'key_id': scrambler.key_id, 'channels': channels,
+                       'block_frames': block_frames, 'window_blocks': window_blocks,
+                       'scramble_channels': scramble_channels}, f, indent=1)
+        return scrambler
+
+    @classmethod
+    def load(cls, key, path):
+        # Scrambler of the session folder PATH, None if its segments are not scrambled
+        if not is_scrambled(path):
+            return None
+        with open(os.path.join(path, SCRAMBLING_NAME)) as f:
+            settings = json.load(f)
+        if key is None:
+            raise ValueError('The recordings in {} are scrambled: the key is needed to read them.'.format(path))
+        scrambler = cls(key, bytes.fromhex(settings['nonce']), settings['channels'], settings['block_frames'],
+                        settings['window_blocks'], settings['scramble_channels'])
+        if not hmac.compare_digest(scrambler.key_id, settings['key_id']):
+            raise ValueError('The key does not match the key of the recordings in {}.'.format(path))
+        return scrambler
+
+    @property
+    def key_id(self):
+        # Public fingerprint of the key, used to detect a wrong key
+        return hmac.new(self._key, self._nonce + b'key', hashlib.sha256).hexdigest()[:16]
+
+    def _seeds(self, segment):
+        digest = hmac.new(self._key, self._nonce + segment.to_bytes(4, 'little'), hashlib.sha256).digest()
+        return np.random.SeedSequence(int.from_bytes(digest, 'little')).spawn(2)
+
+    def prepare(self, segment, frames):
+        # Compute the permutations of a segment of (at most) FRAMES frames. They are computed again only if the
+        # segment changes or is longer
+        n_windows = max(1, -(-frames // self.window_frames))
+        if segment == self._segment and len(self._keys) >= n_windows:
+            return
+        channel_seed, block_seed = self._seeds(segment)
+        if self.scramble_channels:
+            self._channel_order = np.random.default_rng(channel_seed).permutation(self.channels)
+        else:
+            self._channel_order = np.arange(self.channels)
+        self._channel_inverse = np.argsort(self._channel_order)
+        # The keys are drawn window by window from the same stream: more windows do not change the first ones
+        self._keys = np.random.default_rng(block_seed).random((n_windows, self.window_blocks))
+        self._orders = np.argsort(self._keys, axis=1)
+        self._inverses = np.argsort(self._orders, axis=1)
+        self._segment = segment
+
+    def _block_order(self, segment, window, n_blocks, inverse):
+        self.prepare(segment, (window + 1) * self.window_frames)
+        if n_blocks == self.window_blocks:
+            return self._inverses[window] if inverse else self._orders[window]
+        order = np.argsort(self._keys[window, :n_blocks])
+        return np.argsort(order) if inverse else order
+
+    def _permute(self, samples, segment, window, inverse):
+        # Permute the blocks of one window SAMPLES (frames, channels). The frames after the last whole block are not
+        # permuted
+        samples = np.ascontiguousarray(samples)
+        n_blocks = len(samples) // self.block_frames
+        whole = n_blocks * self.block_frames
+        order = self._block_order(segment, window, n_blocks, inverse)
+        output = np.empty_like(samples, order='C')
+        # Gather of whole blocks: every block is a contiguous row of the window
+        np.take(samples[:whole].reshape(n_blocks, -1), order, axis=0, out=output[:whole].reshape(n_blocks, -1))
+        output[whole:] = samples[whole:]
+        if self.scramble_channels:
+            output = np.take(output, self._channel_inverse if inverse else self._channel_order, axis=1)
+        return output
+
+    def scramble(self, samples, segment, window):
+        # Scrambled copy of the window number WINDOW of a segment (at most window_frames frames)
+        return self._permute(samples, segment, window, inverse=False)
+
+    def descramble(self, samples, segment, window):
+        # Original frames of the scrambled window number WINDOW of a segment
+        return self._permute(samples, segment, window, inverse=True)
+
+    def descramble_segment(self, samples, segment):
+        # Original frames of a whole scrambled segment (frames, channels)
+        self.prepare(segment, len(samples))
+        output = np.empty_like(samples)
+        for window, start in enumerate(range(0, len(samples), self.window_frames)):
+            output[start:start + self.window_frames] = \
+                self.descramble(samples[start:start + self.window_frames], segment, window)
+        return output
+
+    def stored_channels(self, segment, channels):
+        # Positions in the scrambled segment of the original CHANNELS
+        self.prepare(segment, 0)
+        return [int(self._channel_inverse[channel]) for channel in channels]
+
+
+class ScramblingSegmentWriter(SegmentWriter):
+    """writer of a scrambled .wav segment
+
+    Chunks are collected in a window, which is scrambled and written when it is full. The last window of the segment
+    may be shorter. The gaps and the frames written count the frames in their original order. The checksums are
+    computed on the scrambled data, as they are stored.
+
+    """
+    def __init__(self, filename, channels, sample_width, rate, expected_frames, scrambler, segment, fsync_period=0,
+                 latency=None, checksum_frames=0):
+        SegmentWriter.__init__(self, filename, channels, sample_width, rate, expected_frames, fsync_period,
+                               latency=latency, checksum_frames=checksum_frames)
+        self.scrambler = scrambler
+        self.segment = segment
+        scrambler.prepare(segment, expected_frames)
+        self._window = bytearray(scrambler.window_frames * self.frame_size)
+        self._window_fill = 0  # Bytes waiting in the window
+        self._window_number = 0
+        self._window_time = None  # Capture time of the first chunk of the window
+
+    def write(self, data, timestamp=None):
+        view = memoryview(data).cast('B')
+        if self._window_time is None:
+            self._window_time = timestamp
+        while view:
+            size = min(len(view), len(self._window) - self._window_fill)
+            self._window[self._window_fill:self._window_fill + size] = view[:size]
+            self._window_fill += size
+            view = view[size:]
+            if self._window_fill == len(self._window):
+                self._write_window()
+                if view:
+                    self._window_time = timestamp
+        self.frames_written += len(data) // self.frame_size
+
+    def _write_window(self):
+        samples = np.frombuffer(self._window, dtype=SAMPLE_TYPES[self.sample_width],
+                                count=self._window_fill // self.sample_width).reshape(-1, self.channels)
+        scrambled = self.scrambler.scramble(samples, self.segment, self._window_number)
+        self._write_data(memoryview(scrambled).cast('B'), self._window_time)
+        self._window_number += 1
+        self._window_fill = 0
+        self._window_time = None
+
+    def close(self, sync=False):
+        if self._fd is not None and self._window_fill:
+            self._write_window()
+        SegmentWriter.close(self, sync)
@@ -0,0 +1,90 @@
+"""This part of the code defines the journal of a recording session. Every process appends to the journal the changes
+of state of the segments (opened, closed, queued for compression, compressed or deferred to the next start) and the
+main process records the shutdown and when the log file is moved to the session folder. The Recordings folder holds
+a pointer to the last session, so after a crash only the journal of that session is read to know which work was not
+completed.
+"""
+import json
+import os
+import time
+
+JOURNAL_NAME = 'journal.log'  # Journal of a session, in the session folder
+LAST_SESSION_NAME = 'last_session'  # Name of the folder of the last session, in the Recordings folder
+
+# States recorded in the journal
+STARTED = 'STARTED'  # The session started (with its settings)
+OPENED = 'OPENED'  # The .wav file of the segment was created
+CLOSED = 'CLOSED'  # All the frames of the segment were written
+QUEUED = 'QUEUED'  # The segment was sent to the compression process
+COMPRESSED = 'COMPRESSED'  # The segment is stored in the archive (its .wav file can be removed)
+DEFERRED = 'DEFERRED'  # The segment was not stored (or not sent to the compression process) in time: it is stored later
+STOPPED = 'STOPPED'  # The processes stopped (with the time spent in every phase of the shutdown)
+LOG_MOVED = 'LOG_MOVED'  # The log file was moved to the session folder: the session is complete
+
+
+class SessionJournal:
+    """append-only journal of a recording session
+
+    Each record is one line (time, state, segment, settings) written with a single write on a file opened in append
+    mode, so that the records of the different processes are never mixed, and forced on the disk. Records are written
+    a few times per segment only.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.filename = os.path.join(path, JOURNAL_NAME)
+        self._fd = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fd'] = None
+        return state
+
+    def start(self, settings):
+        # Record the start of the session and make it the last session of the Recordings folder
+        self.record(STARTED, settings=settings)
+        recordings = os.path.dirname(self.path)
+        with open(os.path.join(recordings, LAST_SESSION_NAME + '.tmp'), 'w') as f:
+            f.write(os.path.basename(self.path))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(os.path.join(recordings, LAST_SESSION_NAME + '.tmp'), os.path.join(recordings, LAST_SESSION_NAME))
+
+    def record(self, state, segment='', settings=None):
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self._pid = os.getpid()
+        line = '{:.3f}\t{}\t{}\t{}\n'.format(time.time(), state, segment, json.dumps(settings) if settings else '')
+        os.write(self._fd, line.encode())
+        os.fsync(self._fd)
+
+    def read(self):
+        # Return the records of the journal as (time, state, segment, settings). A line cut by a crash is ignored
+        records = []
+        if not os.path.exists(self.filename):
+            return records
+        with open(self.filename) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if not line.endswith('\n') or len(fields) != 4:
+                    continue
+                records.append((float(fields[0]), fields[1], fields[2], json.loads(fields[3]) if fields[3] else None))
+        return records
+
+    def close(self):
+        if self._fd is not None and self._pid == os.getpid():
+            os.close(self._fd)
+        self._fd = None
+
+
+def last_session(recordings_path):
+    # Journal of the last session of the Recordings folder, None if there is none
+    try:
+        with open(os.path.join(recordings_path, LAST_SESSION_NAME)) as f:
+            name = f.read().strip()
+    except OSError:
+        return None
+    if not name or not os.path.isdir(os.path.join(recordings_path, name)):
+        return None
+    return SessionJournal(os.path.join(recordings_path, name))
@@ -0,0 +1,149 @@
+"""This part of the code defines the shutdown of the recording, bounded in time. When the recording has to end (SIGINT,
+SIGTERM, a process which failed, a full disk), the main process starts the shutdown and the processes stop in phases,
+each one after the phase before it, all within the same deadline:
+- record: the record processes close the streams;
+- merge: with several boards, the merge process merges the frames already received from the boards;
+- flush: the save process writes the frames left in the ring buffer, closes the last segment (its header is fixed up
+  and it is forced on the disk) and sends it to the compression process, followed by the end of the segments;
+- compress: the compression process stores every segment once, until the deadline. The segments which are not stored
+  in time are recorded as DEFERRED in the journal and compressed at the next start (see CustomLogging/clean_up_log.py);
+- join: the other processes (DSP stage, live tap, recompression) end.
+The processes still running at the deadline are terminated. The time spent in every phase is logged and recorded in the
+journal of the session.
+The processes of the recording ignore SIGINT (the terminal sends it to all of them) and turn SIGTERM into a request of
+shutdown, so that a signal never interrupts them in the middle of a write or of an operation on the shared memory.
+"""
+import ctypes
+import logging
+import multiprocessing
+import signal
+import time
+
+from Processes.session_journal import STOPPED
+
+# Initialize custom logger for multiprocessing logging
+process_logger = logging.getLogger('shutdown')
+
+PHASES = ('record', 'merge', 'flush', 'compress', 'join')  # Phases of the shutdown, in order
+SHUTDOWN_TIMEOUT = 10  # Seconds the recording has to stop within, if no other deadline is given
+CLOSE_MARGIN = 0.5  # Seconds kept before the deadline to close the files
+KILL_GRACE = 1  # Seconds given to a process terminated at the deadline before it is killed
+POLL_PERIOD = 0.05  # Seconds between two checks of the end of a phase
+END_OF_SEGMENTS = None  # Sent by the save process to the compression process after the last segment
+
+
+class ShutdownControl:
+    """deadline and phases of the shutdown, shared by the processes of the recording
+
+    The shutdown is started with begin(), by the main process or by a process which received SIGTERM, and the deadline
+    is TIMEOUT seconds later. The end of every phase is marked by the main process with end_phase(). The times are
+    time.monotonic() values, which are the same in all the processes.
+
+    """
+    def __init__(self, timeout=SHUTDOWN_TIMEOUT):
+        self.timeout = timeout
+        self._start = multiprocessing.RawValue(ctypes.c_double, 0.0)  # Time when the shutdown started (0: recording)
+        self._ends = multiprocessing.RawArray(ctypes.c_double, len(PHASES))  # Time when every phase ended (0: not yet)
+        self._started = multiprocessing.Event()  # Set when the shutdown starts, to wake up the processes waiting for it
+
+    @property
+    def requested(self):
+        return self._start.value != 0.0
+
+    @property
+    def deadline(self):
+        return self._start.value + self.timeout if self.requested else None
+
+    def begin(self):
+        # Start the shutdown, if it did not start yet
+        if not self.requested:
+            self._start.value = time.monotonic()
+            self._started.set()
+
+    def wait(self, timeout=None):
+        # Sleep until the shutdown starts or the timeout expires. Return True if the shutdown started
+        return self._started.wait(timeout)
+
+    def remaining(self, margin=0):
+        # Seconds left before the deadline (minus MARGIN), None if the shutdown did not start
+        if not self.requested:
+            return None
+        return max(0.0, self.deadline - margin - time.monotonic())
+
+    def end_phase(self, phase):
+        index = PHASES.index(phase)
+        if self._ends[index] == 0.0:
+            self._ends[index] = time.monotonic()
+
+    def ended(self, phase):
+        return self._ends[PHASES.index(phase)] != 0.0
+
+    def wait_phase(self, phase):
+        # Wait until PHASE ends or the deadline expires. Return True if the phase ended
+        while not self.ended(phase):
+            if self.remaining() == 0:
+                return False
+            time.sleep(POLL_PERIOD)
+        return True
+
+    def elapsed(self):
+        # Seconds since the shutdown started
+        return time.monotonic() - self._start.value if self.requested else 0.0
+
+    def durations(self):
+        # Seconds spent in every phase which ended, from the end of the phase before it
+        durations = {}
+        previous = self._start.value
+        for index, phase in enumerate(PHASES):
+            if self._ends[index] == 0.0:
+                continue
+            durations[phase] = round(max(0.0, self._ends[index] - previous), 3)
+            previous = max(previous, self._ends[index])
+        return durations
+
+
+def stopping(shutdown):
+    # True if the shutdown of the recording started (SHUTDOWN is a ShutdownControl or None)
+    return shutdown is not None and shutdown.requested
+
+
+def follow_shutdown(shutdown):
+    # Signals of a process of the recording: SIGINT is left to the main process, SIGTERM starts the shutdown
+    if shutdown is None:
+        return
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: shutdown.begin())
+
+
+def stop_recording(supervisor, shutdown, phases, reason, journal=None):
+    # Stop the processes of the recording within the deadline of SHUTDOWN. PHASES gives the names of the processes of
+    # every phase: a phase ends when its processes end, the join phase when all the processes end. The processes still
+    # running at the deadline are terminated, then killed after KILL_GRACE seconds. The time spent in every phase is
+    # logged and recorded in the JOURNAL
+    shutdown.begin()
+    # The shutdown is bounded by its deadline: further signals do not interrupt it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    for phase in PHASES:
+        supervisor.join(shutdown.remaining(), None if phase == 'join' else phases.get(phase, []))
+        shutdown.end_phase(phase)
+
+    forced = [name for name in supervisor.names() if supervisor.is_alive(name)]
+    if forced:
+        process_logger.error('The deadline of the shutdown expired: terminating the processes {}.'
+                             .format(', '.join(forced)))
+        supervisor.terminate(forced)
+        supervisor.join(KILL_GRACE, forced)
+        for name in forced:
+            if supervisor.is_alive(name):
+                supervisor.kill(name)
+        supervisor.join(KILL_GRACE, forced)
+
+    durations = shutdown.durations()
+    elapsed = shutdown.elapsed()
+    process_logger.info('The processes stopped in {:.2f} s ({}).'.format(
+        elapsed, ', '.join('{} {:.2f} s'.format(phase, seconds) for phase, seconds in durations.items())))
+    if journal is not None:
+        journal.record(STOPPED, settings={'reason': reason, 'deadline': shutdown.timeout, 'seconds': round(elapsed, 3),
+                                          'phases': durations, 'forced': forced})
+    return durations, forced
@@ -0,0 +1,252 @@
+"""This part of the code defines the management of the disk where the recordings are stored. The storage manager is a
+thread of the main process: every PERIOD seconds it measures the bytes of every session of the Recordings folder and
+the free space of the disk, and projects the time left before the disk is full from the rate at which the free space
+decreases. The policy is enforced before the disk is exhausted:
+- the sessions older than RETENTION_DAYS and, if DELETE_OLDEST is set, the oldest sessions beyond the QUOTA of the
+  Recordings folder or needed to keep free the space of HORIZON seconds of recording, are deleted (never the session
+  being recorded);
+- if the free space gets lower than MIN_FREE bytes anyway, the recording is stopped cleanly, instead of failing in the
+  middle of a write.
+
+The segments are compressed with a fast codec while recording. The recompression process compresses the containers of
+the older sessions again with a codec with a higher ratio, at the lowest priority and only while the host is idle.
+"""
+import datetime
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from Processes.recording_container import CONTAINER_SUFFIX, container_codec, finish_recompression, \
+    recompress_container
+from Processes.shutdown import follow_shutdown, stopping
+from CustomExceptions.custom_handlers import *
+
+# Initialize custom logger for multiprocessing logging
+process_logger = logging.getLogger('storage_manager')
+
+MIN_FREE = 512 * 2 ** 20  # Bytes always left free on the disk
+HORIZON = 3600  # Seconds of recording whose space is kept free, at the current write rate
+RATE_WINDOW = 600  # Seconds over which the write rate is averaged
+RECOMPRESS_PERIOD = 60  # Seconds between two searches of the sessions to compress again
+IDLE_LOAD = 0.5  # Load average per core (besides the recompression itself) below which the host is idle
+IDLE_WAIT = 5  # Seconds waited before checking again if the host is idle
+SESSION_TIME_FORMAT = 'AudioRecorded_on%d%b%Y_at%H.%M.%S'  # Name of the folder of a session
+
+
+def session_time(path):
+    # Time (seconds since the epoch) when the session of the folder PATH started
+    try:
+        return datetime.datetime.strptime(os.path.basename(path), SESSION_TIME_FORMAT).timestamp()
+    except ValueError:
+        return os.path.getmtime(path)
+
+
+def sessions(recordings_path):
+    # Folders of the sessions of the Recordings folder, the oldest first
+    try:
+        paths = [entry.path for entry in os.scandir(recordings_path) if entry.is_dir()]
+    except OSError:
+        return []
+    return sorted(paths, key=session_time)
+
+
+def folder_size(path):
+    # Bytes used by the files of a folder (the space allocated on the disk, so the preallocated segments count whole)
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.stat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                # The file was removed in the meanwhile (e.g. a segment just compressed)
+                pass
+    return size
+
+
+class StorageManager:
+    """thread of the main process enforcing the disk budget of the recordings
+
+    The write rate is the rate at which the free space of the disk decreases, averaged over RATE_WINDOW seconds: it
+    includes the segments being written and the archive. The space needed is the larger of MIN_FREE and the bytes of
+    HORIZON seconds at that rate. When the recording has to stop, SHUTDOWN is called with the reason.
+
+    """
+    def __init__(self, recordings_path, session_path, metrics=None, shutdown=None, period=10, min_free=MIN_FREE,
+                 horizon=HORIZON, quota=0, retention_days=0, delete_oldest=False):
+        self.recordings_path = recordings_path
+        self.session_path = session_path
+        self.metrics = metrics
+        self.shutdown = shutdown
+        self.period = period
+        self.min_free = min_free
+        self.horizon = horizon
+        self.quota = quota
+        self.retention_days = retention_days
+        self.delete_oldest = delete_oldest
+        self.write_rate = None  # Bytes per second
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='storage', daemon=True)
+        self._previous = None  # (time, free bytes) of the previous check
+        self._state = {}
+        self._low = False  # True while the free space is lower than the space needed
+        self._full = False
+
+    def start(self):
+        self.check()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.period):
+            try:
+                self.check()
+            except OSError as error:
+                process_logger.warning('Storage check failed: {}'.format(error))
+
+    def _measure(self):
+        now = time.monotonic()
+        free = shutil.disk_usage(self.recordings_path).free
+        if self._previous is not None and now > self._previous[0]:
+            rate = max(0.0, (self._previous[1] - free) / (now - self._previous[0]))
+            # Exponential average over RATE_WINDOW seconds
+            weight = min(1.0, (now - self._previous[0]) / RATE_WINDOW)
+            self.write_rate = rate if self.write_rate is None else self.write_rate + weight * (rate - self.write_rate)
+        self._previous = (now, free)
+        return free
+
+    def needed_space(self):
+        # Free bytes needed to record HORIZON more seconds
+        return max(self.min_free, (self.write_rate or 0) * self.horizon)
+
+    def check(self):
+        free = self._measure()
+        session_sizes = {path: folder_size(path) for path in sessions(self.recordings_path)}
+        used = sum(session_sizes.values())
+
+        # Retention and quota: the oldest sessions are deleted first, the current session never
+        for path in list(session_sizes):
+            if os.path.abspath(path) == os.path.abspath(self.session_path):
+                continue
+            expired = self.retention_days and time.time() - session_time(path) > self.retention_days * 86400
+            over_budget = self.delete_oldest and (free < self.needed_space() or self.quota and used > self.quota)
+            if not expired and not over_budget:
+                continue
+            size = session_sizes.pop(path)
+            process_logger.warning('Deleting the session {} ({} bytes): {}.'.format(
+                os.path.basename(path), size, 'retention period expired' if expired else 'disk budget'))
+            shutil.rmtree(path, ignore_errors=True)
+            if self.metrics is not None:
+                self.metrics.add('sessions_deleted')
+            used -= size
+            free = shutil.disk_usage(self.recordings_path).free
+            self._previous = (time.monotonic(), free)
+
+        time_to_full = (free - self.min_free) / self.write_rate if self.write_rate else None
+        self._state = {'storage_free_bytes': free, 'storage_used_bytes': used,
+                       'storage_session_bytes': session_sizes.get(self.session_path, 0),
+                       'storage_sessions': len(session_sizes),
+                       'storage_write_bytes_per_second': self.write_rate or 0.0}
+        if time_to_full is not None:
+            self._state['storage_time_to_full_seconds'] = max(0.0, time_to_full)
+
+        # The state of the disk is logged when it changes
+        if (free < self.needed_space()) != self._low:
+            self._low = not self._low
+            if self._low:
+                process_logger.warning('{} bytes free on the disk: {} left at the current write rate.'.format(
+                    free, 'no time' if time_to_full is not None and time_to_full <= 0 else
+                    datetime.timedelta(seconds=int(time_to_full)) if time_to_full else 'no estimate of the time'))
+            else:
+                process_logger.info('{} bytes free on the disk.'.format(free))
+        if free < self.min_free and not self._full:
+            # Nothing else can be deleted: the recording is stopped while the last segment can still be written
+            self._full = True
+            process_logger.error('The disk is almost full ({} bytes free): the recording is stopped.'.format(free))
+            if self.shutdown is not None:
+                self.shutdown('the disk is almost full')
+
+    def snapshot(self):
+        return dict(self._state)
+
+
+def _lower_priority():
+    # The recompression runs at the lowest CPU priority, and at the idle I/O priority if ionice is available
+    os.nice(19)
+    if shutil.which('ionice'):
+        subprocess.run(['ionice', '-c', '3', '-p', str(os.getpid())], capture_output=True)
+
+
+def recompress_sessions(connection_error, disconnection_error, recordings_path, session_path, codec, metrics=None,
+                        shutdown=None):
+
+    # SIGINT is left to the main process and SIGTERM starts the shutdown (without a shutdown control, SIGTERM ends the
+    # process)
+    if shutdown is None:
+        signal.signal(signal.SIGTERM, sigterm_handler)
+    follow_shutdown(shutdown)
+
+    def recording():
+        # True until the recording ends
+        return connection_error.value is False and disconnection_error.value is False and not stopping(shutdown)
+
+    _lower_priority()
+    cpus = multiprocessing.cpu_count()
+
+    def pause(seconds):
+        # Sleep SECONDS, or until the shutdown starts. Without a shutdown control the flags are checked every second
+        if shutdown is not None:
+            shutdown.wait(seconds)
+            return
+        end = time.monotonic() + seconds
+        while recording() and time.monotonic() < end:
+            time.sleep(min(1.0, end - time.monotonic()))
+
+    def idle():
+        # The host is idle if its load is low and the compression process has no backlog. Otherwise the recompression
+        # waits
+        while recording():
+            backlog = 0
+            if metrics is not None:
+                backlog = metrics.get('segments_written') - metrics.get('segments_compressed')
+            if os.getloadavg()[0] < IDLE_LOAD * cpus + 1 and backlog <= 1:
+                return True
+            pause(IDLE_WAIT)
+        return False
+
+    try:
+        while recording():
+            for path in sessions(recordings_path):
+                container = os.path.join(path, 'data' + CONTAINER_SUFFIX)
+                if os.path.abspath(path) == os.path.abspath(session_path) or not os.path.exists(container):
+                    continue
+                try:
+                    finish_recompression(container)
+                    if container_codec(container) == codec:
+                        continue
+                    process_logger.info('Compressing {} again with {}.'.format(os.path.basename(path), codec))
+                    sizes = recompress_container(container, codec, idle)
+                except (OSError, ValueError) as error:
+                    # E.g. the session was deleted by the storage manager in the meanwhile
+                    process_logger.warning('Recompression of {} failed: {}'.format(os.path.basename(path), error))
+                    continue
+                if sizes is None:
+                    break
+                process_logger.info('{} compressed again with {}: {} -> {} bytes.'.format(os.path.basename(path),
+                                                                                       codec, *sizes))
+                if metrics is not None:
+                    metrics.add('sessions_recompressed')
+                    metrics.add('bytes_saved_by_recompression', max(0, sizes[0] - sizes[1]))
+            # The process sleeps until the next search, and ends as soon as the recording ends
+            pause(RECOMPRESS_PERIOD)
+
+    except (KeyboardInterrupt, SystemExit):
+        # The container being compressed again is left as it was
+        pass
@@ -1,54 +1,115 @@
-import ctypes
-import logging
-import pyaudio
-
-# Initialize custom logger for multiprocessing logging
-process_logger = logging.getLogger('stream_setup')
-
-
-# Define the Python wrapper will be used to call the C backend
-def ALSA_py_error_handler(filename, line, function, err, fmt,arg):
-    # Logging into the log file the warnings coming from portaudio library
-    process_logger.warning('ALSA lib configuration error: file {} line {} function {} {}'
-                           .format(filename, line, function, fmt))
-
-
-def stream_set_up():
-    asound = ctypes.cdll.LoadLibrary('/usr/lib/x86_64-linux-gnu/libportaudio.so.2')
-
-    # Define our error handler type for this function call:
-    # include/error.h:59:typedef void (*snd_lib_error_handler_t)(const char *file, int line,
-    # const char *function, int err, const char *fmt, ...) /* __attribute__ ((format (printf, 5, 6))) */;
-    # CFUNCTYPE is a factory; it creates "types" for callback functions
-    # CFUNCTYPE arguments are types
-    # 1. Return of the C function to which it points
-    # (here void -> None)
-    # 2. Inputs of the C function to which it points
-    # (here char*, int, char*, int, char* -> c_char_p, c_int, c_char_p, c_int, c_char_p
-    # 3. The pointer to the variadic argument list is passed as c_void_p
-
-    ALSA_ERROR_HANDLER_FUNC = ctypes.CFUNCTYPE(None, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
-                                               ctypes.c_char_p, ctypes.c_void_p)
-
-    # Create the C-callable callback ALSA_c_error_handler
-    ALSA_c_error_handler = ALSA_ERROR_HANDLER_FUNC(ALSA_py_error_handler)
-
-    # Set the C-side error handler; it will use the Python callback but is callable from C
-    asound.snd_lib_error_set_handler(ALSA_c_error_handler)
-
-    p_audio = pyaudio.PyAudio()
-
-    # Get the index of the MCH Streamer
-    num_devices = p_audio.get_device_count()  # Number of all available audio peripherals
-    index = -1  # -1 means the variable INDEX is void
-    for num_device in range(0, num_devices):
-        # Look for the MCH Streamer in the list of audio peripheral. If MCH Streamer is present, then its information
-        # are logged into the log file and the functions returns its index in the list
-        if "MCHStreamer" in p_audio.get_device_info_by_index(num_device)['name']:  # Linux OS / TinkerOS
-            process_logger.info('Streamer Board information: {}'.format(p_audio.get_device_info_by_index(num_device)))
-            index = p_audio.get_device_info_by_index(num_device)['index']
-            break
-
-    return p_audio, index
-
-
+import ctypes
+import ctypes.util
+import logging
+import pyaudio
+
+# Initialize custom logger for multiprocessing logging
+process_logger = logging.getLogger('stream_setup')
+
+
+# Define the Python wrapper will be used to call the C backend
+def ALSA_py_error_handler(filename, line, function, err, fmt,arg):
+    # Logging into the log file the warnings coming from portaudio library
+    # The message is formatted later by the log handler, which also suppresses the repeated warnings
+    process_logger.warning('ALSA lib configuration error: file %s line %s function %s %s', filename, line, function,
+                           fmt)
+
+
+# ALSA library whose error messages are redirected to the log file. The C-callable handler is kept alive for the whole
+# life of the process, because ALSA can call it at any time
+ALSA_LIBRARY = ctypes.util.find_library('asound') or '/usr/lib/x86_64-linux-gnu/libportaudio.so.2'
+ALSA_c_error_handler = None
+
+STREAMER_NAME = 'MCHStreamer'  # Name of the audio peripheral used for the recording
+last_streamer_index = None  # Index of the MCH Streamer at the last enumeration of the audio peripherals
+
+
+def stream_set_up(board=0, identity=None):
+    global ALSA_c_error_handler
+
+    # Define our error handler type for this function call:
+    # include/error.h:59:typedef void (*snd_lib_error_handler_t)(const char *file, int line,
+    # const char *function, int err, const char *fmt, ...) /* __attribute__ ((format (printf, 5, 6))) */;
+    # CFUNCTYPE is a factory; it creates "types" for callback functions
+    # CFUNCTYPE arguments are types
+    # 1. Return of the C function to which it points
+    # (here void -> None)
+    # 2. Inputs of the C function to which it points
+    # (here char*, int, char*, int, char* -> c_char_p, c_int, c_char_p, c_int, c_char_p
+    # 3. The pointer to the variadic argument list is passed as c_void_p
+    if ALSA_c_error_handler is None:
+        try:
+            asound = ctypes.cdll.LoadLibrary(ALSA_LIBRARY)
+        except OSError:
+            # Without ALSA (e.g. on Windows) the warnings are not redirected
+            process_logger.warning('ALSA library not found: its warnings are not logged.')
+        else:
+            ALSA_ERROR_HANDLER_FUNC = ctypes.CFUNCTYPE(None, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p,
+                                                       ctypes.c_int, ctypes.c_char_p, ctypes.c_void_p)
+
+            # Create the C-callable callback ALSA_c_error_handler
+            ALSA_c_error_handler = ALSA_ERROR_HANDLER_FUNC(ALSA_py_error_handler)
+
+            # Set the C-side error handler; it will use the Python callback but is callable from C
+            asound.snd_lib_error_set_handler(ALSA_c_error_handler)
+
+    p_audio = pyaudio.PyAudio()
+
+    # Get the index of the MCH Streamer (the BOARD-th one, if several boards are connected, or the one with the
+    # IDENTITY of the board already opened)
+    device_info = find_streamer(p_audio, board, identity)
+    index = -1  # -1 means the variable INDEX is void
+    if device_info is not None:
+        # If MCH Streamer is present, then its information are logged into the log file and the functions returns
+        # its index in the list
+        process_logger.info('Streamer Board information: {}'.format(device_info))
+        index = device_info['index']
+
+    return p_audio, index, device_info
+
+
+def streamer_identity(device_info):
+    # Identity of a board which does not depend on the order of the audio peripherals: its name (with the ALSA card and
+    # device, e.g. 'MCHStreamer: USB Audio (hw:1,0)') and its host API
+    return device_info['name'], device_info['hostApi']
+
+
+def find_streamer(p_audio, board=0, identity=None):
+    # Look for the MCH Streamer in the list of audio peripherals and return its information (None if it is not
+    # connected). Every peripheral is queried only once, starting from the index where the board was found last time,
+    # so that a reconnection usually needs a single query. If the IDENTITY of the board is known (see
+    # streamer_identity()), only that board is returned: when a board drops out and the list changes, a board which is
+    # reconnected never takes the device of another board
+    global last_streamer_index
+
+    num_devices = p_audio.get_device_count()  # Number of all available audio peripherals
+    indexes = list(range(0, num_devices))
+    if last_streamer_index is not None and last_streamer_index < num_devices:
+        indexes.remove(last_streamer_index)
+        indexes.insert(0, last_streamer_index)
+
+    if identity is not None:
+        for num_device in indexes:
+            device_info = p_audio.get_device_info_by_index(num_device)
+            if streamer_identity(device_info) == tuple(identity):
+                last_streamer_index = num_device
+                return device_info
+        return None
+
+    if board > 0:
+        # With several boards, the boards are numbered in the order of the list of audio peripherals: the whole list
+        # is queried, so that the numbers do not depend on the order of the queries
+        streamers = [device_info for device_info in map(p_audio.get_device_info_by_index,
+                                                         range(p_audio.get_device_count()))
+                     if STREAMER_NAME in device_info['name']]
+        if board >= len(streamers):
+            return None
+        last_streamer_index = streamers[board]['index']
+        return streamers[board]
+
+    for num_device in indexes:
+        device_info = p_audio.get_device_info_by_index(num_device)
+        if STREAMER_NAME in device_info['name']:  # Linux OS / TinkerOS
+            last_streamer_index = num_device
+            return device_info
+    return None
@@ -0,0 +1,114 @@
+"""This part of the code supervises the processes of the recording. The main process sleeps on the process sentinels
+and on a shutdown pipe instead of checking periodically if the processes are still alive.
+"""
+import logging
+import multiprocessing
+import time
+from multiprocessing.connection import wait
+
+# Initialize custom logger for multiprocessing logging
+process_logger = logging.getLogger('supervisor')
+
+
+class ProcessSupervisor:
+    """supervisor of the recording processes
+
+    Processes are registered with add() and started with start(). run() blocks (without using CPU) until one of the
+    processes stops for good or a shutdown is requested, and returns the reason why the recording is ending
+    (SHUTDOWN_REQUESTED tells if it was requested with request_shutdown(), e.g. by the storage manager).
+    A process that ends with errors is restarted up to MAX_RESTARTS times before the shutdown is triggered. A process
+    which is not ESSENTIAL (e.g. the DSP stage) is left stopped instead, and the recording goes on.
+    If PROFILING is given (see profiling.py), every process runs under the sampling profiler.
+
+    """
+    def __init__(self, profiling=None):
+        self.profiling = profiling
+        self._specs = {}  # Name -> (target, args, max_restarts, essential)
+        self._processes = {}  # Name -> running multiprocessing.Process
+        self.restarts = {}  # Name -> number of restarts done so far
+        self._stopped = set()  # Names of the processes which are not essential and stopped for good
+        self.shutdown_reason = None
+        self.shutdown_requested = False
+        self._shutdown_reader, self._shutdown_writer = multiprocessing.Pipe(duplex=False)
+
+    def add(self, name, target, args, max_restarts=0, essential=True):
+        self._specs[name] = (target, args, max_restarts, essential)
+        self.restarts[name] = 0
+
+    def __getitem__(self, name):
+        return self._processes[name]
+
+    def _spawn(self, name):
+        target, args, _, _ = self._specs[name]
+        if self.profiling is not None:
+            target = self.profiling.wrap(target, name)
+        process = multiprocessing.Process(name=name, target=target, args=args)
+        process.start()
+        self._processes[name] = process
+
+    def start(self):
+        for name in self._specs:
+            self._spawn(name)
+
+    def request_shutdown(self, reason):
+        # Wake up run() from another thread of the main process (e.g. a timer or the storage manager)
+        self._shutdown_writer.send(reason)
+
+    def run(self):
+        while True:
+            sentinels = {process.sentinel: name for name, process in self._processes.items()
+                         if name not in self._stopped}
+            ready = wait(list(sentinels) + [self._shutdown_reader])
+
+            if self._shutdown_reader in ready:
+                self.shutdown_reason = self._shutdown_reader.recv()
+                self.shutdown_requested = True
+                return self.shutdown_reason
+
+            for sentinel in ready:
+                name = sentinels[sentinel]
+                process = self._processes[name]
+                process.join()
+                _, _, max_restarts, essential = self._specs[name]
+
+                # A process that ended with errors is restarted, if it is allowed
+                if process.exitcode != 0 and self.restarts[name] < max_restarts:
+                    self.restarts[name] += 1
+                    process_logger.warning('The {} process ended with exit code {}: restarting it ({}/{}).'
+                                           .format(name, process.exitcode, self.restarts[name], max_restarts))
+                    self._spawn(name)
+                    continue
+
+                if not essential:
+                    process_logger.warning('The {} process ended with exit code {}: the recording goes on without it.'
+                                           .format(name, process.exitcode))
+                    self._stopped.add(name)
+                    continue
+
+                self.shutdown_reason = 'the {} process ended with exit code {}'.format(name, process.exitcode)
+                return self.shutdown_reason
+
+    def exitcodes(self, essential_only=False):
+        return {name: process.exitcode for name, process in self._processes.items()
+                if not essential_only or self._specs[name][3]}
+
+    def names(self):
+        return list(self._processes)
+
+    def is_alive(self, name):
+        return self._processes[name].is_alive()
+
+    def join(self, timeout=None, names=None):
+        # Wait for the processes (all of them, or the processes NAMES) to end. TIMEOUT bounds the whole wait
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for name in self._processes if names is None else names:
+            if name in self._processes:
+                self._processes[name].join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+    def terminate(self, names=None):
+        for name in self._processes if names is None else names:
+            if name in self._processes and self._processes[name].is_alive():
+                self._processes[name].terminate()
+
+    def kill(self, name):
+        self._processes[name].kill()
@@ -0,0 +1,238 @@
+"""This part of the code defines the writer of the .wav segments. Recorded chunks are collected in a large buffer and
+written to the disk with few aligned writes, instead of one write (plus the header update) for each chunk. The CRC32
+of the data is computed while they are copied in the buffer, so that the integrity of the stored segment can be checked
+later (see integrity.py) without reading the data again.
+"""
+import json
+import os
+import struct
+import time
+import zlib
+from collections import deque
+
+WAV_HEADER_SIZE = 44  # Size of the canonical PCM .wav header
+WRITE_SIZE = 1 << 20  # Size of the write buffer (bytes)
+WRITE_ALIGNMENT = 4096  # Writes end on multiples of the page size of the file
+
+
+def wav_header(channels, sample_width, rate, data_size):
+    # Canonical 44 bytes header of a PCM .wav file containing DATA_SIZE bytes of frames
+    block_align = channels * sample_width
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_size, b'WAVE', b'fmt ', 16, 1, channels, rate,
+                       rate * block_align, block_align, sample_width * 8, b'data', data_size)
+
+
+def repair_wav(filename, frame_multiple=1):
+    # Fix in place the header of a .wav segment which was not closed (e.g. after a power failure): its header still
+    # reports the preallocated size and the space after the written data is filled with zeros. The data are kept up to
+    # the last frame which is not zero (and to a multiple of FRAME_MULTIPLE frames), then the file is truncated and
+    # the header rewritten. Return the frames kept
+    with open(filename, 'r+b') as f:
+        header = f.read(WAV_HEADER_SIZE)
+        if len(header) < WAV_HEADER_SIZE or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            raise ValueError('{} is not a .wav segment.'.format(filename))
+        channels, rate = struct.unpack_from('<HI', header, 22)
+        sample_width = struct.unpack_from('<H', header, 34)[0] // 8
+        frame_size = channels * sample_width
+
+        # Look for the last byte which is not zero, from the end of the file
+        end = f.seek(0, os.SEEK_END)
+        while end > WAV_HEADER_SIZE:
+            start = max(WAV_HEADER_SIZE, end - WRITE_SIZE)
+            f.seek(start)
+            data = f.read(end - start).rstrip(b'\0')
+            if data:
+                end = start + len(data)
+                break
+            end = start
+
+        data_size = -(-(end - WAV_HEADER_SIZE) // frame_size) * frame_size
+        if WAV_HEADER_SIZE + data_size > f.seek(0, os.SEEK_END):
+            data_size -= frame_size
+        data_size -= data_size % (frame_multiple * frame_size)
+        f.truncate(WAV_HEADER_SIZE + data_size)
+        f.seek(0)
+        f.write(wav_header(channels, sample_width, rate, data_size))
+        f.flush()
+        os.fsync(f.fileno())
+    return data_size // frame_size
+
+
+class SegmentWriter:
+    """buffered writer of one .wav segment
+
+    The file is preallocated for EXPECTED_FRAMES frames and the header is written once when the file is opened.
+    Chunks are copied in a write buffer which is written to the disk when it is full, so that every write ends on a
+    page boundary of the file. When the segment is closed, the header is fixed up (and the preallocated space
+    released) only if the number of frames written differs from the expected one.
+    If FSYNC_PERIOD is not 0, the data are forced on the disk at most every FSYNC_PERIOD seconds.
+    If a LATENCY histogram is given, the time from the capture of each chunk (its TIMESTAMP) to its write on the disk
+    is recorded.
+    The CRC32 of the data of the segment, and of every block of CHECKSUM_FRAMES frames (if it is not 0), are computed
+    on the bytes written in the file and returned by checksums().
+    Gaps in the recorded data (frames lost before a chunk, or silent frames which were not stored) are marked with
+    mark_gap() and stored with the segment in a .json metadata file.
+
+    """
+    def __init__(self, filename, channels, sample_width, rate, expected_frames, fsync_period=0,
+                 write_size=WRITE_SIZE, latency=None, checksum_frames=0):
+        self.filename = filename
+        self.channels = channels
+        self.sample_width = sample_width
+        self.rate = rate
+        self.frame_size = channels * sample_width
+        self.frames_written = 0
+        self.fsync_period = fsync_period
+
+        self._header_data_size = expected_frames * self.frame_size
+        self._buffer = bytearray(write_size)
+        self._view = memoryview(self._buffer)
+        self._fill = 0  # Bytes waiting in the write buffer
+        self._offset = WAV_HEADER_SIZE  # Position in the file of the first byte of the write buffer
+        self._last_fsync = time.monotonic()
+        self._latency = latency
+        self._pending_times = deque()  # (end position in the file, capture time) of the chunks not yet written
+        self.gaps = []  # Frames lost in the segment: {'frame': frames written before the gap, 'lost_frames': n}
+        self.checksum_frames = checksum_frames
+        self.crc32 = 0  # CRC32 of the data written in the file
+        self._block_crcs = []  # CRC32 of the complete blocks
+        self._block_crc = 0  # CRC32 of the block being written
+        self._block_left = checksum_frames * self.frame_size  # Bytes left to complete the block
+
+        self._fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # Reserve the space of the whole segment, so that the file is not fragmented on the SD card
+            if hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(self._fd, 0, WAV_HEADER_SIZE + self._header_data_size)
+                except OSError:
+                    pass
+            self._write_all(wav_header(channels, sample_width, rate, self._header_data_size))
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    @property
+    def closed(self):
+        return self._fd is None
+
+    @property
+    def data_size(self):
+        return self.frames_written * self.frame_size
+
+    @property
+    def metadata_filename(self):
+        return os.path.splitext(self.filename)[0] + '.json'
+
+    def mark_gap(self, lost_frames, levels=None):
+        # LOST_FRAMES frames are missing between the frames already written and the next ones. LEVELS (dBFS of every
+        # channel) are given for the silent frames skipped by the activity gate
+        gap = {'frame': self.frames_written, 'seconds': self.frames_written / self.rate, 'lost_frames': lost_frames}
+        if levels is not None:
+            gap.update(inactive=True, levels=levels)
+        self.gaps.append(gap)
+
+    def _write_all(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.write(self._fd, view)
+            view = view[written:]
+
+    def _flush(self, aligned):
+        # Write the buffer on the disk. If ALIGNED is True, the bytes after the last page boundary are kept in the
+        # buffer and written with the next flush
+        size = self._fill
+        if aligned:
+            size = (self._offset + self._fill) // WRITE_ALIGNMENT * WRITE_ALIGNMENT - self._offset
+        if size <= 0:
+            return
+
+        self._write_all(self._view[:size])
+        self._offset += size
+        self._record_latency()
+        self._fill -= size
+        if self._fill:
+            self._buffer[:self._fill] = self._view[size:size + self._fill]
+
+        if self.fsync_period and time.monotonic() - self._last_fsync >= self.fsync_period:
+            os.fsync(self._fd)
+            self._last_fsync = time.monotonic()
+
+    def _record_latency(self):
+        if self._latency is None:
+            return
+        now = time.monotonic()
+        while self._pending_times and self._pending_times[0][0] <= self._offset:
+            self._latency.record(now - self._pending_times.popleft()[1])
+
+    def write(self, data, timestamp=None):
+        self._write_data(data, timestamp)
+        self.frames_written += len(data) // self.frame_size
+
+    def _checksum(self, data):
+        # Update the CRC32 of the segment and of its blocks with DATA, the bytes being written in the file
+        self.crc32 = zlib.crc32(data, self.crc32)
+        if not self.checksum_frames:
+            return
+        view = memoryview(data).cast('B')
+        while view:
+            size = min(len(view), self._block_left)
+            self._block_crc = zlib.crc32(view[:size], self._block_crc)
+            self._block_left -= size
+            view = view[size:]
+            if self._block_left == 0:
+                self._block_crcs.append(self._block_crc)
+                self._block_crc = 0
+                self._block_left = self.checksum_frames * self.frame_size
+
+    def checksums(self):
+        # CRC32 (hexadecimal) of the data of the segment and of its blocks, the last block may be shorter. The segment
+        # has to be closed
+        blocks = list(self._block_crcs)
+        if self.checksum_frames and self._block_left < self.checksum_frames * self.frame_size:
+            blocks.append(self._block_crc)
+        return {'frames': self.frames_written, 'block_frames': self.checksum_frames,
+                'crc32': '{:08x}'.format(self.crc32), 'blocks': ['{:08x}'.format(crc) for crc in blocks]}
+
+    def _write_data(self, data, timestamp=None):
+        # Copy DATA (bytes of whole frames) in the write buffer
+        self._checksum(data)
+        size = len(data)
+        if self._latency is not None and timestamp is not None:
+            self._pending_times.append((self._offset + self._fill + size, timestamp))
+        if self._fill + size > len(self._buffer):
+            self._flush(aligned=True)
+
+        if self._fill + size > len(self._buffer):
+            # The chunk is larger than the buffer: it is written directly
+            self._flush(aligned=False)
+            self._write_all(data)
+            self._offset += size
+            self._record_latency()
+        else:
+            self._buffer[self._fill:self._fill + size] = data
+            self._fill += size
+
+    def close(self, sync=False):
+        # If SYNC is True, the segment is forced on the disk even without FSYNC_PERIOD (e.g. at the shutdown)
+        if self._fd is None:
+            return
+        try:
+            self._flush(aligned=False)
+
+            # Fix up the header and release the preallocated space if the segment is shorter than expected
+            if self.data_size != self._header_data_size:
+                os.ftruncate(self._fd, WAV_HEADER_SIZE + self.data_size)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                self._write_all(wav_header(self.channels, self.sample_width, self.rate, self.data_size))
+
+            if self.fsync_period or sync:
+                os.fsync(self._fd)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+        if self.gaps:
+            with open(self.metadata_filename, 'w') as f:
+                json.dump({'channels': self.channels, 'rate': self.rate, 'frames': self.frames_written,
+                           'gaps': self.gaps}, f, indent=1)
@@ -1,167 +1,375 @@
-"""
-This code performs multichannel audio record and permutes the read frames, so that the output wav file is encrypted.
-Since on the acquisition board a CHUNK size of 1024 will overflow the buffer, this code is implemented by using the
-multiprocessing approach.
-Another possible solution for overflow is increase the buffer size (2048 is fine).
-
-Hardware: MCHStreamer Kit
-Software: Windows OS / Ubuntu / TinkerOS
-"""
-
-import datetime
-import multiprocessing
-from ctypes import c_bool
-from Processes.record_process import *
-from Processes.save_process import *
-from Processes.compress_process import *
-from CustomExceptions.custom_handlers import *
-from CustomLogging.clean_up_log import *
-
-# Initialize custom logger for multiprocessing logging
-process_logger = logging.getLogger('main_process')
-
-
-if __name__ == '__main__':
-    import logging.config
-    import yaml
-    import sys
-
-    # Detect current working directory
-    current_path = os.getcwd()
-
-    clean_up(current_path)
-
-    # Register handler for the SIGTERM signal
-    signal.signal(signal.SIGTERM, sigterm_handler)
-
-    # Configure logger. Adding path where config file and custom logger class are stored
-    sys.path.append(os.getcwd() + '/CustomLogging')
-    formatter_path = os.getcwd() + '/CustomLogging/logging.yaml'
-    if os.path.exists(formatter_path):
-        with open(formatter_path) as f:
-            config = yaml.load(f.read())
-        logging.config.dictConfig(config)
-
-    # Set parameters for recording
-    RATE = 32000
-    # RATE = int(p.get_device_info_by_index(1)['defaultSampleRate'])  # Sampling rate
-    CHANNELS = 7  # Number of microphones (including Ref Mic)
-    FORMAT = pyaudio.paInt16  # Format of data and size recorded is Int 16 bit
-    FORMAT_SIZE = pyaudio.get_sample_size(FORMAT)
-    CHUNK = 1024  # Frames per buffer
-
-    # Create directory to save results
-    path_results = current_path + '/Recordings' + '/AudioRecorded_' + str(
-        datetime.datetime.today().strftime('on%d%b%Y_at%H.%M.%S'))
-
-    try:
-        # Check if the folder containing all audio data already exists. If not, it will be created
-        if not os.path.exists(current_path + '/Recordings'):
-            os.makedirs(current_path + '/Recordings')
-            os.mkdir(path_results)
-        else:
-            os.mkdir(path_results)
-
-    except OSError:
-        # If the folder for the results is not created, the record does not start
-        process_logger.error('Creation of the directory for the results failed.')
-    else:
-
-        try:
-            # Initialize flags to handle the "Connection error" and "Disconnection error" events in the processes.
-            # Default value is false (no error occurred)
-            error_connection_flag = multiprocessing.Value(c_bool, False)
-            disconnection_error_flag = multiprocessing.Value(c_bool, False)
-
-            # Multiprocessing initialization
-            q_frames = multiprocessing.Queue()  # queue where recorded frames (ready to be written) are put
-            q_files = multiprocessing.Queue()  # queue where filenames of wav files (ready to be compressed) are put
-            record_process = multiprocessing.Process(name='record', target=audio_record, args=(error_connection_flag,
-                                                                                               q_frames, FORMAT,
-                                                                                               CHANNELS, RATE, CHUNK))
-            save_process = multiprocessing.Process(name='save', target=save_data, args=(error_connection_flag,
-                                                                                        disconnection_error_flag,
-                                                                                        q_frames, q_files, CHANNELS,
-                                                                                        FORMAT_SIZE, RATE, CHUNK,
-                                                                                        path_results))
-            compress_process = multiprocessing.Process(name='compress', target=compress_data,
-                                                       args=(error_connection_flag, disconnection_error_flag, q_files,
-                                                             path_results))
-
-            # Start the processes
-            record_process.start()
-            save_process.start()
-            compress_process.start()
-
-            # The main process check periodically if the processes are still running
-            while record_process.is_alive() is True and save_process.is_alive() is True \
-                    and compress_process.is_alive() is True:
-                continue
-
-            # Check if processes ended because of MCH not connected (from the beginning)
-            if error_connection_flag.value is True:
-                raise StreamConnectionError
-
-            # Check if one of the processes ended with errors (exit code != 0). Usually it happens when the streamer
-            # board is disconnected during the recording. If one the processes ended with errors, the others are
-            # terminated raising an exception
-            if record_process.exitcode != 0 or save_process.exitcode != 0 or compress_process.exitcode != 0:
-                disconnection_error_flag.value = True
-                raise DisconnectionError
-
-        # Exceptions handling
-        except KeyboardInterrupt:
-            # If the program was interrupted by SIGINT or SIGTERM signal, the main process waits the processes to
-            # complete and then terminates
-            record_process.join()
-            save_process.join()
-            compress_process.join()
-
-            # Move log file to the data folder
-            subprocess.run(['mv', 'audio_record.log', path_results])
-
-        except (OSError, StreamConnectionError):
-            # If any errors happens due to errors in the streaming set up,
-            # log file is stored under the 'Failed run' folder
-            try:
-                if not os.path.exists(current_path + '/Failed'):
-                    os.makedirs(current_path + '/Failed')
-                    os.rename('audio_record.log',
-                              'audio_record_' + datetime.datetime.today().strftime('on%d%b%Y_at%H.%M.%S') + '.log')
-                    subprocess.run(
-                        ['mv', 'audio_record_' + datetime.datetime.today().strftime('on%d%b%Y_at%H.%M.%S') + '.log',
-                         current_path + '/Failed'])
-                else:
-                    os.rename('audio_record.log',
-                              'audio_record_' + datetime.datetime.today().strftime('on%d%b%Y_at%H.%M.%S') + '.log')
-                    subprocess.run(
-                        ['mv', 'audio_record_' + datetime.datetime.today().strftime('on%d%b%Y_at%H.%M.%S') + '.log',
-                         current_path + '/Failed'])
-
-                record_process.join()
-                save_process.join()
-                compress_process.join()
-
-            except OSError:
-                process_logger.error('Creation of the directory for logs of failed run failed.')
-
-        except DisconnectionError:
-            # If the board looses connection with the sensors, all the processes terminate. The recorded data are
-            # stored in the "Recordings" folder
-            if save_process.is_alive():
-                save_process.join()
-            if compress_process.is_alive():
-                compress_process.join()
-
-            process_logger.error('An unexpected error happened. Check connection with MCH Streamer. '
-                                 'Has it been disconnected?')
-            subprocess.run(['mv', 'audio_record.log', path_results])
-
-        except SystemExit:
-            process_logger.info('The system is shutting down.')
-            # Move log file to the data folder
-            subprocess.run(['mv', 'audio_record.log', path_results])
-
-            record_process.terminate()
-            save_process.terminate()
-            compress_process.terminate()
+"""
+This code performs multichannel audio record and permutes the read frames, so that the output wav file is encrypted.
+Frames are permuted only if the key file of the recordings exists (see Processes/scrambling.py).
+Since on the acquisition board a CHUNK size of 1024 will overflow the buffer, this code is implemented by using the
+multiprocessing approach.
+Another possible solution for overflow is increase the buffer size (2048 is fine): with CHUNK_TUNING, the smallest
+buffer size which does not overflow is measured on every host (see Processes/buffer_tuning.py).
+
+Hardware: MCHStreamer Kit
+Software: Windows OS / Ubuntu / TinkerOS
+"""
+
+import datetime
+import multiprocessing
+from ctypes import c_bool
+from Processes.record_process import *
+from Processes.save_process import *
+from Processes.ring_buffer import *
+from Processes.supervisor import *
+from Processes.metrics import *
+from Processes.compress_process import *
+from Processes.dsp_process import *
+from Processes.session_journal import *
+from Processes.scrambling import *
+from Processes.audio_codecs import supported_codec
+from Processes.activity_gate import *
+from Processes.live_tap import live_publisher, TAP_NAME, TAP_SLOTS
+from Processes.board_merger import BoardStats, merge_boards
+from Processes.buffer_tuning import BufferProfile, PROFILE_NAME
+from Processes.storage_manager import *
+from Processes.shutdown import ShutdownControl, SHUTDOWN_TIMEOUT, stop_recording
+from Processes.profiling import Profiling, profiling_requested, SAMPLE_INTERVAL, DUMP_PERIOD
+from CustomExceptions.custom_handlers import *
+from CustomLogging.clean_up_log import *
+
+# Initialize custom logger for multiprocessing logging
+process_logger = logging.getLogger('main_process')
+
+
+if __name__ == '__main__':
+    import logging.config
+    import yaml
+    import sys
+
+    # Detect current working directory
+    current_path = os.getcwd()
+
+    clean_up(current_path)
+
+    # Register handler for the SIGTERM signal
+    signal.signal(signal.SIGTERM, sigterm_handler)
+
+    # Configure logger. Adding path where config file and custom logger class are stored
+    sys.path.append(os.getcwd() + '/CustomLogging')
+    formatter_path = os.getcwd() + '/CustomLogging/logging.yaml'
+    if os.path.exists(formatter_path):
+        with open(formatter_path) as f:
+            config = yaml.load(f.read())
+        logging.config.dictConfig(config)
+
+    # Set parameters for recording
+    RATE = 32000
+    # RATE = int(p.get_device_info_by_index(1)['defaultSampleRate'])  # Sampling rate
+    BOARDS = 1  # Number of MCH Streamer boards recorded together (their channels are merged in the same segments)
+    BOARD_CHANNELS = 7  # Number of microphones of each board (including Ref Mic)
+    CHANNELS = BOARDS * BOARD_CHANNELS  # Number of channels of the recording
+    FORMAT = paInt16  # Format of data and size recorded is Int 16 bit
+    FORMAT_SIZE = get_sample_size(FORMAT)
+    CHUNK = 1024  # Frames per buffer (if CHUNK_TUNING is False, or if the buffers can not be calibrated)
+    # Source of the audio data: portaudio (MCH Streamer), synthetic or replay (e.g. 'synthetic:signal=noise,speed=2').
+    # With several boards, one source per board can be given, separated by '|'
+    CAPTURE_BACKEND = os.environ.get('MCH_BACKEND', 'portaudio')
+    # With several boards, the record process of every board runs on its own core
+    PIN_RECORD_PROCESSES = BOARDS > 1
+    RECORD_SECONDS = 60  # Length of each .wav segment (seconds)
+    RING_SLOTS = 512  # Number of chunks the shared ring buffer can hold (about 16 s of audio)
+    # CHUNK and RING_SLOTS are calibrated at the first start on every host and source of audio data, stored in
+    # BUFFER_PROFILE and updated after every recording (delete the profile to calibrate them again)
+    CHUNK_TUNING = True
+    BUFFER_PROFILE = current_path + '/' + PROFILE_NAME
+    FSYNC_PERIOD = 10  # Seconds between two flushes of the open .wav file to the disk (0 disables them)
+    # Activity gate: only the events (with PRE_ROLL seconds before and POST_ROLL seconds after) are stored, the silent
+    # stretches are replaced by markers. An event begins when a channel gets ACTIVITY_ON_MARGIN dB above its noise
+    # floor and ends when all the channels are less than ACTIVITY_OFF_MARGIN dB above it
+    ACTIVITY_GATE = False
+    ACTIVITY_ON_MARGIN = ON_MARGIN
+    ACTIVITY_OFF_MARGIN = OFF_MARGIN
+    ACTIVITY_PRE_ROLL = PRE_ROLL
+    ACTIVITY_POST_ROLL = POST_ROLL
+    # Codec of the compressed segments: raw, delta-zlib, delta-lzma, flac, deflate. A fast codec is used while
+    # recording, the older sessions are compressed again with ARCHIVE_CODEC
+    COMPRESSION_CODEC = 'delta-zlib'
+    ARCHIVE_CODEC = 'delta-lzma'  # Codec of the containers of the older sessions, compressed in idle time (None: never)
+    RECOMPRESS_RESTARTS = 3  # Number of times the recompression process is restarted if it fails
+    ARCHIVE_FORMAT = 'mchr'  # Where the segments are stored: mchr (indexed recording container) or zip (data.zip)
+    COMPRESS_WORKERS = max(1, multiprocessing.cpu_count() - 2)  # Segments compressed in parallel
+    COMPRESS_QUEUE_SIZE = 4  # Files waiting for compression before the save process is slowed down
+    COMPRESS_RESTARTS = 3  # Number of times the compression process is restarted if it fails
+    DSP_STAGE = True  # Levels of the channels (RMS, peak, clipping, DC offset) computed by the DSP process
+    DSP_DECIMATION = 0  # Decimation factor of the low-rate monitoring stream (0 disables it)
+    DSP_MONITOR_NAME = MONITOR_TAP_NAME  # Name of the shared memory segment where the decimated stream is published
+    DSP_RESTARTS = 3  # Number of times the DSP process is restarted if it fails (then the recording goes on without it)
+    # File with the key of the recordings: if it exists, the segments are scrambled before they are written
+    SCRAMBLE_KEY_FILE = os.environ.get(KEY_ENVIRONMENT, current_path + '/scramble.key')
+    SCRAMBLE_CHANNELS = True  # The channels are permuted too (not only the blocks of frames)
+    LIVE_TAP = False  # The live stream is published in a shared memory segment for other programs (see live_tap.py)
+    LIVE_TAP_NAME = TAP_NAME  # Name of the shared memory segment of the live stream
+    LIVE_TAP_SLOTS = TAP_SLOTS  # Chunks of the live stream kept for the subscribers
+    LIVE_TAP_RESTARTS = 3  # Number of times the live tap is restarted if it fails
+    # Disk budget of the recordings: the space of STORAGE_HORIZON seconds of recording (at least STORAGE_MIN_FREE bytes)
+    # is kept free. If STORAGE_DELETE_OLDEST is set, the oldest sessions are deleted to keep it free or to stay within
+    # STORAGE_QUOTA bytes (0 means no quota); sessions older than STORAGE_RETENTION_DAYS days (0 means never) are
+    # always deleted. If less than STORAGE_MIN_FREE bytes are free anyway, the recording is stopped
+    STORAGE_MIN_FREE = MIN_FREE
+    STORAGE_HORIZON = HORIZON
+    STORAGE_QUOTA = 0
+    STORAGE_RETENTION_DAYS = 0
+    STORAGE_DELETE_OLDEST = False
+    # Seconds the processes have to stop within when the recording ends (e.g. the hold-up time of the power supply of
+    # the board): the last segment is stored, the segments which are not compressed in time are compressed at the next
+    # start
+    SHUTDOWN_DEADLINE = SHUTDOWN_TIMEOUT
+    # Profiling mode (also turned on with MCH_PROFILE=1 in the environment): every process samples its stacks every
+    # PROFILE_INTERVAL seconds and writes its profile (folded stacks, CPU and wall time) in the session folder every
+    # PROFILE_PERIOD seconds (see Processes/profiling.py)
+    PROFILE = profiling_requested(False)
+    PROFILE_INTERVAL = SAMPLE_INTERVAL
+    PROFILE_PERIOD = DUMP_PERIOD
+    METRICS_FORMAT = 'prometheus'  # Format of the metrics file: prometheus (textfile collector) or jsonl
+    METRICS_FILE = current_path + '/mch_metrics.prom'  # File where the metrics of the pipeline are exported
+    METRICS_PERIOD = 10  # Seconds between two exports of the metrics
+
+    # A codec which can not store the samples (e.g. flac with 32-bit samples) is replaced by another lossless codec
+    COMPRESSION_CODEC = supported_codec(COMPRESSION_CODEC, FORMAT_SIZE)
+    if ARCHIVE_CODEC:
+        ARCHIVE_CODEC = supported_codec(ARCHIVE_CODEC, FORMAT_SIZE)
+
+    # Create directory to save results
+    path_results = current_path + '/Recordings' + '/AudioRecorded_' + str(
+        datetime.datetime.today().strftime('on%d%b%Y_at%H.%M.%S'))
+
+    try:
+        # Check if the folder containing all audio data already exists. If not, it will be created
+        if not os.path.exists(current_path + '/Recordings'):
+            os.makedirs(current_path + '/Recordings')
+            os.mkdir(path_results)
+        else:
+            os.mkdir(path_results)
+
+    except OSError:
+        # If the folder for the results is not created, the record does not start
+        process_logger.error('Creation of the directory for the results failed.')
+    else:
+
+        metrics_exporter = None
+        storage_manager = None
+        supervisor = None
+        shutdown_phases = {}
+        # journal of the states of the segments, read by clean_up() if the recording does not end properly
+        session_journal = SessionJournal(path_results)
+        buffer_profile = None
+        try:
+            # Frames per buffer and size of the ring buffers tuned for this host and this source (with several boards,
+            # the buffers of the first board are calibrated)
+            if CHUNK_TUNING:
+                buffer_profile = BufferProfile(BUFFER_PROFILE, board_backends(CAPTURE_BACKEND, BOARDS)[0], FORMAT,
+                                               BOARD_CHANNELS, RATE)
+                CHUNK, RING_SLOTS = buffer_profile.buffers(CHUNK, RING_SLOTS)
+                process_logger.info('{} frames per buffer, {} chunks in the ring buffer.'.format(CHUNK, RING_SLOTS))
+
+            # Initialize flags to handle the "Connection error" and "Disconnection error" events in the processes.
+            # Default value is false (no error occurred)
+            error_connection_flag = multiprocessing.Value(c_bool, False)
+            disconnection_error_flag = multiprocessing.Value(c_bool, False)
+            # Deadline and phases of the shutdown, shared by the processes
+            shutdown_control = ShutdownControl(SHUTDOWN_DEADLINE)
+
+            # Multiprocessing initialization
+            # ring buffer where recorded frames (ready to be written) are put
+            ring_frames = SharedRingBuffer(RING_SLOTS, CHUNK * CHANNELS * FORMAT_SIZE, CHANNELS * FORMAT_SIZE)
+            # queue where filenames of wav files (ready to be compressed) are put
+            q_files = multiprocessing.Queue(COMPRESS_QUEUE_SIZE)
+
+            pipeline_metrics = PipelineMetrics()  # counters and latencies shared by the processes
+            channel_levels = ChannelLevels(CHANNELS) if DSP_STAGE else None  # levels computed by the DSP process
+            # The scrambling settings are stored in the folder of the session, the key is never stored with the data
+            scrambler = None
+            scramble_key = read_key(SCRAMBLE_KEY_FILE)
+            if scramble_key is not None:
+                scrambler = Scrambler.create(scramble_key, path_results, CHANNELS,
+                                             scramble_channels=SCRAMBLE_CHANNELS)
+            session_journal.start({'codec': COMPRESSION_CODEC, 'archive_format': ARCHIVE_FORMAT, 'rate': RATE,
+                                   'channels': CHANNELS, 'boards': BOARDS, 'chunk': CHUNK,
+                                   'scrambled': scrambler is not None,
+                                   'activity_gate': ACTIVITY_GATE})
+            activity_gate = None
+            if ACTIVITY_GATE:
+                activity_gate = ActivityGate(CHANNELS, FORMAT_SIZE, RATE, CHUNK, ACTIVITY_ON_MARGIN,
+                                             ACTIVITY_OFF_MARGIN, ACTIVITY_PRE_ROLL, ACTIVITY_POST_ROLL)
+
+            # The supervisor starts the processes and restarts the compression process if it fails
+            # With the profiling mode, every process writes its profile in the session folder
+            profiling = Profiling(path_results, PROFILE_INTERVAL, PROFILE_PERIOD) if PROFILE else None
+            supervisor = ProcessSupervisor(profiling)
+            board_stats = None
+            exported_metrics = pipeline_metrics
+            if BOARDS == 1:
+                supervisor.add('record', audio_record, (error_connection_flag, ring_frames, FORMAT, CHANNELS, RATE,
+                                                        CHUNK, CAPTURE_BACKEND, pipeline_metrics, None,
+                                                        shutdown_control))
+                record_processes = ['record']
+            else:
+                # Every board is recorded by its own process in its own ring buffer (with its own metrics), and the
+                # merge process aligns the boards and puts the merged frames in the ring buffer of the save process
+                cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+                board_rings = []
+                board_wakeup = RingWakeup()  # The merge process is woken up by the chunks of any board
+                board_metrics = []
+                record_processes = []
+                for board, board_backend in enumerate(board_backends(CAPTURE_BACKEND, BOARDS)):
+                    board_rings.append(SharedRingBuffer(RING_SLOTS, CHUNK * BOARD_CHANNELS * FORMAT_SIZE,
+                                                        BOARD_CHANNELS * FORMAT_SIZE, board_wakeup))
+                    board_metrics.append(PipelineMetrics())
+                    cpu = cpus[board % len(cpus)] if PIN_RECORD_PROCESSES and cpus else None
+                    record_processes.append('record {}'.format(board))
+                    supervisor.add(record_processes[-1], audio_record,
+                                   (error_connection_flag, board_rings[board], FORMAT, BOARD_CHANNELS, RATE, CHUNK,
+                                    board_backend, board_metrics[board], cpu, shutdown_control))
+                board_stats = BoardStats(BOARDS)
+                supervisor.add('merge', merge_boards, (error_connection_flag, disconnection_error_flag, board_rings,
+                                                       ring_frames, [BOARD_CHANNELS] * BOARDS, FORMAT_SIZE, RATE,
+                                                       CHUNK, board_stats, shutdown_control))
+                exported_metrics = CombinedMetrics([pipeline_metrics] + board_metrics)
+            supervisor.add('save', save_data, (error_connection_flag, disconnection_error_flag, ring_frames, q_files,
+                                               CHANNELS, FORMAT_SIZE, RATE, CHUNK, path_results, FSYNC_PERIOD,
+                                               RECORD_SECONDS, pipeline_metrics, session_journal, scrambler,
+                                               activity_gate, shutdown_control))
+            supervisor.add('compress', compress_data, (error_connection_flag, disconnection_error_flag, q_files,
+                                                       path_results, COMPRESSION_CODEC, COMPRESS_WORKERS,
+                                                       pipeline_metrics, ARCHIVE_FORMAT, session_journal,
+                                                       shutdown_control),
+                           max_restarts=COMPRESS_RESTARTS)
+            if DSP_STAGE:
+                supervisor.add('dsp', dsp_monitor, (error_connection_flag, disconnection_error_flag, ring_frames,
+                                                    ring_frames.add_observer(), CHANNELS, FORMAT_SIZE, RATE,
+                                                    channel_levels, DSP_DECIMATION, DSP_MONITOR_NAME,
+                                                    shutdown_control),
+                               max_restarts=DSP_RESTARTS, essential=False)
+            if LIVE_TAP:
+                supervisor.add('live', live_publisher, (error_connection_flag, disconnection_error_flag, ring_frames,
+                                                        ring_frames.add_observer(), CHANNELS, FORMAT_SIZE, RATE,
+                                                        LIVE_TAP_NAME, LIVE_TAP_SLOTS, pipeline_metrics,
+                                                        shutdown_control),
+                               max_restarts=LIVE_TAP_RESTARTS, essential=False)
+            if ARCHIVE_CODEC and ARCHIVE_FORMAT == 'mchr':
+                supervisor.add('recompress', recompress_sessions, (error_connection_flag, disconnection_error_flag,
+                                                                   current_path + '/Recordings', path_results,
+                                                                   ARCHIVE_CODEC, pipeline_metrics, shutdown_control),
+                               max_restarts=RECOMPRESS_RESTARTS, essential=False)
+
+            # Processes of every phase of the shutdown (the other processes end in the last phase)
+            shutdown_phases = {'record': record_processes, 'merge': ['merge'] if BOARDS > 1 else [],
+                               'flush': ['save'], 'compress': ['compress']}
+
+            # Start the processes, the storage manager and the periodic export of the metrics
+            supervisor.start()
+            storage_manager = StorageManager(current_path + '/Recordings', path_results, pipeline_metrics,
+                                             supervisor.request_shutdown, METRICS_PERIOD, STORAGE_MIN_FREE,
+                                             STORAGE_HORIZON, STORAGE_QUOTA, STORAGE_RETENTION_DAYS,
+                                             STORAGE_DELETE_OLDEST)
+            storage_manager.start()
+            metrics_exporter = MetricsExporter(exported_metrics, ring_frames, METRICS_FILE, METRICS_PERIOD,
+                                               METRICS_FORMAT, channel_levels, board_stats, storage_manager)
+            metrics_exporter.start()
+
+            # The main process sleeps until one of the processes ends
+            shutdown_reason = supervisor.run()
+            process_logger.info('Recording is ending: {}.'.format(shutdown_reason))
+
+            # Check if processes ended because of MCH not connected (from the beginning)
+            if error_connection_flag.value is True:
+                raise StreamConnectionError
+
+            # Check if one of the processes ended with errors (exit code other than 0; the processes still running
+            # have no exit code). Usually it happens when the streamer board is disconnected during the recording. If
+            # one the processes ended with errors, the others are stopped raising an exception. A shutdown requested
+            # by the main process (e.g. by the storage manager) is never taken for a disconnection
+            if not supervisor.shutdown_requested and any(
+                    exitcode not in (0, None) for exitcode in supervisor.exitcodes(essential_only=True).values()):
+                disconnection_error_flag.value = True
+                raise DisconnectionError
+
+            # Otherwise (e.g. the source ended, or the disk is almost full) all the processes stop, phase by phase,
+            # within the deadline
+            stop_recording(supervisor, shutdown_control, shutdown_phases, shutdown_reason, session_journal)
+
+            # Move log file to the data folder
+            subprocess.run(['mv', 'audio_record.log', path_results])
+            session_journal.record(LOG_MOVED)
+
+        # Exceptions handling
+        except KeyboardInterrupt:
+            # If the program was interrupted by SIGINT signal, the processes store the data left and terminate within
+            # the deadline of the shutdown
+            process_logger.info('Recording is ending: interrupted by the user.')
+            if supervisor is not None:
+                stop_recording(supervisor, shutdown_control, shutdown_phases, 'interrupted by the user',
+                               session_journal)
+
+            # Move log file to the data folder
+            subprocess.run(['mv', 'audio_record.log', path_results])
+            session_journal.record(LOG_MOVED)
+
+        except (OSError, StreamConnectionError):
+            # If any errors happens due to errors in the streaming set up,
+            # log file is stored under the 'Failed run' folder
+            try:
+                if not os.path.exists(current_path + '/Failed'):
+                    os.makedirs(current_path + '/Failed')
+                    os.rename('audio_record.log',
+                              'audio_record_' + datetime.datetime.today().strftime('on%d%b%Y_at%H.%M.%S') + '.log')
+                    subprocess.run(
+                        ['mv', 'audio_record_' + datetime.datetime.today().strftime('on%d%b%Y_at%H.%M.%S') + '.log',
+                         current_path + '/Failed'])
+                else:
+                    os.rename('audio_record.log',
+                              'audio_record_' + datetime.datetime.today().strftime('on%d%b%Y_at%H.%M.%S') + '.log')
+                    subprocess.run(
+                        ['mv', 'audio_record_' + datetime.datetime.today().strftime('on%d%b%Y_at%H.%M.%S') + '.log',
+                         current_path + '/Failed'])
+
+                if supervisor is not None:
+                    stop_recording(supervisor, shutdown_control, shutdown_phases, 'stream connection error')
+
+            except OSError:
+                process_logger.error('Creation of the directory for logs of failed run failed.')
+
+        except DisconnectionError:
+            # If the board looses connection with the sensors, all the processes terminate. The recorded data are
+            # stored in the "Recordings" folder
+            stop_recording(supervisor, shutdown_control, shutdown_phases, shutdown_reason, session_journal)
+
+            process_logger.error('An unexpected error happened. Check connection with MCH Streamer. '
+                                 'Has it been disconnected?')
+            subprocess.run(['mv', 'audio_record.log', path_results])
+            session_journal.record(LOG_MOVED)
+
+        except SystemExit:
+            # If the system is shutting down (SIGTERM), the processes store the data left and terminate within the
+            # deadline of the shutdown
+            process_logger.info('Recording is ending: the system is shutting down.')
+            if supervisor is not None:
+                stop_recording(supervisor, shutdown_control, shutdown_phases, 'the system is shutting down',
+                               session_journal)
+
+            # Move log file to the data folder
+            subprocess.run(['mv', 'audio_record.log', path_results])
+            session_journal.record(LOG_MOVED)
+
+        finally:
+            if storage_manager is not None:
+                storage_manager.stop()
+
+            # Last export of the metrics
+            if metrics_exporter is not None:
+                metrics_exporter.stop()
+
+                # The overflows and the occupancy of the ring buffers of the recording tune the buffers of the next
+                # start
+                counters = exported_metrics.snapshot()
+                if buffer_profile is not None and counters['chunks_captured']:
+                    rings = [ring_frames] + (board_rings if BOARDS > 1 else [])
+                    buffer_profile.record_session(CHUNK, counters['input_overflows'],
+                                                  max(ring.high_water for ring in rings),
+                                                  sum(ring.overruns for ring in rings))
@@ -0,0 +1,91 @@
+"""Tests of the activity gate of the save process.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import unittest
+
+import numpy as np
+
+from Processes.activity_gate import ActivityGate
+
+RATE = 1000
+CHUNK = 100  # 0.1 s
+CHANNELS = 2
+RANDOM = np.random.default_rng(0)
+
+
+def chunk(level, channel=None):
+    # Noise at LEVEL dBFS on one channel (or all of them) over a floor at -60 dBFS
+    levels = np.full(CHANNELS, -60.0)
+    levels[slice(None) if channel is None else channel] = level
+    noise = RANDOM.standard_normal((CHUNK, CHANNELS)) * 10 ** (levels / 20) * 32768
+    return np.rint(noise).astype('<i2').tobytes()
+
+
+class ActivityGateTest(unittest.TestCase):
+
+    def setUp(self):
+        # 3 chunks of pre-roll, 5 chunks of post-roll
+        self.gate = ActivityGate(CHANNELS, 2, RATE, CHUNK, pre_roll=0.3, post_roll=0.5)
+        self.stored = []
+
+    def feed(self, *chunks):
+        for data in chunks:
+            self.stored += self.gate.process(data, len(self.stored))
+        return len(self.stored)
+
+    def test_event_with_pre_and_post_roll(self):
+        quiet = [chunk(-60) for _ in range(20)]
+        event = [chunk(-20, channel=1) for _ in range(3)]
+        self.feed(*quiet)
+        self.assertEqual(self.stored, [])
+        self.assertFalse(self.gate.active)
+
+        self.feed(*event)
+        self.assertTrue(self.gate.active)
+        self.assertEqual(self.gate.events, 1)
+        # The pre-roll is stored before the event, in order
+        self.assertEqual([data for data, _ in self.stored], quiet[-3:] + event)
+
+        after = [chunk(-60) for _ in range(20)]
+        self.feed(*after)
+        self.assertFalse(self.gate.active)
+        self.assertEqual([data for data, _ in self.stored], quiet[-3:] + event + after[:5])
+
+        self.gate.discard()
+        frames, levels = self.gate.skipped()
+        self.assertEqual(frames, (20 + 3 + 20 - len(self.stored)) * CHUNK)
+        for level in levels:
+            self.assertAlmostEqual(level, -60, delta=1)
+        self.assertEqual(self.gate.skipped(), (0, [None, None]))
+
+    def test_hysteresis(self):
+        self.feed(*[chunk(-60) for _ in range(20)])
+        # Between the two thresholds: the gate does not open
+        self.assertEqual(self.feed(*[chunk(-53) for _ in range(3)]), 0)
+        self.feed(*[chunk(-60) for _ in range(20)])
+        self.feed(chunk(-30))
+        # ...but it stays open
+        stored = self.feed(*[chunk(-53) for _ in range(10)])
+        self.assertTrue(self.gate.active)
+        self.assertEqual(stored, 3 + 1 + 10)
+        self.assertEqual(self.gate.events, 1)
+
+    def test_floor_follows_a_louder_background(self):
+        self.feed(*[chunk(-60) for _ in range(20)])
+        self.feed(*[chunk(-40) for _ in range(300)])
+        # The floor rose by 1 dB per second at most: the background is now silence
+        self.assertFalse(self.gate.active)
+        self.assertAlmostEqual(10 * np.log10(self.gate.floor.max()), -40, delta=1)
+        self.assertEqual(self.gate.events, 1)
+
+    def test_digital_silence(self):
+        silence = bytes(CHUNK * CHANNELS * 2)
+        self.feed(*[silence] * 10)
+        self.assertEqual(self.stored, [])
+        self.gate.discard()
+        self.assertEqual(self.gate.skipped(), (10 * CHUNK, [None, None]))
+
+
+if __name__ == '__main__':
+    unittest.main()
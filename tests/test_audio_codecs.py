@@ -0,0 +1,96 @@
+"""Tests of the lossless audio codecs of the compressed segments.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import os
+import tempfile
+import unittest
+import zipfile
+
+import numpy as np
+
+from Processes import audio_codecs
+from Processes.audio_codecs import (CODECS, FALLBACK_CODEC, codec_extension, decode_segment, encode_segment,
+                                    extract_archive, read_wav, supported_codec, write_wav)
+
+RATE = 16000
+
+
+def samples(dtype, frames=5000, channels=3):
+    # Noisy sine waves with the extreme values of the type, to check the wrap around of the differences
+    info = np.iinfo(dtype)
+    t = np.arange(frames)[:, None]
+    signal = 0.5 * info.max * np.sin(2 * np.pi * 440 * t / RATE * np.arange(1, channels + 1))
+    data = (signal + np.random.default_rng(1).normal(0, 100, signal.shape)).astype(dtype)
+    data[10] = info.max
+    data[11] = info.min
+    return data
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_round_trips(self):
+        for codec in ('raw', 'delta-zlib', 'delta-lzma'):
+            for dtype in (np.int16, np.int32):
+                with self.subTest(codec=codec, dtype=dtype):
+                    original = samples(dtype)
+                    decoded, rate = decode_segment(encode_segment(original, RATE, codec))
+                    self.assertEqual(rate, RATE)
+                    self.assertEqual(decoded.dtype, original.dtype)
+                    np.testing.assert_array_equal(decoded, original)
+
+    @unittest.skipIf(audio_codecs.soundfile is None, 'soundfile is not installed')
+    def test_flac_round_trip(self):
+        original = samples(np.int16)
+        decoded, _ = decode_segment(encode_segment(original, RATE, 'flac'))
+        np.testing.assert_array_equal(decoded, original)
+
+    def test_delta_codecs_compress_audio(self):
+        original = samples(np.int16)
+        self.assertLess(len(encode_segment(original, RATE, 'delta-lzma')), 0.8 * original.nbytes)
+
+    def test_flac_rejects_32_bit_samples(self):
+        with self.assertRaises(ValueError):
+            encode_segment(samples(np.int32), RATE, 'flac')
+
+    def test_supported_codec(self):
+        self.assertEqual(supported_codec('flac', 2), 'flac')
+        self.assertEqual(supported_codec('delta-zlib', 4), 'delta-zlib')
+        with self.assertLogs('audio_codecs', 'WARNING'):
+            self.assertEqual(supported_codec('flac', 4), FALLBACK_CODEC)
+
+    def test_truncated_segment(self):
+        data = encode_segment(samples(np.int16), RATE, 'raw')
+        with self.assertRaises(ValueError):
+            decode_segment(data[:-600])
+
+    def test_not_a_segment(self):
+        with self.assertRaises(ValueError):
+            decode_segment(bytes(100))
+
+    def test_extensions(self):
+        self.assertEqual(codec_extension('deflate'), '.wav')
+        self.assertEqual(len({codec_extension(codec) for codec in CODECS}), len(CODECS))
+
+
+class ExtractArchiveTest(unittest.TestCase):
+
+    def test_archive_of_compressed_and_wav_segments(self):
+        with tempfile.TemporaryDirectory() as path:
+            first, second = samples(np.int16, frames=1000), samples(np.int16, frames=700)
+            write_wav(os.path.join(path, 'source.wav'), second, RATE)
+            archive = os.path.join(path, 'data.zip')
+            with zipfile.ZipFile(archive, 'w') as zf:
+                zf.writestr('segment_0001' + codec_extension('delta-zlib'), encode_segment(first, RATE, 'delta-zlib'))
+                zf.write(os.path.join(path, 'source.wav'), 'segment_0002.wav')
+
+            destination = os.path.join(path, 'out')
+            extract_archive(archive, destination)
+            for name, original in (('segment_0001.wav', first), ('segment_0002.wav', second)):
+                decoded, rate = read_wav(os.path.join(destination, name))
+                self.assertEqual(rate, RATE)
+                np.testing.assert_array_equal(decoded, original)
+
+
+if __name__ == '__main__':
+    unittest.main()
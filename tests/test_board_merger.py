@@ -0,0 +1,122 @@
+"""Tests of the merge of several boards recorded together and of their alignment despite the drift of their clocks.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import unittest
+
+import numpy as np
+
+from Processes.board_merger import BOARD_TIMEOUT, CLOCK_MIN_BUFFERS, BoardClock, BoardMerger, BoardStats
+from Processes.ring_buffer import SharedRingBuffer
+
+RATE = 1000
+CHUNK = 100
+UNITS = 10 ** 5  # Sample value of one second: every sample holds the time when it was recorded
+FRAME_UNITS = UNITS // RATE
+
+
+class SimulatedBoard:
+    # Board of one channel whose ADC records at RATE * (1 + DRIFT / 10 ** 6) Hz from START seconds
+
+    def __init__(self, start, drift=0.0):
+        self.start = start
+        self.period = 1 / (RATE * (1 + drift / 10 ** 6))
+        self.ring = SharedRingBuffer(64, CHUNK * 4, 4)
+        self.frames = 0
+
+    def next_time(self):
+        return self.start + self.frames * self.period
+
+    def record_chunk(self):
+        times = self.start + (self.frames + np.arange(CHUNK)) * self.period
+        self.ring.put(np.rint(times * UNITS).astype('<i4').tobytes(), times[0])
+        self.frames += CHUNK
+
+
+class BoardClockTest(unittest.TestCase):
+
+    def test_period_and_times(self):
+        clock = BoardClock(RATE, 64)
+        period = 1 / 1000.05
+        for buffer in range(100):
+            clock.add(buffer * CHUNK, 5000.0 + buffer * CHUNK * period)
+        self.assertEqual(clock.measured, 64)
+        self.assertAlmostEqual(clock.time(12345), 5000.0 + 12345 * period, places=6)
+        self.assertAlmostEqual(clock.period, period, delta=period * 1e-9)
+        self.assertAlmostEqual(clock.frame(5010.0), 10 / period, places=3)
+
+    def test_nominal_period_before_the_measures(self):
+        clock = BoardClock(RATE, 64)
+        clock.add(0, 10.0)
+        self.assertAlmostEqual(clock.time(RATE), 11.0)
+
+    def test_period_is_kept_after_a_reset(self):
+        clock = BoardClock(RATE, 64)
+        for buffer in range(40):
+            clock.add(buffer * CHUNK, buffer * CHUNK * 0.00099)
+        clock.time(0)
+        clock.reset()
+        clock.add(10 ** 6, 2000.0)
+        clock.add(10 ** 6 + CHUNK, 2000.0 + CHUNK * 0.0011)
+        # Two measures are not enough to measure the period again
+        self.assertAlmostEqual(clock.time(10 ** 6 + 1000), 2000.0 + 0.99 + 0.0011 * CHUNK / 2 - 0.00099 * CHUNK / 2)
+        self.assertAlmostEqual(clock.period, 0.00099)
+
+
+class BoardMergerTest(unittest.TestCase):
+
+    def setUp(self):
+        # Board 1 starts later and its clock is 1000 ppm fast: it records one more frame every second
+        self.boards = [SimulatedBoard(100.0), SimulatedBoard(100.0537, drift=1000)]
+        self.stats = BoardStats(2)
+        self.merger = BoardMerger([board.ring for board in self.boards], [1, 1], 4, RATE, CHUNK, self.stats)
+
+    def record(self, seconds, boards=(0, 1)):
+        # Record the chunks of the boards in time order, and merge them as they come
+        merged = []
+        end = self.boards[0].next_time() + seconds
+        while True:
+            board = min((self.boards[index] for index in boards), key=SimulatedBoard.next_time)
+            if board.next_time() >= end:
+                return merged
+            board.record_chunk()
+            self.merger.poll()
+            merged += self.merger.merge(now=board.next_time())
+
+    def test_boards_stay_aligned(self):
+        merged = self.record(40)
+        self.assertTrue(self.merger.started)
+        self.assertGreater(len(merged), 350)
+        samples = np.frombuffer(b''.join(data for data, _ in merged), dtype='<i4').reshape(-1, 2)
+        # The frames merged together were recorded within one frame, although the boards drifted by 40 frames
+        self.assertLessEqual(np.abs(samples[:, 1] - samples[:, 0]).max(), FRAME_UNITS)
+        # The merge starts at the first frame of board 1
+        self.assertGreaterEqual(samples[0, 0], self.boards[1].start * UNITS - FRAME_UNITS)
+        # The ADC time of a merged chunk is the time of its first frame of board 0
+        for data, adc_time in merged[::50]:
+            self.assertAlmostEqual(np.frombuffer(data, dtype='<i4')[0] / UNITS, adc_time, places=4)
+
+        snapshot = self.stats.snapshot()
+        self.assertAlmostEqual(snapshot['board_drift_ppm'][1], 1000, delta=1)
+        self.assertAlmostEqual(snapshot['board_frames_dropped'][1], 40, delta=5)
+        self.assertEqual(snapshot['board_frames_dropped'][0], 0)
+        self.assertEqual(snapshot['board_frames_missing'], [0, 0])
+
+    def test_no_merge_before_the_clocks_are_measured(self):
+        self.assertEqual(self.record(CLOCK_MIN_BUFFERS * CHUNK / RATE - 0.5), [])
+        self.assertFalse(self.merger.started)
+
+    def test_late_board_is_replaced_by_zeros(self):
+        self.record(10)
+        self.assertFalse(self.merger.late)
+        # Board 1 stops delivering its frames: the merge waits for it BOARD_TIMEOUT seconds
+        self.assertEqual(self.record(BOARD_TIMEOUT - 0.2, boards=(0,)), [])
+        waiting = self.record(BOARD_TIMEOUT, boards=(0,))
+        self.assertTrue(self.merger.late)
+        samples = np.frombuffer(b''.join(data for data, _ in waiting), dtype='<i4').reshape(-1, 2)
+        self.assertEqual(samples[-CHUNK:, 1].tolist(), [0] * CHUNK)
+        self.assertGreater(self.stats.snapshot()['board_frames_missing'][1], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""Tests of the tuning of the buffers with several boards recorded together.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import os
+import tempfile
+import unittest
+
+from Processes.buffer_tuning import PROFILE_NAME, BufferProfile, calibrate_chunk, ring_slots
+from Processes.capture_backends import board_backends, create_backend, paInt16
+
+BOARDS_SPEC = 'synthetic:signal=sine,speed=4|synthetic:signal=clicks,drift=30'  # One backend per board
+
+
+class MultiBoardProfileTest(unittest.TestCase):
+
+    def test_the_multi_board_spec_is_not_a_backend(self):
+        with self.assertRaises(ValueError):
+            create_backend(BOARDS_SPEC)
+
+    def test_profile_of_the_first_board(self):
+        # The buffers are calibrated with the backend of the first board, as in main.py
+        with tempfile.TemporaryDirectory() as path:
+            profile = BufferProfile(os.path.join(path, PROFILE_NAME), board_backends(BOARDS_SPEC, 2)[0], paInt16, 7,
+                                    32000)
+            self.assertEqual(profile.backend, 'synthetic:signal=sine,speed=4')
+            self.assertIn('/synthetic:speed=4/', profile.key)
+            chunk, trials = calibrate_chunk(profile.backend, profile.audio_format, profile.channels, profile.rate,
+                                            candidates=(4096,), seconds=0.5)
+            self.assertEqual(chunk, 4096)
+            self.assertEqual(list(trials), [4096])
+
+
+class ProfileKeyTest(unittest.TestCase):
+
+    def key(self, backend, channels=7, rate=32000):
+        return BufferProfile(PROFILE_NAME, backend, paInt16, channels, rate).key
+
+    def test_options_without_effect_on_the_timing_keep_the_calibration(self):
+        self.assertEqual(self.key('synthetic:signal=sine,speed=4'),
+                         self.key('synthetic:signal=noise,duration=5,speed=4'))
+        self.assertEqual(self.key('portaudio:board=0'), self.key('portaudio'))
+
+    def test_timing_parameters_change_the_key(self):
+        self.assertNotEqual(self.key('synthetic:speed=4'), self.key('synthetic:speed=8'))
+        self.assertNotEqual(self.key('synthetic'), self.key('synthetic:jitter=0.01'))
+        self.assertNotEqual(self.key('synthetic'), self.key('synthetic', channels=16))
+        self.assertNotEqual(self.key('synthetic'), self.key('synthetic', rate=48000))
+        self.assertNotEqual(self.key('synthetic'), self.key('replay:path=x.wav'))
+
+
+class ProfileUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.profile = BufferProfile(os.path.join(self.directory.name, PROFILE_NAME), 'synthetic:speed=4', paInt16, 7,
+                                     32000)
+        self.profile._save({'chunk': 1024, 'ring_slots': 500, 'trials': {}, 'ring_high_water_seconds': 0})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_calibrated_source_is_not_measured_again(self):
+        self.assertEqual(self.profile.buffers(4096, 64), (1024, 500))
+        other = BufferProfile(self.profile.filename, 'synthetic:speed=4,duration=60', paInt16, 7, 32000)
+        self.assertEqual(other.entry(), self.profile.entry())
+
+    def test_ring_is_sized_on_the_highest_occupancy(self):
+        # 40 chunks of 1024 frames at 32 kHz: 1.28 s, the ring holds 4 times as much but at least MIN_RING_SECONDS
+        self.profile.record_session(1024, 0, 40, 0)
+        self.assertEqual(self.profile.entry()['ring_slots'], ring_slots(4 * 1.28, 32000, 1024))
+        self.profile.record_session(1024, 0, 10, 0)
+        self.assertEqual(self.profile.entry()['ring_slots'], ring_slots(4 * 1.28, 32000, 1024))
+        self.assertAlmostEqual(self.profile.entry()['ring_high_water_seconds'], 1.28)
+
+    def test_overflows_and_overruns(self):
+        self.profile.record_session(1024, 3, 10, 2)
+        entry = self.profile.entry()
+        # Larger buffers from the next start, and a ring twice as large (in seconds of audio)
+        self.assertEqual(entry['chunk'], 2048)
+        self.assertEqual(entry['ring_slots'], 500)
+        self.assertEqual(self.profile.buffers(4096, 64), (2048, 500))
+        # A recording made with other buffers does not change the profile
+        self.profile.record_session(512, 3, 10, 2)
+        self.assertEqual(self.profile.entry(), entry)
+
+
+if __name__ == '__main__':
+    unittest.main()
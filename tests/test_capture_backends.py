@@ -0,0 +1,129 @@
+"""Tests of the sources of audio data of the record process which do not need audio hardware.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import os
+import tempfile
+import time
+import unittest
+import zipfile
+
+import numpy as np
+
+from Processes.audio_codecs import encode_segment, write_wav
+from Processes.capture_backends import (ReplayBackend, SyntheticBackend, board_backends, create_backend, paContinue,
+                                        paInputOverflow, paInt16, paInt32)
+
+RATE = 8000
+CHUNK = 800
+CHANNELS = 2
+
+
+class Collector:
+    # Stream callback keeping the buffers delivered by a backend
+
+    def __init__(self):
+        self.buffers = []
+        self.statuses = []
+        self.adc_times = []
+
+    def __call__(self, in_data, frame_count, time_info, status):
+        self.buffers.append(in_data)
+        self.statuses.append(status)
+        self.adc_times.append(time_info['input_buffer_adc_time'])
+        return None, paContinue
+
+
+def run(backend, audio_format=paInt16, timeout=10):
+    # Deliver all the buffers of a backend which ends by itself
+    collector = Collector()
+    if not backend.open(audio_format, CHANNELS, RATE, CHUNK, collector):
+        raise RuntimeError('The backend did not open.')
+    deadline = time.monotonic() + timeout
+    while backend.is_active() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    backend.close()
+    return collector
+
+
+class SyntheticBackendTest(unittest.TestCase):
+
+    def test_duration(self):
+        collector = run(SyntheticBackend('sine', speed=0, duration=2))
+        self.assertEqual(len(collector.buffers), 2 * RATE // CHUNK)
+        self.assertTrue(all(len(data) == CHUNK * CHANNELS * 2 for data in collector.buffers))
+        samples = np.frombuffer(b''.join(collector.buffers), dtype='<i2').reshape(-1, CHANNELS)
+        self.assertGreater(samples.max(), 30000)
+
+    def test_32_bit_samples(self):
+        collector = run(SyntheticBackend('noise', speed=0, duration=1), audio_format=paInt32)
+        self.assertTrue(all(len(data) == CHUNK * CHANNELS * 4 for data in collector.buffers))
+
+    def test_lost_buffers_are_flagged(self):
+        collector = run(SyntheticBackend('noise', speed=0, duration=20, dropout=0.2, seed=3))
+        lost = 20 * RATE // CHUNK - len(collector.buffers)
+        self.assertGreater(lost, 0)
+        # The buffer following lost buffers has the input overflow flag
+        self.assertIn(collector.statuses.count(paInputOverflow), range(1, lost + 1))
+        self.assertIn(0, collector.statuses)
+
+    def test_real_time_delivery(self):
+        start = time.monotonic()
+        collector = run(SyntheticBackend('silence', speed=4, duration=2))
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+        # The buffers are time-stamped on a fixed grid
+        np.testing.assert_allclose(np.diff(collector.adc_times), CHUNK / RATE / 4)
+
+    def test_clock_drift(self):
+        collector = run(SyntheticBackend('silence', speed=4, duration=1, drift=100000))
+        np.testing.assert_allclose(np.diff(collector.adc_times), CHUNK / RATE / 4 / 1.1)
+
+    def test_unknown_signal(self):
+        with self.assertRaises(ValueError):
+            SyntheticBackend('chirp').open(paInt16, CHANNELS, RATE, CHUNK, Collector())
+
+
+class ReplayBackendTest(unittest.TestCase):
+
+    def test_replay_of_wav_files_and_archives(self):
+        with tempfile.TemporaryDirectory() as path:
+            samples = np.random.default_rng(0).integers(-2000, 2000, (3000, CHANNELS)).astype('<i2')
+            wav = os.path.join(path, 'segment_0001.wav')
+            write_wav(wav, samples[:1300], RATE)
+            archive = os.path.join(path, 'data.zip')
+            with zipfile.ZipFile(archive, 'w') as zf:
+                zf.writestr('segment_0002.dlz', encode_segment(samples[1300:], RATE, 'delta-zlib'))
+
+            collector = run(ReplayBackend('{};{}'.format(wav, archive), speed=0))
+            # The segments are cut in buffers of CHUNK frames, the last incomplete buffer is not delivered
+            replayed = np.frombuffer(b''.join(collector.buffers), dtype='<i2').reshape(-1, CHANNELS)
+            np.testing.assert_array_equal(replayed, samples[:3000 // CHUNK * CHUNK])
+
+    def test_replay_of_other_channels(self):
+        with tempfile.TemporaryDirectory() as path:
+            wav = os.path.join(path, 'segment_0001.wav')
+            write_wav(wav, np.zeros((2000, 3), dtype='<i2'), RATE)
+            backend = ReplayBackend(wav, speed=0)
+            backend._prepare(paInt16, CHANNELS, RATE, CHUNK)
+            with self.assertRaises(ValueError):
+                list(backend._buffers())
+
+class BackendSpecTest(unittest.TestCase):
+
+    def test_create_backend(self):
+        backend = create_backend('synthetic:signal=noise,speed=4,dropout=0.1')
+        self.assertIsInstance(backend, SyntheticBackend)
+        self.assertEqual((backend.signal, backend.speed, backend.dropout), ('noise', 4.0, 0.1))
+        with self.assertRaises(ValueError):
+            create_backend('microphone')
+
+    def test_board_backends(self):
+        self.assertEqual(board_backends('portaudio', 2), ['portaudio:board=0', 'portaudio:board=1'])
+        self.assertEqual(board_backends('synthetic:speed=2', 2), ['synthetic:speed=2'] * 2)
+        self.assertEqual(board_backends('synthetic|portaudio:board=3', 2), ['synthetic', 'portaudio:board=3'])
+        with self.assertRaises(ValueError):
+            board_backends('synthetic|synthetic', 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""Tests of the log handler shared by the processes of the recording.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+
+from CustomLogging.clog import CustomLogHandler
+
+FUTURE = time.time() + 3600
+
+
+def log_from_child(handler, message):
+    record = logging.LogRecord('record', logging.INFO, __file__, 0, message, None, None)
+    handler.handle(record)
+
+
+class CustomLogHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'recording.log')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def handler(self, **kwargs):
+        handler = CustomLogHandler(self.filename, **kwargs)
+        handler.setFormatter(logging.Formatter('%(name)s %(levelname)s %(message)s'))
+        return handler
+
+    def log(self, handler, message, *args, created=0.0):
+        # CREATED is the time of the record relative to FUTURE: the flusher thread never sees the windows end
+        record = logging.LogRecord('record', logging.WARNING, __file__, 0, message, args, None)
+        record.created = FUTURE + created
+        handler.handle(record)
+
+    def lines(self):
+        with open(self.filename) as f:
+            return f.read().splitlines()
+
+    def test_repeated_messages_are_summarized(self):
+        handler = self.handler(rate_limit=3, dedup_window=10)
+        for _ in range(10):
+            self.log(handler, 'ALSA lib pcm.c: underrun occurred')
+        self.log(handler, 'Another message')
+        handler.close()
+        self.assertEqual(self.lines(), ['record WARNING ALSA lib pcm.c: underrun occurred'] * 3 + [
+            'record WARNING Another message',
+            'record WARNING Previous message repeated 7 more times: ALSA lib pcm.c: underrun occurred'])
+
+    def test_messages_with_other_arguments_are_not_repeats(self):
+        handler = self.handler(rate_limit=1)
+        for board in range(3):
+            self.log(handler, 'Board %d reconnected', board)
+        handler.close()
+        self.assertEqual(len(self.lines()), 3)
+
+    def test_rate_limit_window(self):
+        handler = self.handler(rate_limit=2, dedup_window=10)
+        for created in (0.0, 1.0, 2.0, 3.0, 12.0):
+            self.log(handler, 'Input overflow', created=created)
+        handler.close()
+        # The window is over at the fifth record: the suppressed records are summarized and the message logged again
+        self.assertEqual(self.lines(), ['record WARNING Input overflow'] * 2 + [
+            'record WARNING Previous message repeated 2 more times: Input overflow',
+            'record WARNING Input overflow'])
+
+    def test_records_are_dropped_when_the_buffer_is_full(self):
+        handler = self.handler(capacity=3)
+        for n in range(10):
+            self.log(handler, 'Message %d', n)
+        handler.close()
+        self.assertEqual(self.lines(), ['record WARNING Message 0', 'record WARNING Message 1',
+                                        'record WARNING Message 2',
+                                        'logging WARNING 7 log records dropped (log buffer full).'])
+
+    def test_records_of_a_child_process(self):
+        handler = self.handler(flush_period=0.1)
+        child = multiprocessing.Process(target=log_from_child, args=(handler, 'Recording started'))
+        child.start()
+        child.join()
+        handler.close()
+        # The records left in the buffer of the child are sent when it exits
+        self.assertEqual(child.exitcode, 0)
+        self.assertEqual(self.lines(), ['record INFO Recording started'])
+
+
+if __name__ == '__main__':
+    unittest.main()
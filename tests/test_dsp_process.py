@@ -0,0 +1,143 @@
+"""Tests of the DSP stage: levels of the channels and decimation of the stream.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import ctypes
+import multiprocessing
+import time
+import unittest
+
+import numpy as np
+
+from Processes.dsp_process import (ChannelLevels, PolyphaseDecimator, chunk_levels, dsp_monitor, lowpass_filter,
+                                   monitor_slot_size)
+from Processes.live_tap import LiveSubscriber
+from Processes.ring_buffer import SharedRingBuffer
+from Processes.shutdown import ShutdownControl
+
+RATE = 8000
+
+
+def sine(frequency, frames, amplitude=0.5):
+    return amplitude * np.sin(2 * np.pi * frequency * np.arange(frames) / RATE)
+
+
+class ChunkLevelsTest(unittest.TestCase):
+
+    def test_levels(self):
+        samples = np.zeros((800, 3), dtype=np.int16)
+        samples[:, 0] = np.rint(sine(100, 800) * 32768)
+        samples[:, 1] = 16384
+        samples[:2, 2] = [32767, -32768]
+        rms, peak, dc, clipped = chunk_levels(samples)
+        np.testing.assert_allclose(rms, [0.5 / np.sqrt(2), 0.5, np.sqrt(2 / 800)], rtol=1e-3)
+        np.testing.assert_allclose(peak, [0.5, 0.5, 1], rtol=1e-3)
+        np.testing.assert_allclose(dc, [0, 0.5, 0], atol=1e-4)
+        self.assertEqual(clipped.tolist(), [0, 0, 2])
+
+    def test_shared_levels(self):
+        levels = ChannelLevels(2)
+        levels.update(np.array([0.1, 0.2]), np.array([0.3, 0.4]), np.array([0.0, 0.01]), np.array([0, 3]))
+        levels.update(np.array([0.1, 0.2]), np.array([0.3, 0.4]), np.array([0.0, 0.01]), np.array([1, 3]))
+        levels.skip(2)
+        snapshot = levels.snapshot()
+        self.assertEqual(snapshot['channel_clipped_samples'], [1, 6])
+        self.assertEqual(snapshot['channel_peak'], [0.3, 0.4])
+        self.assertEqual((snapshot['dsp_chunks'], snapshot['dsp_skipped_chunks']), (2, 2))
+
+
+class PolyphaseDecimatorTest(unittest.TestCase):
+
+    def test_same_output_as_filtering_then_downsampling(self):
+        factor = 8
+        signal = np.random.default_rng(0).normal(0, 1000, (1000, 2))
+        taps = lowpass_filter(factor)
+        expected = np.stack([np.convolve(signal[:, channel], taps)[:len(signal)][::factor] for channel in range(2)],
+                            axis=1)
+        output = PolyphaseDecimator(factor, 2).process(signal)
+        np.testing.assert_allclose(output, expected, rtol=1e-4, atol=1e-2)
+
+    def test_output_does_not_depend_on_the_chunks(self):
+        signal = np.random.default_rng(1).normal(0, 1000, (3000, 3))
+        whole = PolyphaseDecimator(4, 3).process(signal)
+        decimator = PolyphaseDecimator(4, 3)
+        bounds = [0, 5, 6, 257, 1000, 1003, 3000]
+        parts = [decimator.process(signal[start:stop]) for start, stop in zip(bounds[:-1], bounds[1:])]
+        np.testing.assert_allclose(np.concatenate(parts), whole, rtol=1e-4, atol=1e-2)
+        self.assertEqual(len(whole), 3000 // 4)
+
+    def test_low_pass(self):
+        # The decimated rate is 1000 Hz: 100 Hz goes through, 3000 Hz would alias and is removed
+        decimator = PolyphaseDecimator(8, 2)
+        output = decimator.process(np.stack([sine(100, 8000), sine(3000, 8000)], axis=1))[200:]
+        rms = np.sqrt((output ** 2).mean(axis=0))
+        self.assertAlmostEqual(rms[0], 0.5 / np.sqrt(2), delta=0.01)
+        self.assertLess(rms[1], 0.5 * 1e-3)
+
+    def test_reset(self):
+        signal = np.random.default_rng(2).normal(0, 1000, (800, 1))
+        decimator = PolyphaseDecimator(4, 1)
+        first = decimator.process(signal)
+        decimator.process(signal)
+        decimator.reset()
+        np.testing.assert_array_equal(decimator.process(signal), first)
+
+
+def subscribe(name, timeout=10):
+    # Subscriber of a live tap, once its publisher created it
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return LiveSubscriber(name)
+        except (FileNotFoundError, ValueError):
+            # The segment does not exist yet, or its header is not written yet
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+class DspMonitorTest(unittest.TestCase):
+
+    def test_levels_of_the_chunks_of_the_ring(self):
+        chunk, channels = 400, 2
+        ring = SharedRingBuffer(16, chunk * channels * 2, channels * 2)
+        observer = ring.add_observer()
+        levels = ChannelLevels(channels)
+        shutdown = ShutdownControl()
+        no_error = multiprocessing.Value(ctypes.c_bool, False)
+        process = multiprocessing.Process(target=dsp_monitor, args=(
+            no_error, no_error, ring, observer, channels, 2, RATE, levels, 4, 'mch_test_monitor', shutdown))
+        process.start()
+        try:
+            tap = subscribe('mch_test_monitor')
+            samples = np.zeros((chunk, channels), dtype=np.int16)
+            samples[:, 1] = -32768
+            for _ in range(5):
+                ring.put(samples.tobytes())
+            # The decimated stream is published for the subscribers of the monitor tap
+            published = []
+            while sum(len(item.samples) for item in published) < 5 * chunk // 4:
+                published += tap.read(timeout=10)
+            tap.close()
+            self.assertEqual(tap.rate, RATE // 4)
+            decimated = np.concatenate([item.samples for item in published])
+            self.assertEqual(decimated.shape, (5 * chunk // 4, channels))
+            self.assertEqual(decimated[-1].tolist(), [0, -32768])
+        finally:
+            shutdown.begin()
+            process.join(10)
+        self.assertEqual(process.exitcode, 0)
+        snapshot = levels.snapshot()
+        self.assertEqual(snapshot['dsp_chunks'], 5)
+        self.assertEqual(snapshot['channel_clipped_samples'], [0, 5 * chunk])
+        self.assertEqual(snapshot['channel_peak'], [0.0, 1.0])
+        # The DSP stage only observes the chunks: they are left to the save process
+        self.assertEqual(ring.occupancy(), 5)
+
+    def test_monitor_slot_size(self):
+        # A slot holds the decimated frames of a chunk, whatever the phase of the decimation
+        self.assertEqual(monitor_slot_size(1024, 7, 2, 3), 343 * 7 * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
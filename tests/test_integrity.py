@@ -0,0 +1,150 @@
+"""Tests of the integrity checksums of the recordings and of their verification.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import io
+import os
+import tempfile
+import unittest
+import zipfile
+
+import numpy as np
+
+from Processes.integrity import (MANIFEST_NAME, SEGMENT_PREFIX, SessionManifest, find_sessions, stored_segments,
+                                 verify_segment, verify_sessions)
+from Processes.recording_container import ContainerWriter, encode_blocks
+from Processes.wav_writer import WAV_HEADER_SIZE, SegmentWriter
+
+RATE = 1000
+CHANNELS = 2
+FRAME_SIZE = CHANNELS * 2
+
+
+def samples(frames, seed=0):
+    return np.random.default_rng(seed).integers(-30000, 30000, (frames, CHANNELS)).astype('<i2')
+
+
+def damage(filename, frame):
+    # Flip the bits of the first sample of FRAME in a .wav segment
+    with open(filename, 'r+b') as f:
+        f.seek(WAV_HEADER_SIZE + frame * FRAME_SIZE)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 0xff]))
+
+
+class SessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.session = os.path.join(self.directory.name, 'session')
+        os.mkdir(self.session)
+        self.manifest = SessionManifest(self.session)
+
+    def tearDown(self):
+        self.manifest.close()
+        self.directory.cleanup()
+
+    def segment(self, number, frames):
+        # Segment written by the save process, with its record in the manifest
+        name = SEGMENT_PREFIX + str(number)
+        writer = SegmentWriter(os.path.join(self.session, name + '.wav'), CHANNELS, 2, RATE, frames,
+                               checksum_frames=RATE)
+        writer.write(samples(frames, number).tobytes())
+        writer.close()
+        self.manifest.record(name, writer.checksums())
+        return os.path.join(self.session, name + '.wav')
+
+    def compress(self, *filenames):
+        # Segments stored in the container of the session, as the compression process does
+        writer = ContainerWriter(os.path.join(self.session, 'data.mchr'), CHANNELS, 2, RATE, 'raw')
+        for filename in filenames:
+            writer.append(encode_blocks(filename, 'raw'))
+            os.remove(filename)
+        writer.close()
+
+    def verify(self, paths=None):
+        output = io.StringIO()
+        failures = verify_sessions(paths or [self.session], workers=1, output=output)
+        return failures, output.getvalue()
+
+    def test_manifest(self):
+        self.segment(0, 2500)
+        self.segment(1, 10)
+        with open(os.path.join(self.session, MANIFEST_NAME), 'a') as f:
+            f.write('{"segment": "audio data minute 2", "fra')
+        records = SessionManifest(self.session).read()
+        # The line cut by a crash is ignored
+        self.assertEqual(list(records), [SEGMENT_PREFIX + '0', SEGMENT_PREFIX + '1'])
+        self.assertEqual(records[SEGMENT_PREFIX + '0']['frames'], 2500)
+        self.assertEqual(len(records[SEGMENT_PREFIX + '0']['blocks']), 3)
+        self.assertEqual(records[SEGMENT_PREFIX + '1']['block_frames'], RATE)
+
+    def test_find_sessions(self):
+        empty = os.path.join(self.directory.name, 'empty')
+        os.mkdir(empty)
+        self.segment(0, 100)
+        self.assertEqual(find_sessions([self.directory.name]), [empty, self.session])
+        self.assertEqual(find_sessions([self.session]), [self.session])
+
+    def test_damaged_seconds_are_located(self):
+        filename = self.segment(0, 2500)
+        task = (SEGMENT_PREFIX + '0', 'wav', filename, None, self.manifest.read()[SEGMENT_PREFIX + '0'])
+        self.assertEqual(verify_segment(task), (SEGMENT_PREFIX + '0', 2500 * FRAME_SIZE, []))
+        damage(filename, 1200)
+        name, size, problems = verify_segment(task)
+        self.assertEqual(problems, ['checksum mismatch in the seconds 1-2'])
+        damage(filename, 2400)
+        self.assertEqual(verify_segment(task)[2], ['checksum mismatch in the seconds 1-2, 2-2.5'])
+
+    def test_unreadable_segment(self):
+        filename = self.segment(0, 100)
+        with open(filename, 'r+b') as f:
+            f.write(b'junk')
+        name, size, problems = verify_segment((SEGMENT_PREFIX + '0', 'wav', filename, None,
+                                               self.manifest.read()[SEGMENT_PREFIX + '0']))
+        self.assertEqual(size, 0)
+        self.assertTrue(problems[0].startswith('unreadable (wav)'))
+
+    def test_compressed_session(self):
+        first, second = self.segment(0, 1500), self.segment(1, 1500)
+        self.compress(first, second)
+        self.segment(2, 700)
+        self.assertEqual({name: kind for name, (kind, _, _) in stored_segments(self.session).items()},
+                         {SEGMENT_PREFIX + '0': 'mchr', SEGMENT_PREFIX + '1': 'mchr', SEGMENT_PREFIX + '2': 'wav'})
+        failures, output = self.verify()
+        self.assertEqual(failures, 0)
+        self.assertIn('3 segments verified, 0 damaged, 0 missing, 0 without checksum', output)
+
+    def test_segment_damaged_before_the_compression(self):
+        first, second = self.segment(0, 1500), self.segment(1, 1500)
+        damage(second, 100)
+        self.compress(first, second)
+        failures, output = self.verify()
+        self.assertEqual(failures, 1)
+        self.assertIn('audio data minute 1: checksum mismatch in the seconds 0-1', output)
+
+    def test_missing_and_unchecked_segments(self):
+        os.remove(self.segment(0, 100))
+        # A segment without frames has no data in the archive
+        self.manifest.record(SEGMENT_PREFIX + '1', {'frames': 0, 'block_frames': RATE, 'crc32': '00000000',
+                                                     'blocks': []})
+        with zipfile.ZipFile(os.path.join(self.session, 'data.zip'), 'w') as zf:
+            zf.writestr(SEGMENT_PREFIX + '2.wav', b'')
+        failures, output = self.verify()
+        self.assertEqual(failures, 1)
+        self.assertIn('audio data minute 0: missing from the archive', output)
+        self.assertIn('no checksum for audio data minute 2', output)
+        self.assertIn('0 segments verified, 0 damaged, 1 missing, 1 without checksum', output)
+
+    def test_unreadable_archive(self):
+        self.segment(0, 100)
+        with open(os.path.join(self.session, 'data.zip'), 'wb') as f:
+            f.write(b'not a zip archive')
+        failures, output = self.verify()
+        self.assertEqual(failures, 1)
+        self.assertIn('archive unreadable', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
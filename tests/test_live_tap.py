@@ -0,0 +1,149 @@
+"""Tests of the live tap: publication of the live stream to local subscribers.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import ctypes
+import multiprocessing
+import os
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from CustomExceptions.custom_handlers import SubscriberDropped
+from Processes import live_tap
+from Processes.live_tap import ACTIVE, DROPPED, FREE, LivePublisher, LiveSubscriber, live_publisher
+from Processes.ring_buffer import SharedRingBuffer
+from Processes.shutdown import ShutdownControl
+
+CHANNELS = 2
+FRAMES = 64
+SLOTS = 8
+NAME = 'mch_test_tap_{}'.format(os.getpid())
+
+
+def chunk(value):
+    return np.full((FRAMES, CHANNELS), value, dtype='<i2').tobytes()
+
+
+class LiveTapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = LivePublisher(CHANNELS, 2, 8000, FRAMES * CHANNELS * 2, NAME, SLOTS, max_subscribers=2)
+
+    def tearDown(self):
+        self.publisher.close()
+
+    def test_subscriber_reads_the_chunks_published_after_it_subscribed(self):
+        self.publisher.publish(chunk(1))
+        with LiveSubscriber(NAME) as tap:
+            self.assertEqual((tap.channels, tap.rate), (CHANNELS, 8000))
+            self.assertEqual(self.publisher.subscribers, 1)
+            self.assertEqual(tap.read(timeout=0), [])
+            self.publisher.publish(chunk(2), lost_frames=5, timestamp=12.5)
+            self.publisher.publish(chunk(3))
+            first, second = tap.read(timeout=1)
+            self.assertEqual((first.seq, first.lost_frames, first.timestamp), (1, 5, 12.5))
+            self.assertEqual(first.samples.shape, (FRAMES, CHANNELS))
+            self.assertTrue((first.samples == 2).all())
+            self.assertTrue((second.samples == 3).all())
+        self.assertEqual(self.publisher.subscribers, 0)
+
+    def test_slow_subscriber_is_dropped_and_frees_its_slot(self):
+        tap = LiveSubscriber(NAME)
+        for value in range(SLOTS):
+            self.publisher.publish(chunk(value))
+        self.assertEqual(self.publisher.dropped, 1)
+        self.assertEqual(self.publisher.subscribers, 0)
+        with self.assertRaises(SubscriberDropped):
+            tap.read(timeout=0)
+        with self.assertRaises(SubscriberDropped):
+            tap.read(timeout=0)
+        tap.close()
+        # The slot is free again: two subscribers can be attached
+        with LiveSubscriber(NAME), LiveSubscriber(NAME):
+            with self.assertRaises(ConnectionRefusedError):
+                LiveSubscriber(NAME)
+
+    def test_publisher_frees_the_slots_of_the_subscribers_which_do_not_come_back(self):
+        tap = LiveSubscriber(NAME)
+        other = LiveSubscriber(NAME)
+        # A subscriber which exited without unsubscribing
+        other._subscriber['pid'] = 2 ** 31 - 1
+        for value in range(SLOTS):
+            self.publisher.publish(chunk(value))
+        states = self.publisher._layout.subscribers['state']
+        self.assertEqual(sorted(states.tolist()), [DROPPED, DROPPED])
+        with mock.patch.object(live_tap, 'CLEAN_UP_PERIOD', 0), mock.patch.object(live_tap, 'DROPPED_GRACE', 0.1):
+            self.publisher.clean_up()
+            time.sleep(0.2)
+            self.publisher.clean_up()
+        self.assertEqual(states.tolist(), [FREE, FREE])
+        # The slot was taken by another subscriber: the dropped one does not free it
+        with LiveSubscriber(NAME) as new:
+            with self.assertRaises(SubscriberDropped):
+                tap.read(timeout=0)
+            self.assertEqual(self.publisher._layout.subscribers['state'][new._index], ACTIVE)
+        other.close()
+
+    def test_end_of_the_stream(self):
+        tap = LiveSubscriber(NAME)
+        self.publisher.publish(chunk(1))
+        self.publisher.close()
+        self.assertEqual(len(list(tap)), 1)
+        tap.close()
+
+    def test_stale_segment_is_replaced(self):
+        tap = LiveSubscriber(NAME)
+        # The publisher did not exit properly: the segment is left behind
+        stale = self.publisher
+        stale._view.release()
+        stale._layout = None
+        stale._segment.close()
+        self.publisher = LivePublisher(CHANNELS, 2, 8000, FRAMES * CHANNELS * 2, NAME, SLOTS)
+        # The subscribers still attached to the stale segment see the end of the stream
+        with self.assertRaises(EOFError):
+            tap.read(timeout=1)
+        tap.close()
+        self.assertEqual(self.publisher.subscribers, 0)
+
+
+class LivePublisherProcessTest(unittest.TestCase):
+
+    def test_chunks_of_the_ring_are_published(self):
+        ring = SharedRingBuffer(16, FRAMES * CHANNELS * 2, CHANNELS * 2)
+        observer = ring.add_observer()
+        shutdown = ShutdownControl()
+        no_error = multiprocessing.Value(ctypes.c_bool, False)
+        process = multiprocessing.Process(target=live_publisher, args=(
+            no_error, no_error, ring, observer, CHANNELS, 2, 8000, NAME, SLOTS, None, shutdown))
+        process.start()
+        try:
+            deadline = time.monotonic() + 10
+            while True:
+                try:
+                    tap = LiveSubscriber(NAME)
+                    break
+                except (FileNotFoundError, ValueError):
+                    # The segment does not exist yet, or its header is not written yet
+                    self.assertLess(time.monotonic(), deadline)
+                    time.sleep(0.05)
+            for value in range(3):
+                ring.put(chunk(value), 1.0 + value)
+            received = []
+            while len(received) < 3:
+                received += tap.read(timeout=10)
+            self.assertEqual([int(item.samples[0, 0]) for item in received], [0, 1, 2])
+        finally:
+            shutdown.begin()
+            process.join(10)
+        # The stream ends with the recording
+        with self.assertRaises(EOFError):
+            tap.read(timeout=1)
+        tap.close()
+        self.assertEqual(process.exitcode, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
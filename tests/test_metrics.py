@@ -0,0 +1,133 @@
+"""Tests of the metrics of the recording pipeline.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from Processes.metrics import (HISTOGRAM_BUCKETS, CombinedMetrics, LatencyHistogram, MetricsExporter,
+                               PipelineMetrics, prometheus_text)
+from Processes.ring_buffer import SharedRingBuffer
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def test_empty_histogram(self):
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.summary(), {'count': 0, 'mean': None, 'p50': None, 'p99': None})
+
+    def test_percentiles_are_accurate_within_a_bucket(self):
+        histogram = LatencyHistogram()
+        for _ in range(98):
+            histogram.record(0.002)
+        histogram.record(0.5)
+        histogram.record(0.5)
+        self.assertEqual(histogram.count(), 100)
+        self.assertAlmostEqual(histogram.mean(), (98 * 0.002 + 1) / 100)
+        for q, value in ((50, 0.002), (98, 0.002), (99, 0.5), (100, 0.5)):
+            self.assertGreaterEqual(histogram.percentile(q), value)
+            self.assertLess(histogram.percentile(q), value * 1.19)
+
+    def test_extreme_values(self):
+        histogram = LatencyHistogram()
+        histogram.record(0)
+        histogram.record(1e9)
+        self.assertEqual(histogram.percentile(50), LatencyHistogram.bucket_bound(0))
+        self.assertEqual(histogram.percentile(100), LatencyHistogram.bucket_bound(HISTOGRAM_BUCKETS - 1))
+
+
+class PipelineMetricsTest(unittest.TestCase):
+
+    def test_record_callback(self):
+        metrics = PipelineMetrics()
+        now = time.monotonic()
+        metrics.record_callback(4096, {'input_buffer_adc_time': now - 0.01, 'current_time': now}, 2,
+                                time.perf_counter())
+        metrics.record_callback(4096, {'input_buffer_adc_time': 0, 'current_time': now}, 1, time.perf_counter())
+        counters = metrics.snapshot()
+        self.assertEqual((counters['chunks_captured'], counters['bytes_captured']), (2, 8192))
+        self.assertEqual((counters['input_overflows'], counters['input_underflows']), (1, 1))
+        # The latency of the ADC is recorded only when the host API gives the ADC time
+        self.assertEqual(metrics.adc_latency.count(), 1)
+        self.assertEqual(metrics.callback_duration.count(), 2)
+
+    def test_combined_metrics(self):
+        boards = [PipelineMetrics(), PipelineMetrics()]
+        boards[0].add('chunks_captured', 3)
+        boards[1].add('chunks_captured', 4)
+        boards[0].adc_latency.record(0.001)
+        boards[1].adc_latency.record(0.003)
+        combined = CombinedMetrics(boards)
+        self.assertEqual(combined.snapshot()['chunks_captured'], 7)
+        histogram = combined.histograms()['adc_latency']
+        self.assertEqual(histogram.count(), 2)
+        self.assertAlmostEqual(histogram.mean(), 0.002)
+
+
+class PrometheusTextTest(unittest.TestCase):
+
+    def test_metric_types(self):
+        histogram = LatencyHistogram()
+        histogram.record(0.25)
+        empty = LatencyHistogram()
+        text = prometheus_text({'bytes_written': 10, 'ring_occupancy': 3, 'level_dbfs': [-20.5, -30.0],
+                                'board_drift_ppm': [0.0, 12.5], 'disk_latency': {}, 'adc_latency': {}},
+                               {'disk_latency': histogram, 'adc_latency': empty}).splitlines()
+        self.assertIn('# TYPE mch_bytes_written_total counter', text)
+        self.assertIn('mch_bytes_written_total 10', text)
+        self.assertIn('# TYPE mch_ring_occupancy gauge', text)
+        self.assertIn('mch_ring_occupancy 3', text)
+        self.assertIn('mch_level_dbfs{channel="1"} -30.0', text)
+        self.assertIn('mch_board_drift_ppm{board="1"} 12.5', text)
+        self.assertIn('# TYPE mch_disk_latency_seconds summary', text)
+        self.assertIn('mch_disk_latency_seconds_sum 0.25', text)
+        self.assertIn('mch_disk_latency_seconds_count 1', text)
+        self.assertIn('mch_adc_latency_seconds{quantile="0.99"} NaN', text)
+        self.assertIn('mch_adc_latency_seconds_count 0', text)
+
+
+class MetricsExporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.metrics = PipelineMetrics()
+        self.ring = SharedRingBuffer(4, 64, 4)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_jsonl_export(self):
+        filename = os.path.join(self.directory.name, 'metrics.jsonl')
+        exporter = MetricsExporter(self.metrics, self.ring, filename, export_format='jsonl')
+        self.ring.put(bytes(64))
+        self.metrics.add('segments_written', 3)
+        self.metrics.add('segments_compressed', 1)
+        exporter.export()
+        self.metrics.add('bytes_written', 1000)
+        exporter.export()
+        with open(filename) as f:
+            first, second = [json.loads(line) for line in f]
+        self.assertEqual(first['ring_occupancy'], 1)
+        self.assertEqual(first['compression_lag_segments'], 2)
+        self.assertNotIn('bytes_written_per_second', first)
+        self.assertGreater(second['bytes_written_per_second'], 0)
+        self.assertEqual(second['disk_latency']['count'], 0)
+
+    def test_prometheus_export_thread(self):
+        filename = os.path.join(self.directory.name, 'mch.prom')
+        exporter = MetricsExporter(self.metrics, self.ring, filename, period=0.05)
+        exporter.start()
+        time.sleep(0.2)
+        self.metrics.add('segments_written')
+        exporter.stop()
+        # The last export is done when the exporter stops, no temporary file is left
+        self.assertEqual(os.listdir(self.directory.name), ['mch.prom'])
+        with open(filename) as f:
+            self.assertIn('mch_segments_written_total 1', f.read().splitlines())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+"""Tests of the benchmark of the record -> save -> compress pipeline, on a short synthetic recording.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import json
+import os
+import tempfile
+import unittest
+
+from Benchmarks import pipeline_benchmark
+
+OPTIONS = ['--channels', '2', '--rates', '8000', '--duration', '2', '--speed', '4', '--segments', '0.5',
+           '--workers', '1', '--ring-slots', '64']
+
+
+class PipelineBenchmarkTest(unittest.TestCase):
+
+    def run_benchmark(self, *options):
+        with tempfile.TemporaryDirectory() as path:
+            output = os.path.join(path, 'results.jsonl')
+            pipeline_benchmark.main(OPTIONS + ['--directory', path, '--output', output] + list(options))
+            with open(output) as f:
+                results = [json.loads(line) for line in f]
+            # The segments of the configurations are deleted
+            self.assertEqual(sorted(os.listdir(path)), ['results.jsonl'])
+        return results
+
+    def test_one_line_per_configuration_and_the_first_failure(self):
+        *results, summary = self.run_benchmark('--chunks', '512', '1024')
+        self.assertEqual([result['chunk'] for result in results], [512, 1024])
+        self.assertIn('first_failure', summary)
+        for result in results:
+            self.assertTrue(result['ok'], result)
+            self.assertEqual(result['overruns'], 0)
+            self.assertEqual(set(result['cpu_seconds']), {'record', 'save', 'compress'})
+            self.assertGreater(result['disk_latency']['count'], 0)
+            self.assertGreater(result['archive_latency']['count'], 0)
+            self.assertGreater(result['written_mb_per_s'], 0)
+
+    def test_several_boards(self):
+        result, _ = self.run_benchmark('--boards', '2')
+        self.assertEqual((result['boards'], result['channels']), (2, 4))
+        self.assertEqual(set(result['exit_codes'].values()), {0})
+        self.assertEqual(set(result['cpu_seconds']), {'record 0', 'record 1', 'merge', 'save', 'compress'})
+
+
+if __name__ == '__main__':
+    unittest.main()
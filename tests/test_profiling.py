@@ -0,0 +1,135 @@
+"""Tests of the profiling mode of the recording.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from Processes.profiling import PROFILE_ENVIRONMENT, Profiling, StackSampler, profiling_requested
+from Processes.supervisor import ProcessSupervisor
+
+
+def wait_for(event):
+    event.wait()
+
+
+def spin_until(event):
+    while not event.is_set():
+        pass
+
+
+def work(seconds):
+    # Target of a profiled process: it is busy, then it sleeps
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+    time.sleep(seconds)
+
+
+def read_folded(filename):
+    # Samples by stack of a folded profile
+    counts = {}
+    with open(filename) as f:
+        for line in f:
+            stack, count = line.rsplit(' ', 1)
+            counts[stack] = int(count)
+    return counts
+
+
+class ProfilingRequestedTest(unittest.TestCase):
+
+    def test_environment(self):
+        for value, requested in (('1', True), ('yes', True), ('0', False), (' ', False)):
+            with self.subTest(value=value), mock.patch.dict(os.environ, {PROFILE_ENVIRONMENT: value}):
+                self.assertEqual(profiling_requested(), requested)
+        with mock.patch.dict(os.environ):
+            os.environ.pop(PROFILE_ENVIRONMENT, None)
+            self.assertFalse(profiling_requested())
+            self.assertTrue(profiling_requested(default=True))
+
+
+class StackSamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.event = threading.Event()
+
+    def tearDown(self):
+        self.event.set()
+        self.directory.cleanup()
+
+    def test_stacks_of_the_threads(self):
+        waiting = threading.Thread(target=wait_for, args=(self.event,), name='waiting')
+        spinning = threading.Thread(target=spin_until, args=(self.event,), name='spinning')
+        waiting.start()
+        spinning.start()
+        sampler = StackSampler(self.directory.name, 'test', root=threading.Thread.run.__code__)
+        for _ in range(20):
+            sampler.sample()
+            time.sleep(0.005)
+        self.event.set()
+        waiting.join()
+        spinning.join()
+        sampler.dump()
+
+        self.assertEqual(sampler.samples, 20)
+        wall = read_folded(sampler.filenames['wall'])
+        (waiting_stack,) = [stack for stack in wall if stack.startswith('waiting;')]
+        # The stacks start below the root frame, from the target of the thread
+        self.assertTrue(waiting_stack.startswith('waiting;wait_for (test_profiling.py:'))
+        self.assertEqual(wall[waiting_stack], 20)
+        self.assertEqual(sum(count for stack, count in wall.items() if stack.startswith('spinning;spin_until')), 20)
+
+        # The waiting thread is never running
+        cpu = read_folded(sampler.filenames['cpu'])
+        self.assertFalse([stack for stack in cpu if stack.startswith('waiting;')])
+        with open(sampler.filenames['times']) as f:
+            times = json.load(f)
+        self.assertEqual((times['process'], times['pid'], times['samples']), ('test', os.getpid(), 20))
+        if times['threads_cpu_seconds']:
+            self.assertGreater(times['threads_cpu_seconds']['spinning'], times['threads_cpu_seconds']['waiting'])
+
+    def test_profile_is_written_periodically(self):
+        sampler = StackSampler(self.directory.name, 'test', interval=0.01, period=0.05)
+        sampler.start()
+        try:
+            deadline = time.monotonic() + 5
+            while not os.path.exists(sampler.filenames['times']) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(os.path.exists(sampler.filenames['times']))
+        finally:
+            sampler.stop()
+        self.assertGreater(sampler.samples, 0)
+        self.assertFalse(glob.glob(os.path.join(self.directory.name, '*.tmp')))
+
+
+class ProfiledProcessTest(unittest.TestCase):
+
+    def test_supervised_process(self):
+        with tempfile.TemporaryDirectory() as path:
+            supervisor = ProcessSupervisor(Profiling(path, interval=0.005))
+            supervisor.add('work', work, (0.3,))
+            supervisor.start()
+            supervisor.join(timeout=10)
+            self.assertEqual(supervisor.exitcodes(), {'work': 0})
+
+            pid = supervisor['work'].pid
+            prefix = os.path.join(path, 'profile work {}'.format(pid))
+            wall = read_folded(prefix + '.wall.folded')
+            # The frames of the parent process and of the profiler are left out
+            self.assertTrue(all(stack.startswith('MainThread;work (test_profiling.py:') for stack in wall))
+            with open(prefix + '.json') as f:
+                times = json.load(f)
+            self.assertEqual(times['pid'], pid)
+            self.assertGreaterEqual(times['wall_seconds'], 0.5)
+            self.assertGreater(times['cpu_seconds'], 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+"""Tests of the reconnection of a stalled or disconnected source by the record process.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import ctypes
+import multiprocessing
+import unittest
+from unittest import mock
+
+from Processes import record_process
+from Processes.capture_backends import paInt16
+from Processes.metrics import PipelineMetrics
+from Processes.ring_buffer import SharedRingBuffer
+from Processes.shutdown import ShutdownControl
+
+RATE = 8000
+CHUNK = 400
+CHANNELS = 2
+FRAME_SIZE = CHANNELS * 2
+
+
+class FlakyCapture:
+    # Source which can be opened again only after FAILURES attempts
+
+    def __init__(self, failures, error=None):
+        self.failures = failures
+        self.error = error
+        self.attempts = 0
+
+    def reopen(self):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            if self.error is not None:
+                raise self.error
+            return False
+        return True
+
+
+@mock.patch.object(record_process, 'RECONNECT_PERIOD', 0.01)
+class ReconnectTest(unittest.TestCase):
+
+    def test_reconnection_after_failed_attempts(self):
+        capture = FlakyCapture(2, OSError('device busy'))
+        self.assertTrue(record_process.reconnect(capture))
+        self.assertEqual(capture.attempts, 3)
+
+    def test_reconnection_timeout(self):
+        capture = FlakyCapture(10 ** 6)
+        with mock.patch.object(record_process, 'RECONNECT_TIMEOUT', 0.2):
+            self.assertFalse(record_process.reconnect(capture))
+        self.assertGreater(capture.attempts, 1)
+
+    def test_no_reconnection_during_the_shutdown(self):
+        shutdown = ShutdownControl()
+        shutdown.begin()
+        capture = FlakyCapture(0)
+        self.assertFalse(record_process.reconnect(capture, shutdown))
+        self.assertEqual(capture.attempts, 0)
+
+
+class StalledSourceTest(unittest.TestCase):
+
+    def test_stalled_source_is_opened_again(self):
+        # The synthetic source hangs after 1 s of audio and stops after 3 s, like a disconnected board
+        ring = SharedRingBuffer(256, CHUNK * FRAME_SIZE, FRAME_SIZE)
+        metrics = PipelineMetrics()
+        error_connection = multiprocessing.Value(ctypes.c_bool, False)
+        process = multiprocessing.Process(target=record_process.audio_record, args=(
+            error_connection, ring, paInt16, CHANNELS, RATE, CHUNK, 'synthetic:speed=4,stall=1,duration=3', metrics))
+        process.start()
+        process.join(30)
+        self.assertEqual(process.exitcode, 0)
+        self.assertFalse(error_connection.value)
+
+        chunks = ring.get_range(timeout=0)
+        self.assertEqual(len(chunks), 3 * RATE // CHUNK)
+        self.assertEqual(metrics.get('reconnections'), 1)
+        # The frames missing during the stall are reported with the first chunk after the reconnection
+        lost = [chunk.seq for chunk in chunks if chunk.lost_frames]
+        self.assertEqual(lost, [RATE // CHUNK])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+"""Tests of the recording container and of its time-range reader.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from Processes.recording_container import (INDEX_SUFFIX, ContainerReader, ContainerWriter, encode_blocks,
+                                           index_type, segment_number)
+from Processes.wav_writer import SegmentWriter
+
+RATE = 1000
+CHANNELS = 3
+BLOCK_SECONDS = 0.5
+
+
+def samples(frames, seed=0):
+    return np.random.default_rng(seed).integers(-30000, 30000, (frames, CHANNELS)).astype('<i2')
+
+
+class ContainerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+        self.filename = os.path.join(self.path, 'data.mchr')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def segment(self, number, data, gaps=()):
+        # Segment written by the save process; GAPS are (frames written before the gap, lost frames)
+        filename = os.path.join(self.path, 'audio data minute {}.wav'.format(number))
+        writer = SegmentWriter(filename, CHANNELS, 2, RATE, len(data))
+        written = 0
+        for frame, lost_frames in list(gaps) + [(len(data), 0)]:
+            writer.write(data[written:frame].tobytes())
+            written = frame
+            if lost_frames:
+                writer.mark_gap(lost_frames)
+        writer.close()
+        return filename
+
+    def write(self, *segments, codec='delta-zlib'):
+        writer = ContainerWriter(self.filename, CHANNELS, 2, RATE, codec, BLOCK_SECONDS)
+        for filename in segments:
+            writer.append(encode_blocks(filename, codec, BLOCK_SECONDS))
+        writer.close()
+
+    def test_segment_number(self):
+        self.assertEqual(segment_number('Recordings/x/audio data minute 12.wav'), 12)
+        self.assertEqual(segment_number('data.wav'), 0)
+
+    def test_time_range_of_some_channels(self):
+        first, second = samples(1700, 1), samples(1200, 2)
+        for codec in ('raw', 'delta-lzma'):
+            with self.subTest(codec=codec):
+                self.write(self.segment(1, first), self.segment(2, second), codec=codec)
+                recording = np.concatenate([first, second])
+                with ContainerReader(self.filename) as reader:
+                    self.assertEqual((reader.codec, reader.channels, reader.rate), (codec, CHANNELS, RATE))
+                    self.assertEqual(reader.frames, 2900)
+                    self.assertEqual(len(reader.index), 4 + 3)
+                    np.testing.assert_array_equal(reader.read(1.25, 0.8, [2, 0]), recording[1250:2050][:, [2, 0]])
+                    np.testing.assert_array_equal(reader.read(0, 10), np.concatenate([recording, np.zeros(
+                        (10000 - 2900, CHANNELS), '<i2')]))
+                    np.testing.assert_array_equal(np.concatenate(list(reader.blocks())), recording)
+                for name in ('data.mchr', 'data.mchr' + INDEX_SUFFIX):
+                    os.remove(os.path.join(self.path, name))
+
+    def test_gaps_are_read_as_zeros(self):
+        data = samples(1000)
+        self.write(self.segment(1, data, gaps=[(400, 250)]), self.segment(2, data))
+        with ContainerReader(self.filename) as reader:
+            self.assertEqual(reader.frames, 2250)
+            # Blocks never contain a gap
+            self.assertEqual(reader.index['start'].tolist(), [0, 650, 1150, 1250, 1750])
+            np.testing.assert_array_equal(reader.read(0.3, 0.5), np.concatenate(
+                [data[300:400], np.zeros((250, CHANNELS), '<i2'), data[400:550]]))
+            np.testing.assert_array_equal(reader.read(1.25, 1), data)
+            (gap,) = reader.gaps()
+            self.assertEqual((gap['start'], gap['lost_frames'], gap['segment']), (400, 250, 1))
+
+    def test_blocks_written_before_their_index_are_recovered(self):
+        data = samples(1500)
+        self.write(self.segment(1, data))
+        # The index records of the last two blocks were lost (crash), and a block was only partly written
+        with open(self.filename + INDEX_SUFFIX, 'r+b') as f:
+            f.truncate(os.path.getsize(self.filename + INDEX_SUFFIX) - 2 * index_type(CHANNELS).itemsize - 3)
+        with open(self.filename, 'ab') as f:
+            f.write(b'MCHB' + bytes(20))
+
+        self.write(self.segment(2, data))
+        with ContainerReader(self.filename) as reader:
+            self.assertEqual(reader.frames, 3000)
+            np.testing.assert_array_equal(reader.read(0, 3), np.concatenate([data, data]))
+
+    def test_container_with_other_settings(self):
+        self.write(self.segment(1, samples(100)))
+        with self.assertRaises(ValueError):
+            ContainerWriter(self.filename, CHANNELS, 2, 2 * RATE, 'delta-zlib')
+        with self.assertRaises(ValueError):
+            ContainerWriter(self.filename, CHANNELS, 2, RATE, 'deflate')
+
+    def test_not_a_container(self):
+        with open(self.filename, 'wb') as f:
+            f.write(bytes(100))
+        with self.assertRaises(ValueError):
+            ContainerReader(self.filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
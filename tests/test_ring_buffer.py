@@ -0,0 +1,144 @@
+"""Tests of the shared memory ring buffer between the record process and its consumers.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import multiprocessing
+import time
+import unittest
+
+from Processes.ring_buffer import RingWakeup, SharedRingBuffer, wait_any
+
+FRAME_SIZE = 4  # Two channels of 16-bit samples
+SLOT_SIZE = 8 * FRAME_SIZE
+
+
+def chunk(value, frames=8):
+    return bytes([value]) * (frames * FRAME_SIZE)
+
+
+def put_later(ring, data, delay):
+    time.sleep(delay)
+    ring.put(data)
+
+
+class RingBufferTest(unittest.TestCase):
+
+    def test_chunks_are_read_in_order_without_copy(self):
+        ring = SharedRingBuffer(4, SLOT_SIZE, FRAME_SIZE)
+        for value in range(3):
+            self.assertTrue(ring.put(chunk(value), adc_time=10.0 + value))
+        chunks = ring.get_range(timeout=0)
+        self.assertEqual([c.seq for c in chunks], [0, 1, 2])
+        self.assertEqual([bytes(c.data) for c in chunks], [chunk(value) for value in range(3)])
+        self.assertEqual([c.adc_time for c in chunks], [10.0, 11.0, 12.0])
+        self.assertIsInstance(chunks[0].data, memoryview)
+        self.assertEqual(ring.occupancy(), 3)
+        ring.release(len(chunks))
+        self.assertEqual(ring.occupancy(), 0)
+        self.assertEqual(ring.get_range(timeout=0), [])
+
+    def test_max_chunks(self):
+        ring = SharedRingBuffer(4, SLOT_SIZE, FRAME_SIZE)
+        for value in range(3):
+            ring.put(chunk(value))
+        self.assertEqual([c.seq for c in ring.get_range(max_chunks=2, timeout=0)], [0, 1])
+
+    def test_overrun_drops_the_chunk_and_reports_its_frames(self):
+        ring = SharedRingBuffer(2, SLOT_SIZE, FRAME_SIZE)
+        self.assertTrue(ring.put(chunk(0)))
+        self.assertTrue(ring.put(chunk(1)))
+        # The ring is full: the chunks are dropped, the producer is never blocked
+        self.assertFalse(ring.put(chunk(2)))
+        self.assertFalse(ring.put(chunk(3, frames=5)))
+        self.assertEqual(ring.overruns, 2)
+        self.assertEqual(ring.high_water, 2)
+        ring.release(len(ring.get_range(timeout=0)))
+
+        # The frames lost are attached to the next chunk published, with the gaps of the source
+        ring.mark_gap(7)
+        ring.put(chunk(4))
+        (next_chunk,) = ring.get_range(timeout=0)
+        self.assertEqual(next_chunk.seq, 2)
+        self.assertEqual(next_chunk.lost_frames, 8 + 5 + 7)
+        self.assertEqual(bytes(next_chunk.data), chunk(4))
+
+    def test_wait_times_out(self):
+        ring = SharedRingBuffer(2, SLOT_SIZE, FRAME_SIZE)
+        start = time.monotonic()
+        self.assertEqual(ring.get_range(timeout=0.1), [])
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_consumer_is_woken_up_by_another_process(self):
+        ring = SharedRingBuffer(2, SLOT_SIZE, FRAME_SIZE)
+        producer = multiprocessing.Process(target=put_later, args=(ring, chunk(5), 0.2))
+        producer.start()
+        try:
+            chunks = ring.get_range(timeout=5)
+        finally:
+            producer.join()
+        self.assertEqual([bytes(c.data) for c in chunks], [chunk(5)])
+
+
+class ObserverTest(unittest.TestCase):
+
+    def test_observer_does_not_take_the_chunks(self):
+        ring = SharedRingBuffer(4, SLOT_SIZE, FRAME_SIZE)
+        for value in range(3):
+            ring.put(chunk(value))
+        self.assertEqual([c.seq for c in ring.observe(1)], [1, 2])
+        self.assertEqual(ring.occupancy(), 3)
+        self.assertEqual(len(ring.get_range(timeout=0)), 3)
+
+    def test_slow_observer_skips_the_overwritten_chunks(self):
+        ring = SharedRingBuffer(4, SLOT_SIZE, FRAME_SIZE)
+        for value in range(10):
+            ring.put(chunk(value))
+            ring.release(len(ring.get_range(timeout=0)))
+        chunks = ring.observe(0)
+        # The slot of the next chunk may be overwritten at any time: it is not returned
+        self.assertEqual([c.seq for c in chunks], [7, 8, 9])
+        self.assertTrue(ring.is_intact(7))
+        ring.put(chunk(10))
+        self.assertFalse(ring.is_intact(7))
+        self.assertTrue(ring.is_intact(8))
+
+    def test_observer_is_woken_up_by_the_producer(self):
+        ring = SharedRingBuffer(4, SLOT_SIZE, FRAME_SIZE)
+        observer = ring.add_observer()
+        self.assertFalse(ring.wait_observed(0, observer, timeout=0.05))
+        producer = multiprocessing.Process(target=put_later, args=(ring, chunk(1), 0.2))
+        producer.start()
+        try:
+            self.assertTrue(ring.wait_observed(0, observer, timeout=5))
+        finally:
+            producer.join()
+        self.assertEqual([c.seq for c in ring.observe(0)], [0])
+
+
+class WaitAnyTest(unittest.TestCase):
+
+    def test_rings_sharing_a_wakeup(self):
+        wakeup = RingWakeup()
+        rings = [SharedRingBuffer(2, SLOT_SIZE, FRAME_SIZE, wakeup) for _ in range(3)]
+        self.assertFalse(wait_any(rings, timeout=0.05))
+        producer = multiprocessing.Process(target=put_later, args=(rings[2], chunk(2), 0.2))
+        producer.start()
+        try:
+            start = time.monotonic()
+            self.assertTrue(wait_any(rings, timeout=5))
+            self.assertLess(time.monotonic() - start, 4)
+        finally:
+            producer.join()
+        self.assertEqual(rings[2].occupancy(), 1)
+        self.assertEqual(rings[0].occupancy(), 0)
+
+    def test_notify_without_waiting_process(self):
+        # The producers write in the pipe only while a process waits: a later wait is not woken up by old chunks
+        wakeup = RingWakeup()
+        for _ in range(100000):
+            wakeup.notify()
+        self.assertFalse(wakeup.wait(lambda: False, timeout=0.05))
+
+
+if __name__ == '__main__':
+    unittest.main()
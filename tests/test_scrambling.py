@@ -0,0 +1,107 @@
+"""Tests of the scrambling of the recorded segments.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from Processes.audio_codecs import read_wav
+from Processes.recording_container import ContainerReader, ContainerWriter, encode_blocks
+from Processes.scrambling import Scrambler, ScramblingSegmentWriter, is_scrambled, read_key
+
+KEY = b'k' * 32
+CHANNELS = 4
+RATE = 1000
+BLOCK_FRAMES = 16
+WINDOW_BLOCKS = 8
+
+
+def samples(frames, seed=0):
+    return np.random.default_rng(seed).integers(-30000, 30000, (frames, CHANNELS)).astype('<i2')
+
+
+class ScramblerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+        self.scrambler = Scrambler.create(KEY, self.path, CHANNELS, BLOCK_FRAMES, WINDOW_BLOCKS)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_segment(self, data, segment=3, chunk=100):
+        filename = os.path.join(self.path, 'audio data minute {}.wav'.format(segment))
+        writer = ScramblingSegmentWriter(filename, CHANNELS, 2, RATE, len(data), self.scrambler, segment)
+        for start in range(0, len(data), chunk):
+            writer.write(data[start:start + chunk].tobytes())
+        writer.close()
+        return filename
+
+    def test_window_round_trip(self):
+        window = samples(BLOCK_FRAMES * WINDOW_BLOCKS)
+        scrambled = self.scrambler.scramble(window, 1, 0)
+        self.assertFalse(np.array_equal(scrambled, window))
+        np.testing.assert_array_equal(self.scrambler.descramble(scrambled, 1, 0), window)
+        # Same frames and channels, in another order
+        self.assertEqual(sorted(scrambled.ravel().tolist()), sorted(window.ravel().tolist()))
+        # Every segment has its own permutations
+        self.assertFalse(np.array_equal(self.scrambler.scramble(window, 2, 0), scrambled))
+
+    def test_segment_round_trip(self):
+        # The last window is shorter, and ends with frames which are not a whole block
+        data = samples(3 * BLOCK_FRAMES * WINDOW_BLOCKS + 5 * BLOCK_FRAMES + 7)
+        filename = self.write_segment(data)
+        stored, rate = read_wav(filename)
+        self.assertEqual((stored.shape, rate), (data.shape, RATE))
+        self.assertFalse(np.array_equal(stored, data))
+        # The frames after the last whole block are not permuted, only their channels
+        np.testing.assert_array_equal(stored[-7:, self.scrambler.stored_channels(3, range(CHANNELS))], data[-7:])
+        descrambler = Scrambler.load(KEY, self.path)
+        np.testing.assert_array_equal(descrambler.descramble_segment(stored, 3), data)
+
+    def test_stored_channels(self):
+        window = samples(BLOCK_FRAMES)
+        scrambled = self.scrambler.scramble(window, 5, 0)
+        positions = self.scrambler.stored_channels(5, range(CHANNELS))
+        self.assertEqual(sorted(positions), list(range(CHANNELS)))
+        for channel, position in enumerate(positions):
+            np.testing.assert_array_equal(scrambled[:, position], window[:, channel])
+
+    def test_key_is_needed(self):
+        self.assertTrue(is_scrambled(self.path))
+        with self.assertRaises(ValueError):
+            Scrambler.load(None, self.path)
+        with self.assertRaises(ValueError):
+            Scrambler.load(b'another key', self.path)
+        self.assertIsNone(Scrambler.load(None, os.path.join(self.path, 'Recordings')))
+
+    def test_read_key(self):
+        filename = os.path.join(self.path, 'scramble.key')
+        self.assertIsNone(read_key(filename))
+        with open(filename, 'wb') as f:
+            f.write(KEY)
+        self.assertEqual(read_key(filename), KEY)
+
+    def test_time_range_of_a_scrambled_container(self):
+        data = samples(2000)
+        container = os.path.join(self.path, 'data.mchr')
+        writer = ContainerWriter(container, CHANNELS, 2, RATE, 'delta-zlib', 0.3)
+        writer.append(encode_blocks(self.write_segment(data, 1), 'delta-zlib', 0.3))
+        writer.append(encode_blocks(self.write_segment(data[:700], 2), 'delta-zlib', 0.3))
+        writer.close()
+        with ContainerReader(container, KEY) as reader:
+            np.testing.assert_array_equal(reader.read(0.35, 1.9, [3, 1]),
+                                          np.concatenate([data, data[:700]])[350:2250][:, [3, 1]])
+            np.testing.assert_array_equal(np.concatenate(list(reader.blocks())), np.concatenate([data, data[:700]]))
+        with ContainerReader(container, stored=True) as reader:
+            self.assertFalse(np.array_equal(reader.stored_segment(1), data))
+        with self.assertRaises(ValueError):
+            ContainerReader(container)
+
+
+if __name__ == '__main__':
+    unittest.main()
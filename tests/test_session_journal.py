@@ -0,0 +1,111 @@
+"""Tests of the journal of a recording session and of the recovery of the last session at startup.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import numpy as np
+
+from CustomLogging.clean_up_log import clean_up
+from Processes.audio_codecs import write_wav
+from Processes.session_journal import (CLOSED, COMPRESSED, LOG_MOVED, OPENED, QUEUED, STARTED, SessionJournal,
+                                       last_session)
+from Processes.wav_writer import SegmentWriter
+
+RATE = 1000
+CHANNELS = 2
+
+
+class SessionJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.recordings = os.path.join(self.directory.name, 'Recordings')
+        self.session = os.path.join(self.recordings, '2026-10-18 10-00-00')
+        os.makedirs(self.session)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_records_and_last_session(self):
+        self.assertIsNone(last_session(self.recordings))
+        journal = SessionJournal(self.session)
+        journal.start({'codec': 'delta-zlib'})
+        journal.record(OPENED, 'audio data minute 1')
+        journal.close()
+        # A line cut by a crash is ignored
+        with open(journal.filename, 'a') as f:
+            f.write('1.000\tCLOSED\taudio da')
+
+        journal = last_session(self.recordings)
+        self.assertEqual(journal.path, self.session)
+        self.assertEqual([record[1:] for record in journal.read()], [
+            (STARTED, '', {'codec': 'delta-zlib'}), (OPENED, 'audio data minute 1', None)])
+
+    def test_last_session_was_removed(self):
+        journal = SessionJournal(self.session)
+        journal.start({})
+        journal.close()
+        shutil.rmtree(self.session)
+        self.assertIsNone(last_session(self.recordings))
+
+
+class CleanUpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+        self.session = os.path.join(self.path, 'Recordings', '2026-10-18 10-00-00')
+        os.makedirs(self.session)
+        self.journal = SessionJournal(self.session)
+        self.data = np.random.default_rng(0).integers(-1000, 1000, (1500, CHANNELS)).astype('<i2')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def segment(self, number, *states):
+        name = 'audio data minute {}'.format(number)
+        for state in states:
+            self.journal.record(state, name)
+        return os.path.join(self.session, name + '.wav')
+
+    def test_work_left_by_a_crash_is_completed(self):
+        self.journal.start({'codec': 'deflate', 'archive_format': 'zip'})
+        # Segment 1 is in the archive but its .wav file was left, segment 2 was closed but not compressed and
+        # segment 3 was being written
+        stored = self.segment(1, OPENED, CLOSED, QUEUED, COMPRESSED)
+        write_wav(stored, self.data, RATE)
+        with zipfile.ZipFile(os.path.join(self.session, 'data.zip'), 'w') as zf:
+            zf.write(stored, 'audio data minute 1.wav')
+        write_wav(self.segment(2, OPENED, CLOSED), self.data, RATE)
+        writer = SegmentWriter(self.segment(3, OPENED), CHANNELS, 2, RATE, 60 * RATE)
+        writer.write(self.data[:700].tobytes())
+        writer._flush(aligned=False)
+        os.close(writer._fd)
+        with open(os.path.join(self.path, 'audio_record.log'), 'w') as f:
+            f.write('log of the session\n')
+
+        clean_up(self.path)
+        self.assertEqual(sorted(os.listdir(self.session)), ['audio_record.log', 'data.zip', 'journal.log'])
+        with zipfile.ZipFile(os.path.join(self.session, 'data.zip')) as zf:
+            self.assertEqual(zf.namelist(), ['audio data minute {}.wav'.format(n) for n in (1, 2, 3)])
+            self.assertEqual(len(zf.read('audio data minute 3.wav')), 44 + 700 * CHANNELS * 2)
+        states = [record[1:3] for record in self.journal.read()]
+        self.assertIn((COMPRESSED, 'audio data minute 2'), states)
+        self.assertIn((COMPRESSED, 'audio data minute 3'), states)
+        self.assertEqual(states[-1], (LOG_MOVED, ''))
+
+        # The session is complete: nothing is done at the next start
+        clean_up(self.path)
+        self.assertEqual(len(self.journal.read()), len(states))
+
+    def test_no_session(self):
+        clean_up(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+"""Tests of the shutdown of the recording, bounded in time.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import queue
+import signal
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from Processes import shutdown as shutdown_module
+from Processes.save_process import send
+from Processes.session_journal import STOPPED, SessionJournal
+from Processes.shutdown import PHASES, ShutdownControl, follow_shutdown, stop_recording, stopping
+from Processes.supervisor import ProcessSupervisor
+
+
+def stop_on_shutdown(shutdown, delay):
+    # Process of the recording: it ends DELAY seconds after the shutdown started
+    follow_shutdown(shutdown)
+    shutdown.wait()
+    time.sleep(delay)
+
+
+def stop_after_phase(shutdown, phase):
+    # Process of a later phase: it ends when PHASE ends
+    follow_shutdown(shutdown)
+    shutdown.wait()
+    shutdown.wait_phase(phase)
+
+
+def stuck(shutdown):
+    # Process which never ends: SIGTERM only starts the shutdown, it has to be killed
+    follow_shutdown(shutdown)
+    while True:
+        time.sleep(1)
+
+
+class ShutdownControlTest(unittest.TestCase):
+
+    def test_before_the_shutdown(self):
+        shutdown = ShutdownControl(2)
+        self.assertFalse(shutdown.requested)
+        self.assertFalse(stopping(shutdown))
+        self.assertFalse(stopping(None))
+        self.assertIsNone(shutdown.deadline)
+        self.assertIsNone(shutdown.remaining())
+        self.assertEqual(shutdown.elapsed(), 0.0)
+        self.assertEqual(shutdown.durations(), {})
+        self.assertFalse(shutdown.wait(0.05))
+
+    def test_deadline(self):
+        shutdown = ShutdownControl(2)
+        shutdown.begin()
+        deadline = shutdown.deadline
+        self.assertTrue(stopping(shutdown))
+        self.assertTrue(shutdown.wait(0))
+        self.assertAlmostEqual(deadline - time.monotonic(), 2, delta=0.5)
+        self.assertLessEqual(shutdown.remaining(), 2)
+        self.assertLessEqual(shutdown.remaining(margin=0.5), 1.5)
+        self.assertEqual(shutdown.remaining(margin=10), 0)
+        # The shutdown starts once: a later request does not move the deadline
+        time.sleep(0.05)
+        shutdown.begin()
+        self.assertEqual(shutdown.deadline, deadline)
+
+    def test_phases_end_in_order(self):
+        shutdown = ShutdownControl(2)
+        shutdown.begin()
+        time.sleep(0.1)
+        shutdown.end_phase('record')
+        shutdown.end_phase('merge')
+        time.sleep(0.1)
+        shutdown.end_phase('flush')
+        self.assertTrue(shutdown.ended('merge'))
+        self.assertFalse(shutdown.ended('compress'))
+        self.assertTrue(shutdown.wait_phase('flush'))
+        durations = shutdown.durations()
+        self.assertEqual(list(durations), ['record', 'merge', 'flush'])
+        self.assertAlmostEqual(durations['record'], 0.1, delta=0.05)
+        self.assertLess(durations['merge'], 0.05)
+        self.assertAlmostEqual(durations['flush'], 0.1, delta=0.05)
+
+    def test_wait_phase_is_bounded_by_the_deadline(self):
+        shutdown = ShutdownControl(0.2)
+        shutdown.begin()
+        start = time.monotonic()
+        self.assertFalse(shutdown.wait_phase('compress'))
+        self.assertAlmostEqual(time.monotonic() - start, 0.2, delta=0.15)
+
+
+class SendTest(unittest.TestCase):
+
+    def test_full_queue(self):
+        que2 = queue.Queue(maxsize=1)
+        self.assertTrue(send(que2, 'segment 0', timeout=0.05))
+        start = time.monotonic()
+        self.assertFalse(send(que2, 'segment 1', timeout=0.1))
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_wait_is_bounded_by_the_deadline_of_the_shutdown(self):
+        que2 = queue.Queue(maxsize=1)
+        que2.put('segment 0')
+        shutdown = ShutdownControl(0.2)
+        shutdown.begin()
+        start = time.monotonic()
+        self.assertFalse(send(que2, 'segment 1', shutdown, timeout=10))
+        self.assertLess(time.monotonic() - start, 1)
+
+
+class StopRecordingTest(unittest.TestCase):
+
+    def setUp(self):
+        # stop_recording() ignores SIGINT and SIGTERM in the main process until it exits
+        self.handlers = signal.getsignal(signal.SIGINT), signal.getsignal(signal.SIGTERM)
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal = SessionJournal(self.directory.name)
+        self.supervisor = ProcessSupervisor()
+
+    def tearDown(self):
+        self.supervisor.terminate()
+        self.supervisor.join(timeout=5)
+        self.journal.close()
+        self.directory.cleanup()
+        signal.signal(signal.SIGINT, self.handlers[0])
+        signal.signal(signal.SIGTERM, self.handlers[1])
+
+    def test_processes_stop_in_phases(self):
+        shutdown = ShutdownControl(5)
+        self.supervisor.add('record', stop_on_shutdown, (shutdown, 0.2))
+        self.supervisor.add('save', stop_after_phase, (shutdown, 'merge'))
+        self.supervisor.add('compress', stop_after_phase, (shutdown, 'flush'))
+        self.supervisor.start()
+        phases = {'record': ['record'], 'flush': ['save'], 'compress': ['compress']}
+        durations, forced = stop_recording(self.supervisor, shutdown, phases, 'test', self.journal)
+
+        self.assertEqual(forced, [])
+        self.assertEqual(list(durations), list(PHASES))
+        self.assertGreaterEqual(durations['record'], 0.15)
+        self.assertLess(shutdown.elapsed(), 3)
+        self.assertEqual(self.supervisor.exitcodes(), {'record': 0, 'save': 0, 'compress': 0})
+        (_, state, _, settings), = self.journal.read()
+        self.assertEqual(state, STOPPED)
+        self.assertEqual(settings['reason'], 'test')
+        self.assertEqual(settings['deadline'], 5)
+        self.assertEqual(settings['forced'], [])
+        self.assertEqual(list(settings['phases']), list(PHASES))
+
+    def test_processes_running_at_the_deadline_are_killed(self):
+        shutdown = ShutdownControl(0.5)
+        self.supervisor.add('record', stop_on_shutdown, (shutdown, 0))
+        self.supervisor.add('save', stuck, (shutdown,))
+        self.supervisor.start()
+        with mock.patch.object(shutdown_module, 'KILL_GRACE', 0.5):
+            durations, forced = stop_recording(self.supervisor, shutdown, {'record': ['record'], 'flush': ['save']},
+                                               'deadline', self.journal)
+
+        self.assertEqual(forced, ['save'])
+        self.assertFalse(self.supervisor.is_alive('save'))
+        self.assertEqual(self.supervisor.exitcodes()['record'], 0)
+        self.assertEqual(self.supervisor.exitcodes()['save'], -signal.SIGKILL)
+        self.assertLess(shutdown.elapsed(), 3)
+        (_, state, _, settings), = self.journal.read()
+        self.assertEqual(state, STOPPED)
+        self.assertEqual(settings['forced'], ['save'])
+
+
+if __name__ == '__main__':
+    unittest.main()
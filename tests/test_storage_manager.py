@@ -0,0 +1,200 @@
+"""Tests of the management of the disk of the recordings and of the recompression of the older sessions.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import ctypes
+import datetime
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from Processes import storage_manager
+from Processes.metrics import PipelineMetrics
+from Processes.recording_container import (INDEX_SUFFIX, RECOMPRESSED_SUFFIX, ContainerReader, ContainerWriter,
+                                           SegmentBlocks, container_codec, encode_samples, finish_recompression,
+                                           recompress_container)
+from Processes.shutdown import ShutdownControl
+from Processes.storage_manager import SESSION_TIME_FORMAT, StorageManager, recompress_sessions, sessions
+
+RATE = 1000
+CHANNELS = 2
+SIZE = 256 * 1024  # Bytes of the data of every session
+
+
+def session_name(days_ago):
+    return (datetime.datetime.now() - datetime.timedelta(days=days_ago)).strftime(SESSION_TIME_FORMAT)
+
+
+def write_container(filename, codec='raw', seconds=3):
+    # Container of SECONDS seconds of a sine wave, in blocks of one second
+    t = np.arange(seconds * RATE)[:, None] / RATE
+    samples = (10000 * np.sin(2 * np.pi * 50 * t * np.arange(1, CHANNELS + 1))).astype('<i2')
+    blocks = [(start, RATE, [encode_samples(samples[start:start + RATE, channel:channel + 1], RATE, codec)
+                             for channel in range(CHANNELS)]) for start in range(0, len(samples), RATE)]
+    writer = ContainerWriter(filename, CHANNELS, 2, RATE, codec, 1)
+    writer.append(SegmentBlocks(RATE, 2, CHANNELS, len(samples), [], blocks, 1))
+    writer.close()
+    return samples
+
+
+class StorageManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.recordings = os.path.join(self.directory.name, 'Recordings')
+        self.sessions = [self.session(days_ago) for days_ago in (30, 10, 2, 0)]
+        self.current = self.sessions[-1]
+        self.stopped = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def session(self, days_ago):
+        path = os.path.join(self.recordings, session_name(days_ago))
+        os.makedirs(path)
+        with open(os.path.join(path, 'data.mchr'), 'wb') as f:
+            f.write(os.urandom(SIZE))
+        return path
+
+    def manager(self, **kwargs):
+        kwargs.setdefault('min_free', 0)
+        return StorageManager(self.recordings, self.current, PipelineMetrics(), self.stopped.append, **kwargs)
+
+    def test_sessions_are_sorted_by_start_time(self):
+        self.assertEqual(sessions(self.recordings), self.sessions)
+
+    def test_retention(self):
+        manager = self.manager(retention_days=7)
+        manager.check()
+        self.assertEqual(sessions(self.recordings), self.sessions[2:])
+        self.assertEqual(manager.metrics.get('sessions_deleted'), 2)
+        self.assertEqual(manager.snapshot()['storage_sessions'], 2)
+
+    def test_quota_deletes_the_oldest_sessions(self):
+        # Without DELETE_OLDEST the quota is only reported
+        self.manager(quota=int(2.5 * SIZE)).check()
+        self.assertEqual(len(sessions(self.recordings)), 4)
+        manager = self.manager(quota=int(2.5 * SIZE), delete_oldest=True)
+        manager.check()
+        self.assertEqual(sessions(self.recordings), self.sessions[2:])
+        self.assertLessEqual(manager.snapshot()['storage_used_bytes'], 2.5 * SIZE)
+
+    def test_current_session_is_never_deleted(self):
+        self.manager(quota=1, delete_oldest=True, retention_days=1).check()
+        self.assertEqual(sessions(self.recordings), [self.current])
+        self.assertEqual(self.stopped, [])
+
+    def test_recording_is_stopped_when_the_disk_is_almost_full(self):
+        manager = self.manager(min_free=2 ** 62)
+        with self.assertLogs('storage_manager', 'ERROR'):
+            manager.check()
+        manager.check()
+        self.assertEqual(self.stopped, ['the disk is almost full'])
+        # Without DELETE_OLDEST the sessions are kept
+        self.assertEqual(len(sessions(self.recordings)), 4)
+
+    def test_write_rate_and_time_to_full(self):
+        usage = shutil.disk_usage(self.recordings)
+        free = [usage.free, usage.free - 10 ** 7]
+        times = [1000.0, 1010.0]
+        with mock.patch.object(storage_manager.shutil, 'disk_usage', lambda path: usage._replace(free=free[0])), \
+                mock.patch.object(storage_manager.time, 'monotonic', lambda: times[0]):
+            manager = self.manager(min_free=10 ** 6, horizon=100)
+            manager.check()
+            free.pop(0)
+            times.pop(0)
+            manager.check()
+        # 10 MB in 10 s, averaged over RATE_WINDOW seconds
+        self.assertAlmostEqual(manager.write_rate, 10 ** 6)
+        self.assertEqual(manager.needed_space(), 10 ** 8)
+        snapshot = manager.snapshot()
+        self.assertAlmostEqual(snapshot['storage_time_to_full_seconds'], (usage.free - 10 ** 7 - 10 ** 6) / 10 ** 6)
+
+
+class RecompressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'data.mchr')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_recompressed_container_holds_the_same_samples(self):
+        samples = write_container(self.filename)
+        before, after = recompress_container(self.filename, 'delta-lzma')
+        self.assertLess(after, before)
+        self.assertEqual(os.path.getsize(self.filename), after)
+        self.assertEqual(container_codec(self.filename), 'delta-lzma')
+        with ContainerReader(self.filename) as reader:
+            np.testing.assert_array_equal(reader.read(0, 3), samples)
+            self.assertEqual(reader.index['segment'].tolist(), [1, 1, 1])
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ['data.mchr', 'data.mchr' + INDEX_SUFFIX])
+
+    def test_abandoned_recompression_leaves_the_container(self):
+        write_container(self.filename)
+        calls = []
+        self.assertIsNone(recompress_container(self.filename, 'delta-lzma', lambda: calls.append(1) or len(calls) < 2))
+        self.assertEqual(container_codec(self.filename), 'raw')
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ['data.mchr', 'data.mchr' + INDEX_SUFFIX])
+
+    def test_interrupted_replacement_is_completed(self):
+        write_container(self.filename)
+        copy = os.path.join(self.directory.name, 'copy.mchr')
+        samples = write_container(copy, 'delta-zlib')
+        # The crash happened after the index of the copy was renamed, before the data
+        os.replace(copy, self.filename + RECOMPRESSED_SUFFIX)
+        os.replace(copy + INDEX_SUFFIX, self.filename + INDEX_SUFFIX + RECOMPRESSED_SUFFIX)
+        finish_recompression(self.filename)
+        self.assertEqual(container_codec(self.filename), 'delta-zlib')
+        with ContainerReader(self.filename) as reader:
+            np.testing.assert_array_equal(reader.read(0, 3), samples)
+
+    def test_partial_copy_is_removed(self):
+        write_container(self.filename)
+        write_container(self.filename + '.tmp', 'delta-zlib')
+        finish_recompression(self.filename)
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ['data.mchr', 'data.mchr' + INDEX_SUFFIX])
+
+
+class RecompressSessionsTest(unittest.TestCase):
+
+    def test_older_sessions_are_compressed_again(self):
+        with tempfile.TemporaryDirectory() as recordings:
+            older, current = (os.path.join(recordings, session_name(days_ago)) for days_ago in (1, 0))
+            for path in (older, current):
+                os.makedirs(path)
+                write_container(os.path.join(path, 'data.mchr'))
+            metrics = PipelineMetrics()
+            shutdown = ShutdownControl()
+            no_error = multiprocessing.Value(ctypes.c_bool, False)
+            process = multiprocessing.Process(target=recompress_sessions, args=(
+                no_error, no_error, recordings, current, 'delta-lzma', metrics, shutdown))
+            with mock.patch.object(storage_manager, 'IDLE_LOAD', 10 ** 6):
+                process.start()
+            try:
+                deadline = time.monotonic() + 30
+                while metrics.get('sessions_recompressed') < 1 and time.monotonic() < deadline:
+                    time.sleep(0.05)
+            finally:
+                # The process sleeps until the next search: it ends as soon as the shutdown starts
+                start = time.monotonic()
+                shutdown.begin()
+                process.join(10)
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertEqual(process.exitcode, 0)
+            self.assertEqual(metrics.get('sessions_recompressed'), 1)
+            self.assertGreater(metrics.get('bytes_saved_by_recompression'), 0)
+            self.assertEqual(container_codec(os.path.join(older, 'data.mchr')), 'delta-lzma')
+            # The session being recorded is left alone
+            self.assertEqual(container_codec(os.path.join(current, 'data.mchr')), 'raw')
+
+
+if __name__ == '__main__':
+    unittest.main()
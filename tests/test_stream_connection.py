@@ -0,0 +1,56 @@
+"""Tests of the search of the MCH Streamer boards among the audio peripherals.
+
+The audio peripherals are given by a stand-in of PyAudio; the module needs the pyaudio library to be imported.
+"""
+import unittest
+
+try:
+    from Processes import stream_connection
+except ImportError:
+    stream_connection = None
+
+
+class FakePyAudio:
+    # List of audio peripherals: (name, host API) of every device, in the order of the enumeration
+
+    def __init__(self, devices):
+        self.devices = devices
+
+    def get_device_count(self):
+        return len(self.devices)
+
+    def get_device_info_by_index(self, index):
+        name, host_api = self.devices[index]
+        return {'index': index, 'name': name, 'hostApi': host_api}
+
+
+BOARD_0 = ('MCHStreamer: USB Audio (hw:1,0)', 0)
+BOARD_1 = ('MCHStreamer: USB Audio (hw:2,0)', 0)
+DEFAULT = ('default', 0)
+
+
+@unittest.skipIf(stream_connection is None, 'pyaudio is not installed')
+class FindStreamerTest(unittest.TestCase):
+
+    def setUp(self):
+        stream_connection.last_streamer_index = None
+
+    def test_boards_are_numbered_in_the_order_of_the_peripherals(self):
+        p_audio = FakePyAudio([DEFAULT, BOARD_0, BOARD_1])
+        self.assertEqual(stream_connection.find_streamer(p_audio, 0)['name'], BOARD_0[0])
+        stream_connection.last_streamer_index = None
+        self.assertEqual(stream_connection.find_streamer(p_audio, 1)['name'], BOARD_1[0])
+
+    def test_reconnection_opens_only_the_same_board(self):
+        identity = stream_connection.streamer_identity(stream_connection.find_streamer(
+            FakePyAudio([DEFAULT, BOARD_0, BOARD_1]), 1))
+        # Board 0 dropped out: board 1 is now the first MCH Streamer of the list, at the index board 0 had
+        self.assertEqual(stream_connection.find_streamer(FakePyAudio([DEFAULT, BOARD_1]), 1, identity)['name'],
+                         BOARD_1[0])
+        # Board 1 dropped out: the reconnection does not take board 0
+        self.assertIsNone(stream_connection.find_streamer(FakePyAudio([DEFAULT, BOARD_0]), 1, identity))
+        self.assertIsNone(stream_connection.find_streamer(FakePyAudio([DEFAULT, BOARD_0]), 0, identity))
+
+
+if __name__ == '__main__':
+    unittest.main()
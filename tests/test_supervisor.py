@@ -0,0 +1,101 @@
+"""Tests of the supervision of the recording processes.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from Processes.supervisor import ProcessSupervisor
+
+
+def sleep_for(seconds):
+    time.sleep(seconds)
+
+
+def fail():
+    raise SystemExit(3)
+
+
+def fail_once(path):
+    # Fails the first time only: the file records the previous runs
+    with open(path, 'a') as f:
+        f.write('run\n')
+    with open(path) as f:
+        if len(f.readlines()) == 1:
+            raise SystemExit(2)
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def tearDown(self):
+        self.supervisor.terminate()
+        self.supervisor.join(timeout=5)
+
+    def test_essential_process_ending_stops_the_recording(self):
+        self.supervisor = ProcessSupervisor()
+        self.supervisor.add('record', sleep_for, (10,))
+        self.supervisor.add('save', fail, ())
+        self.supervisor.start()
+        self.assertEqual(self.supervisor.run(), 'the save process ended with exit code 3')
+        self.assertFalse(self.supervisor.shutdown_requested)
+        self.assertEqual(self.supervisor.exitcodes(), {'record': None, 'save': 3})
+
+    def test_failed_process_is_restarted(self):
+        with tempfile.TemporaryDirectory() as path:
+            runs = os.path.join(path, 'runs')
+            self.supervisor = ProcessSupervisor()
+            self.supervisor.add('compress', fail_once, (runs,), max_restarts=1)
+            self.supervisor.start()
+            # The second run ends without errors: the supervisor returns then
+            self.assertEqual(self.supervisor.run(), 'the compress process ended with exit code 0')
+            self.assertEqual(self.supervisor.restarts['compress'], 1)
+            with open(runs) as f:
+                self.assertEqual(len(f.readlines()), 2)
+
+    def test_restarts_are_bounded(self):
+        self.supervisor = ProcessSupervisor()
+        self.supervisor.add('compress', fail, (), max_restarts=2)
+        self.supervisor.start()
+        self.assertEqual(self.supervisor.run(), 'the compress process ended with exit code 3')
+        self.assertEqual(self.supervisor.restarts['compress'], 2)
+
+    def test_recording_goes_on_without_a_process_which_is_not_essential(self):
+        self.supervisor = ProcessSupervisor()
+        self.supervisor.add('record', sleep_for, (10,))
+        self.supervisor.add('dsp', fail, (), essential=False)
+        self.supervisor.start()
+        threading.Timer(0.5, self.supervisor.request_shutdown, ('the duration is over',)).start()
+        self.assertEqual(self.supervisor.run(), 'the duration is over')
+        self.assertTrue(self.supervisor.shutdown_requested)
+        self.assertEqual(self.supervisor.exitcodes(essential_only=True), {'record': None})
+        self.assertTrue(self.supervisor.is_alive('record'))
+
+    def test_requested_shutdown_wakes_up_run(self):
+        self.supervisor = ProcessSupervisor()
+        self.supervisor.add('record', sleep_for, (10,))
+        self.supervisor.start()
+        threading.Timer(0.2, self.supervisor.request_shutdown, ('the disk is almost full',)).start()
+        start = time.monotonic()
+        self.assertEqual(self.supervisor.run(), 'the disk is almost full')
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertTrue(self.supervisor.shutdown_requested)
+
+    def test_join_is_bounded_by_its_timeout(self):
+        self.supervisor = ProcessSupervisor()
+        self.supervisor.add('record', sleep_for, (10,))
+        self.supervisor.add('save', sleep_for, (10,))
+        self.supervisor.start()
+        start = time.monotonic()
+        self.supervisor.join(timeout=0.3)
+        self.assertLess(time.monotonic() - start, 2)
+        self.supervisor.terminate(['save'])
+        self.supervisor.join(timeout=5, names=['save'])
+        self.assertFalse(self.supervisor.is_alive('save'))
+        self.assertTrue(self.supervisor.is_alive('record'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+"""Tests of the writer of the .wav segments.
+
+Run from the root of the repository: python3 -m pytest tests (or python3 -m unittest discover tests)
+"""
+import json
+import os
+import tempfile
+import unittest
+import wave
+import zlib
+
+from Processes.wav_writer import WAV_HEADER_SIZE, WRITE_ALIGNMENT, SegmentWriter, repair_wav, wav_header
+
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+RATE = 8000
+FRAME_SIZE = CHANNELS * SAMPLE_WIDTH
+
+
+def frames(count, seed=0):
+    # Frames which are never zero, so that the end of the data can be found by repair_wav()
+    return bytes((seed + i) % 255 + 1 for i in range(count * FRAME_SIZE))
+
+
+class RecordingWriter(SegmentWriter):
+    # Writer keeping the position in the file and the size of every write
+
+    def __init__(self, *args, **kwargs):
+        self.writes = []
+        self._position = 0
+        super().__init__(*args, **kwargs)
+
+    def _write_all(self, data):
+        self.writes.append((self._position, len(data)))
+        self._position += len(data)
+        super()._write_all(data)
+
+
+class SegmentWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'segment.wav')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self):
+        with wave.open(self.filename) as w:
+            self.assertEqual((w.getnchannels(), w.getsampwidth(), w.getframerate()), (CHANNELS, SAMPLE_WIDTH, RATE))
+            return w.readframes(w.getnframes())
+
+    def test_expected_frames(self):
+        data = frames(3000)
+        w = SegmentWriter(self.filename, CHANNELS, SAMPLE_WIDTH, RATE, 3000, write_size=8192)
+        # The file is preallocated for the whole segment
+        self.assertGreaterEqual(os.path.getsize(self.filename), WAV_HEADER_SIZE)
+        for start in range(0, len(data), 1000):
+            w.write(data[start:start + 1000])
+        w.close()
+        self.assertTrue(w.closed)
+        self.assertEqual(os.path.getsize(self.filename), WAV_HEADER_SIZE + len(data))
+        self.assertEqual(self.read(), data)
+
+    def test_shorter_segment_fixes_up_the_header(self):
+        data = frames(1500)
+        w = SegmentWriter(self.filename, CHANNELS, SAMPLE_WIDTH, RATE, 8000)
+        w.write(data)
+        w.close()
+        self.assertEqual(os.path.getsize(self.filename), WAV_HEADER_SIZE + len(data))
+        self.assertEqual(self.read(), data)
+
+    def test_writes_end_on_page_boundaries(self):
+        data = frames(20000)
+        w = RecordingWriter(self.filename, CHANNELS, SAMPLE_WIDTH, RATE, 20000, write_size=16384)
+        for start in range(0, len(data), 1300 * FRAME_SIZE):
+            w.write(data[start:start + 1300 * FRAME_SIZE])
+        w.close()
+        # Header written at the opening, then the data: all the writes but the last one end on a page boundary
+        header, *writes = w.writes
+        self.assertEqual(header, (0, WAV_HEADER_SIZE))
+        self.assertGreater(len(writes), 2)
+        for position, size in writes[:-1]:
+            self.assertEqual((position + size) % WRITE_ALIGNMENT, 0)
+        self.assertEqual(self.read(), data)
+
+    def test_chunk_larger_than_the_buffer(self):
+        data = frames(5000)
+        w = SegmentWriter(self.filename, CHANNELS, SAMPLE_WIDTH, RATE, 5000, write_size=4096)
+        w.write(data[:100])
+        w.write(data[100:])
+        w.close()
+        self.assertEqual(self.read(), data)
+
+    def test_checksums(self):
+        data = frames(2500)
+        w = SegmentWriter(self.filename, CHANNELS, SAMPLE_WIDTH, RATE, 2500, checksum_frames=1000)
+        for start in range(0, len(data), 700 * FRAME_SIZE):
+            w.write(data[start:start + 700 * FRAME_SIZE])
+        w.close()
+        block = 1000 * FRAME_SIZE
+        self.assertEqual(w.checksums(), {
+            'frames': 2500, 'block_frames': 1000, 'crc32': '{:08x}'.format(zlib.crc32(data)),
+            'blocks': ['{:08x}'.format(zlib.crc32(data[start:start + block])) for start in range(0, len(data), block)]})
+
+    def test_gaps_are_stored_with_the_segment(self):
+        w = SegmentWriter(self.filename, CHANNELS, SAMPLE_WIDTH, RATE, 2000)
+        w.write(frames(800))
+        w.mark_gap(400)
+        w.write(frames(800))
+        w.close()
+        with open(w.metadata_filename) as f:
+            metadata = json.load(f)
+        self.assertEqual(metadata['frames'], 1600)
+        self.assertEqual(metadata['gaps'], [{'frame': 800, 'seconds': 0.1, 'lost_frames': 400}])
+
+
+class RepairWavTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'segment.wav')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_segment_which_was_not_closed(self):
+        data = frames(3000)
+        w = SegmentWriter(self.filename, CHANNELS, SAMPLE_WIDTH, RATE, 10000, write_size=8192)
+        w.write(data)
+        w._flush(aligned=False)
+        os.close(w._fd)  # Power failure: the header still reports the expected frames
+        with open(self.filename, 'ab') as f:
+            f.truncate(WAV_HEADER_SIZE + 10000 * FRAME_SIZE)
+
+        self.assertEqual(repair_wav(self.filename), 3000)
+        with wave.open(self.filename) as f:
+            self.assertEqual(f.readframes(f.getnframes()), data)
+
+    def test_frame_multiple(self):
+        data = frames(3000)
+        with open(self.filename, 'wb') as f:
+            f.write(wav_header(CHANNELS, SAMPLE_WIDTH, RATE, 10000 * FRAME_SIZE))
+            f.write(data + bytes(7000 * FRAME_SIZE))
+        self.assertEqual(repair_wav(self.filename, frame_multiple=1024), 2048)
+        self.assertEqual(os.path.getsize(self.filename), WAV_HEADER_SIZE + 2048 * FRAME_SIZE)
+
+    def test_file_which_is_not_a_wav_segment(self):
+        with open(self.filename, 'wb') as f:
+            f.write(bytes(100))
+        with self.assertRaises(ValueError):
+            repair_wav(self.filename)
+
+
+if __name__ == '__main__':
+    unittest.main()